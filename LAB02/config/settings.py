@@ -45,6 +45,23 @@ def load_config() -> dict:
     return _resolve_config(raw)
 
 
+def get_etl_setting(name: str, default=None):
+    """
+    Retorna una opción de la sección `etl` de config.yaml.
+    Como el config se resuelve a strings, el valor se convierte al tipo del default.
+    """
+    value = load_config().get("etl", {}).get(name)
+    if value is None or default is None:
+        return default if value is None else value
+    if isinstance(default, bool):
+        return str(value).strip().lower() in ("true", "1", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
 def setup_logging():
     """Configura el sistema de logging desde logging.yaml."""
     log_dir = BASE_DIR / "logs"
@@ -0,0 +1,69 @@
+-- ============================================================================
+-- Benchmark: cohort_activity de agg_cohort_retention, con y sin fan-out
+-- Uso: psql "$OLAP_URL" -f db/olap/benchmark_cohort_retention.sql
+--
+-- 1) Filas intermedias del join fact_orders × fact_sales (una por línea)
+--    frente al join con el margen pre-agregado por orden (una por cabecera).
+-- 2) EXPLAIN ANALYZE de ambas versiones: comparar "rows" del nodo de join,
+--    memoria/disco del HashAggregate y "Execution Time".
+-- Solo lee: no modifica dw.agg_cohort_retention.
+-- ============================================================================
+\timing on
+
+-- ── 1. Tamaño del intermedio ────────────────────────────────────────────────
+SELECT 'con fan-out (fact_sales por línea)' AS variante, COUNT(*) AS filas_join
+FROM dw.fact_orders fo
+LEFT JOIN dw.fact_sales fs ON fs.sales_order_id = fo.sales_order_id
+UNION ALL
+SELECT 'pre-agregado por orden', COUNT(*)
+FROM dw.fact_orders fo
+LEFT JOIN (
+    SELECT sales_order_id, SUM(gross_margin) AS gross_margin, COUNT(*) AS line_count
+    FROM dw.fact_sales
+    GROUP BY sales_order_id
+) om ON om.sales_order_id = fo.sales_order_id;
+
+-- ── 2a. Versión anterior (fan-out + COUNT DISTINCT) ─────────────────────────
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT
+    dc.cohort_key,
+    fo.months_since_first               AS period_number,
+    TO_CHAR(dd.full_date, 'YYYY-MM')    AS active_period_key,
+    COUNT(DISTINCT fo.customer_key)     AS customer_count,
+    SUM(fo.total_due)                   AS total_revenue,
+    SUM(fs.gross_margin)                AS total_margin
+FROM dw.fact_orders fo
+JOIN dw.dim_customer dc ON dc.customer_key = fo.customer_key
+JOIN dw.dim_date     dd ON dd.date_key     = fo.date_key
+LEFT JOIN dw.fact_sales fs ON fs.sales_order_id = fo.sales_order_id
+WHERE dc.cohort_key IS NOT NULL AND fo.months_since_first IS NOT NULL
+GROUP BY dc.cohort_key, fo.months_since_first, TO_CHAR(dd.full_date, 'YYYY-MM');
+
+-- ── 2b. Versión actual (margen por orden, conteo sin DISTINCT) ──────────────
+-- Mismas cifras que 2a: total_due se pondera por line_count en vez de repetirse
+EXPLAIN (ANALYZE, BUFFERS)
+WITH order_margin AS (
+    SELECT sales_order_id, SUM(gross_margin) AS gross_margin, COUNT(*) AS line_count
+    FROM dw.fact_sales
+    GROUP BY sales_order_id
+),
+customer_activity AS (
+    SELECT
+        dc.cohort_key,
+        fo.months_since_first               AS period_number,
+        TO_CHAR(dd.full_date, 'YYYY-MM')    AS active_period_key,
+        fo.customer_key,
+        SUM(fo.total_due * COALESCE(om.line_count, 1)) AS revenue,
+        SUM(om.gross_margin)                AS margin
+    FROM dw.fact_orders fo
+    JOIN dw.dim_customer dc ON dc.customer_key = fo.customer_key
+    JOIN dw.dim_date     dd ON dd.date_key     = fo.date_key
+    LEFT JOIN order_margin om ON om.sales_order_id = fo.sales_order_id
+    WHERE dc.cohort_key IS NOT NULL AND fo.months_since_first IS NOT NULL
+    GROUP BY dc.cohort_key, fo.months_since_first, TO_CHAR(dd.full_date, 'YYYY-MM'),
+             fo.customer_key
+)
+SELECT cohort_key, period_number, active_period_key,
+       COUNT(*) AS customer_count, SUM(revenue) AS total_revenue, SUM(margin) AS total_margin
+FROM customer_activity
+GROUP BY cohort_key, period_number, active_period_key;
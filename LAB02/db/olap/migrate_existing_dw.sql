@@ -0,0 +1,183 @@
+-- ============================================================
+-- Migración de un DW existente al esquema actual (olap_schema.sql)
+-- Idempotente: puede ejecutarse más de una vez; lo ya migrado se omite.
+--
+--   psql -v ON_ERROR_STOP=1 -d adventureworks_dw -f db/olap/migrate_existing_dw.sql
+--
+-- 1. row_hash en las dimensiones (las filas existentes quedan con NULL y se
+--    reescriben una sola vez en la próxima corrida)
+-- 2. Tablas de control del ETL: etl_watermark, etl_pending_index
+-- 3. Staging y cuarentena del modo ELT
+-- 4. fact_sales / fact_orders sin particionar → particionadas por date_key
+--    (se conservan las filas y las secuencias de las claves surrogadas)
+--
+-- Las particiones se crean para el rango de date_key de los datos existentes,
+-- por mes; con etl.partition_granularity = "year" cambiar `granularity` en el
+-- bloque del paso 4. El resto del rango lo crea el ETL al iniciar.
+-- ============================================================
+
+BEGIN;
+
+-- ── 1. row_hash ─────────────────────────────────────────────
+ALTER TABLE dw.dim_customer  ADD COLUMN IF NOT EXISTS row_hash CHAR(32);
+ALTER TABLE dw.dim_product   ADD COLUMN IF NOT EXISTS row_hash CHAR(32);
+ALTER TABLE dw.dim_territory ADD COLUMN IF NOT EXISTS row_hash CHAR(32);
+
+-- ── 2. Control del ETL ──────────────────────────────────────
+CREATE TABLE IF NOT EXISTS dw.etl_watermark (
+    source_name         VARCHAR(100) PRIMARY KEY,
+    last_value          TIMESTAMP,
+    updated_at          TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS dw.etl_pending_index (
+    index_name          TEXT PRIMARY KEY,
+    table_name          TEXT NOT NULL,
+    definition          TEXT NOT NULL,
+    dropped_at          TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- ── 3. Staging y cuarentena (modo ELT) ──────────────────────
+CREATE UNLOGGED TABLE IF NOT EXISTS dw.stg_order_detail (
+    sales_order_id          INT NOT NULL,
+    sales_order_detail_id   INT NOT NULL,
+    order_date              TIMESTAMP NOT NULL,
+    customer_id             INT,
+    territory_id            INT,
+    product_id              INT,
+    is_online               BOOLEAN,
+    order_qty               SMALLINT NOT NULL,
+    unit_price              NUMERIC(19,4) NOT NULL,
+    unit_price_discount     NUMERIC(19,4) NOT NULL,
+    standard_cost           NUMERIC(19,4)
+);
+-- Versiones anteriores la creaban con standard_cost NOT NULL
+ALTER TABLE dw.stg_order_detail ALTER COLUMN standard_cost DROP NOT NULL;
+
+CREATE TABLE IF NOT EXISTS dw.etl_quarantine_sales (
+    quarantine_id           BIGSERIAL PRIMARY KEY,
+    sales_order_id          INT NOT NULL,
+    sales_order_detail_id   INT NOT NULL,
+    order_date              TIMESTAMP,
+    customer_id             INT,
+    product_id              INT,
+    territory_id            INT,
+    missing_keys            VARCHAR(50) NOT NULL,
+    quarantined_at          TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_quarantine_order ON dw.etl_quarantine_sales (sales_order_id);
+
+-- ── 4. Hechos particionados ─────────────────────────────────
+-- Cada tabla se renombra a <tabla>__legacy, se crea la particionada (misma
+-- definición que olap_schema.sql, reutilizando la secuencia de la clave
+-- surrogada), se crean las particiones, se copian las filas y se elimina la
+-- legacy. Los índices secundarios se crean al final sobre la particionada.
+DO $$
+DECLARE
+    granularity TEXT := 'month';   -- 'month' | 'year' (etl.partition_granularity)
+    fact        TEXT;
+    lo          INT;
+    hi          INT;
+    period      DATE;
+    next_period DATE;
+BEGIN
+    FOREACH fact IN ARRAY ARRAY['fact_sales', 'fact_orders'] LOOP
+        IF (SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'dw' AND c.relname = fact) IS DISTINCT FROM 'r' THEN
+            RAISE NOTICE 'dw.% ya está particionada (o no existe): se omite', fact;
+            CONTINUE;
+        END IF;
+
+        EXECUTE format('ALTER TABLE dw.%I RENAME TO %I', fact, fact || '__legacy');
+        -- Libera los nombres de PK e índices para la tabla nueva
+        EXECUTE format('ALTER TABLE dw.%I DROP CONSTRAINT IF EXISTS %I',
+                       fact || '__legacy', fact || '_pkey');
+
+        IF fact = 'fact_sales' THEN
+            DROP INDEX IF EXISTS dw.idx_fs_date_key, dw.idx_fs_customer_key, dw.idx_fs_product_key,
+                                 dw.idx_fs_territory_key, dw.idx_fs_order_id;
+            CREATE TABLE dw.fact_sales (
+                sales_key               BIGINT NOT NULL DEFAULT nextval('dw.fact_sales_sales_key_seq'),
+                date_key                INT NOT NULL REFERENCES dw.dim_date(date_key),
+                customer_key            INT NOT NULL REFERENCES dw.dim_customer(customer_key),
+                product_key             INT NOT NULL REFERENCES dw.dim_product(product_key),
+                territory_key           INT NOT NULL REFERENCES dw.dim_territory(territory_key),
+                sales_order_id          INT NOT NULL,
+                sales_order_detail_id   INT NOT NULL,
+                order_qty               SMALLINT NOT NULL,
+                unit_price              NUMERIC(19,4) NOT NULL,
+                unit_price_discount     NUMERIC(19,4) NOT NULL,
+                standard_cost           NUMERIC(19,4) NOT NULL,
+                line_total              NUMERIC(19,4) NOT NULL,
+                cost_total              NUMERIC(19,4) NOT NULL,
+                gross_margin            NUMERIC(19,4) NOT NULL,
+                gross_margin_pct        NUMERIC(8,4),
+                is_online               BOOLEAN NOT NULL DEFAULT FALSE,
+                etl_loaded_at           TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (sales_key, date_key),
+                CONSTRAINT uq_fs_order_line UNIQUE (sales_order_id, sales_order_detail_id, date_key)
+            ) PARTITION BY RANGE (date_key);
+            ALTER SEQUENCE dw.fact_sales_sales_key_seq OWNED BY dw.fact_sales.sales_key;
+        ELSE
+            DROP INDEX IF EXISTS dw.idx_fo_date_key, dw.idx_fo_customer_key,
+                                 dw.idx_fo_is_first, dw.idx_fo_is_recurring;
+            CREATE TABLE dw.fact_orders (
+                order_key               BIGINT NOT NULL DEFAULT nextval('dw.fact_orders_order_key_seq'),
+                date_key                INT NOT NULL REFERENCES dw.dim_date(date_key),
+                customer_key            INT NOT NULL REFERENCES dw.dim_customer(customer_key),
+                territory_key           INT NOT NULL REFERENCES dw.dim_territory(territory_key),
+                sales_order_id          INT NOT NULL,
+                sub_total               NUMERIC(19,4) NOT NULL,
+                tax_amt                 NUMERIC(19,4) NOT NULL,
+                freight                 NUMERIC(19,4) NOT NULL,
+                total_due               NUMERIC(19,4) NOT NULL,
+                line_count              INT NOT NULL,
+                customer_order_number   INT,
+                is_first_order          BOOLEAN NOT NULL DEFAULT FALSE,
+                is_recurring            BOOLEAN NOT NULL DEFAULT FALSE,
+                months_since_first      INT,
+                etl_loaded_at           TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (order_key, date_key),
+                CONSTRAINT uq_fo_order UNIQUE (sales_order_id, date_key)
+            ) PARTITION BY RANGE (date_key);
+            ALTER SEQUENCE dw.fact_orders_order_key_seq OWNED BY dw.fact_orders.order_key;
+        END IF;
+
+        -- Particiones para el rango de los datos existentes (mismos nombres que el ETL)
+        EXECUTE format('SELECT MIN(date_key), MAX(date_key) FROM dw.%I', fact || '__legacy')
+            INTO lo, hi;
+        IF lo IS NOT NULL THEN
+            period := to_date(lo::text, 'YYYYMMDD');
+            period := CASE granularity WHEN 'year' THEN date_trunc('year', period)
+                                       ELSE date_trunc('month', period) END;
+            WHILE to_char(period, 'YYYYMMDD')::int <= hi LOOP
+                next_period := period + CASE granularity WHEN 'year' THEN INTERVAL '1 year'
+                                                         ELSE INTERVAL '1 month' END;
+                EXECUTE format('CREATE TABLE IF NOT EXISTS dw.%I PARTITION OF dw.%I '
+                               'FOR VALUES FROM (%s) TO (%s)',
+                               fact || '_p' || to_char(period, CASE granularity WHEN 'year'
+                                                                 THEN 'YYYY' ELSE 'YYYY_MM' END),
+                               fact, to_char(period, 'YYYYMMDD'), to_char(next_period, 'YYYYMMDD'));
+                period := next_period;
+            END LOOP;
+        END IF;
+
+        -- Mismas columnas y en el mismo orden que la tabla original
+        EXECUTE format('INSERT INTO dw.%I SELECT * FROM dw.%I', fact, fact || '__legacy');
+        EXECUTE format('DROP TABLE dw.%I', fact || '__legacy');
+        RAISE NOTICE 'dw.% convertida a tabla particionada', fact;
+    END LOOP;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_fs_date_key       ON dw.fact_sales(date_key);
+CREATE INDEX IF NOT EXISTS idx_fs_customer_key   ON dw.fact_sales(customer_key);
+CREATE INDEX IF NOT EXISTS idx_fs_product_key    ON dw.fact_sales(product_key);
+CREATE INDEX IF NOT EXISTS idx_fs_territory_key  ON dw.fact_sales(territory_key);
+CREATE INDEX IF NOT EXISTS idx_fs_order_id       ON dw.fact_sales(sales_order_id);
+CREATE INDEX IF NOT EXISTS idx_fo_date_key       ON dw.fact_orders(date_key);
+CREATE INDEX IF NOT EXISTS idx_fo_customer_key   ON dw.fact_orders(customer_key);
+CREATE INDEX IF NOT EXISTS idx_fo_is_first       ON dw.fact_orders(is_first_order);
+CREATE INDEX IF NOT EXISTS idx_fo_is_recurring   ON dw.fact_orders(is_recurring);
+
+COMMIT;
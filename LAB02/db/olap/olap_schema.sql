@@ -45,6 +45,7 @@ CREATE TABLE dw.dim_customer (
     cohort_month    SMALLINT,
     cohort_key      CHAR(7),                  -- 'YYYY-MM'
     -- SCD
+    row_hash        CHAR(32),                 -- MD5 del contenido (ETL: solo se reescribe si cambia)
     created_at      TIMESTAMP NOT NULL DEFAULT NOW(),
     updated_at      TIMESTAMP NOT NULL DEFAULT NOW()
 );
@@ -69,6 +70,7 @@ CREATE TABLE dw.dim_product (
     is_bike                BOOLEAN NOT NULL DEFAULT FALSE,
     is_accessory           BOOLEAN NOT NULL DEFAULT FALSE,
     -- SCD
+    row_hash               CHAR(32),          -- MD5 del contenido (ETL: solo se reescribe si cambia)
     created_at             TIMESTAMP NOT NULL DEFAULT NOW(),
     updated_at             TIMESTAMP NOT NULL DEFAULT NOW()
 );
@@ -79,16 +81,21 @@ CREATE TABLE dw.dim_territory (
     territory_id        INT NOT NULL UNIQUE,
     territory_name      VARCHAR(50) NOT NULL,
     country_code        VARCHAR(3) NOT NULL,
-    region_group        VARCHAR(50) NOT NULL
+    region_group        VARCHAR(50) NOT NULL,
+    row_hash            CHAR(32)               -- MD5 del contenido (ETL: solo se reescribe si cambia)
 );
 
 -- ============================================================
 -- TABLAS DE HECHOS
+-- Particionadas por rango de date_key (YYYYMMDD). Las particiones
+-- (fact_sales_pYYYY_MM o fact_sales_pYYYY, según etl.partition_granularity)
+-- las crea el ETL para el rango de dim_date. Las claves únicas incluyen
+-- date_key, como exige PostgreSQL en tablas particionadas.
 -- ============================================================
 
 -- Fact principal: Ventas (granularidad: línea de detalle de orden)
 CREATE TABLE dw.fact_sales (
-    sales_key               BIGSERIAL PRIMARY KEY,
+    sales_key               BIGSERIAL,
     -- Claves foráneas a dimensiones
     date_key                INT NOT NULL REFERENCES dw.dim_date(date_key),
     customer_key            INT NOT NULL REFERENCES dw.dim_customer(customer_key),
@@ -109,19 +116,22 @@ CREATE TABLE dw.fact_sales (
     -- Flags analíticos
     is_online               BOOLEAN NOT NULL DEFAULT FALSE,
     -- Timestamp de carga ETL
-    etl_loaded_at           TIMESTAMP NOT NULL DEFAULT NOW()
-);
+    etl_loaded_at           TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (sales_key, date_key),
+    -- Clave natural de la línea (para upserts incrementales)
+    CONSTRAINT uq_fs_order_line UNIQUE (sales_order_id, sales_order_detail_id, date_key)
+) PARTITION BY RANGE (date_key);
 
 -- Fact: Órdenes (granularidad: cabecera de orden)
 -- Para análisis de clientes recurrentes y cohortes
 CREATE TABLE dw.fact_orders (
-    order_key               BIGSERIAL PRIMARY KEY,
+    order_key               BIGSERIAL,
     -- Claves foráneas
     date_key                INT NOT NULL REFERENCES dw.dim_date(date_key),
     customer_key            INT NOT NULL REFERENCES dw.dim_customer(customer_key),
     territory_key           INT NOT NULL REFERENCES dw.dim_territory(territory_key),
     -- Clave natural
-    sales_order_id          INT NOT NULL UNIQUE,
+    sales_order_id          INT NOT NULL,
     -- Métricas
     sub_total               NUMERIC(19,4) NOT NULL,
     tax_amt                 NUMERIC(19,4) NOT NULL,
@@ -134,8 +144,10 @@ CREATE TABLE dw.fact_orders (
     is_recurring            BOOLEAN NOT NULL DEFAULT FALSE, -- cliente ya había comprado antes
     months_since_first      INT,                        -- meses desde su primera compra
     -- ETL
-    etl_loaded_at           TIMESTAMP NOT NULL DEFAULT NOW()
-);
+    etl_loaded_at           TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (order_key, date_key),
+    CONSTRAINT uq_fo_order UNIQUE (sales_order_id, date_key)
+) PARTITION BY RANGE (date_key);
 
 -- ============================================================
 -- TABLAS DE AGREGACIÓN (pre-calculadas para performance)
@@ -201,6 +213,60 @@ CREATE TABLE dw.agg_customer_recurrence (
     PRIMARY KEY (year, quarter, customer_type)
 );
 
+-- ============================================================
+-- CONTROL DEL ETL
+-- ============================================================
+
+-- High-water mark por tabla fuente del OLTP (carga incremental)
+CREATE TABLE dw.etl_watermark (
+    source_name         VARCHAR(100) PRIMARY KEY,  -- 'sales.sales_order_header', ...
+    last_value          TIMESTAMP,                 -- MAX(modified_date) ya procesado
+    updated_at          TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Índices secundarios eliminados para una carga masiva y aún no recreados
+-- (ver src/load/load_phase.py): se recrean al iniciar la corrida siguiente
+CREATE TABLE dw.etl_pending_index (
+    index_name          TEXT PRIMARY KEY,
+    table_name          TEXT NOT NULL,
+    definition          TEXT NOT NULL,
+    dropped_at          TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- ============================================================
+-- STAGING Y CUARENTENA (modo ELT, etl.elt_facts)
+-- ============================================================
+
+-- Líneas de orden extraídas del OLTP sin transformar (se vacía en cada corrida)
+CREATE UNLOGGED TABLE dw.stg_order_detail (
+    sales_order_id          INT NOT NULL,
+    sales_order_detail_id   INT NOT NULL,
+    order_date              TIMESTAMP NOT NULL,
+    customer_id             INT,
+    territory_id            INT,
+    product_id              INT,
+    is_online               BOOLEAN,
+    order_qty               SMALLINT NOT NULL,
+    unit_price              NUMERIC(19,4) NOT NULL,
+    unit_price_discount     NUMERIC(19,4) NOT NULL,
+    standard_cost           NUMERIC(19,4)   -- del extract de productos; NULL = producto desconocido
+);
+
+-- Líneas sin cliente, producto o territorio en el DW (no se cargan a fact_sales)
+CREATE TABLE dw.etl_quarantine_sales (
+    quarantine_id           BIGSERIAL PRIMARY KEY,
+    sales_order_id          INT NOT NULL,
+    sales_order_detail_id   INT NOT NULL,
+    order_date              TIMESTAMP,
+    customer_id             INT,
+    product_id              INT,
+    territory_id            INT,
+    missing_keys            VARCHAR(50) NOT NULL,  -- p. ej. 'customer,territory'
+    quarantined_at          TIMESTAMP NOT NULL DEFAULT NOW()
+);
+-- Para reemplazar la cuarentena de las órdenes reprocesadas (ver load.elt)
+CREATE INDEX idx_quarantine_order ON dw.etl_quarantine_sales (sales_order_id);
+
 -- ============================================================
 -- ÍNDICES para optimizar las consultas analíticas
 -- ============================================================
@@ -0,0 +1,28 @@
+"""
+Extractores del OLTP.
+`create_extractor` construye el backend configurado en config.yaml (etl.extract_backend).
+"""
+from config.settings import get_etl_setting
+from .sql_extractor import SQLExtractor, ExtractionCache
+from .copy_extractor import CopyExtractor
+
+EXTRACT_BACKENDS = {
+    "sql":  SQLExtractor,    # fetch por cursor (server-side si stream_results)
+    "copy": CopyExtractor,   # COPY (query) TO STDOUT en CSV
+}
+
+
+def create_extractor(backend: str | None = None,
+                     cache: ExtractionCache | None = None) -> SQLExtractor:
+    """
+    Crea el extractor OLTP del backend indicado (o el de config.yaml).
+    `cache` es el caché de extracción compartido de la corrida, si lo hay.
+    """
+    backend = backend or get_etl_setting("extract_backend", "sql")
+    if backend not in EXTRACT_BACKENDS:
+        raise ValueError(f"Backend de extracción desconocido: {backend}")
+    return EXTRACT_BACKENDS[backend](
+        batch_size=get_etl_setting("batch_size", 1000),
+        stream_results=get_etl_setting("stream_results", True),
+        cache=cache,
+    )
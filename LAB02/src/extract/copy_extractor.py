@@ -0,0 +1,122 @@
+"""
+Extractor OLTP basado en COPY (query) TO STDOUT.
+Usa los mismos queries que SQLExtractor, pero el resultado llega como un
+stream CSV (psycopg2 `copy_expert`) que se parsea incrementalmente en batches,
+en lugar de traer las filas con fetch por cursor.
+"""
+import csv
+import logging
+import os
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Callable, Iterator
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from src.extract.sql_extractor import SQLExtractor
+from src.utils.db import get_oltp_engine
+
+logger = logging.getLogger(__name__)
+
+# Con FORCE_QUOTE * todo valor no nulo llega entre comillas y solo los NULL
+# quedan sin comillas. El lector usa QUOTE_NONNUMERIC, que convierte a float
+# los campos sin comillas: el marcador NULL es 'NaN' y cualquier float leído
+# es un NULL, sin confundirlo con un texto igual al marcador (p. ej. "\N")
+NULL_MARKER = "NaN"
+
+# OID de tipo PostgreSQL → conversor desde el texto CSV
+_PG_CONVERTERS: dict[int, Callable[[str], object]] = {
+    16:   lambda v: v == "t",          # bool
+    20:   int,                         # int8
+    21:   int,                         # int2
+    23:   int,                         # int4
+    700:  float,                       # float4
+    701:  float,                       # float8
+    1700: Decimal,                     # numeric
+    1082: date.fromisoformat,          # date
+    1114: datetime.fromisoformat,      # timestamp
+    1184: datetime.fromisoformat,      # timestamptz
+}
+
+
+def _converter(type_code: int) -> Callable[[str | float], object]:
+    convert = _PG_CONVERTERS.get(type_code, str)
+    return lambda v: None if isinstance(v, float) else convert(v)
+
+
+class CopyExtractor(SQLExtractor):
+    """
+    Extrae datos del OLTP con COPY ... TO STDOUT (FORMAT csv).
+    Los valores se convierten a los mismos tipos Python que entrega psycopg2,
+    por lo que extract() / extract_columnar() son intercambiables con SQLExtractor.
+    """
+
+    @staticmethod
+    def _render(query: str, params: dict | None) -> str:
+        """COPY no admite parámetros: se renderizan como literales SQL."""
+        stmt = text(query).bindparams(**params) if params else text(query)
+        return str(stmt.compile(dialect=postgresql.psycopg2.dialect(),
+                                compile_kwargs={"literal_binds": True}))
+
+    def _iter_partitions(self, query: str, params: dict | None) -> Iterator[tuple[list, list]]:
+        """Ejecuta COPY en un hilo que escribe a un pipe y parsea el CSV por batches."""
+        sql = self._render(query, params)
+        connection = get_oltp_engine().raw_connection()
+        dbapi_conn = connection.dbapi_connection
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, "r", encoding="utf-8", newline="")
+        writer = os.fdopen(write_fd, "wb")
+        errors: list[Exception] = []
+        producer = None
+        try:
+            dbapi_conn.set_client_encoding("UTF8")
+            with dbapi_conn.cursor() as cursor:
+                # Metadatos de columnas sin ejecutar el query completo
+                cursor.execute(f"SELECT * FROM ({sql}) q LIMIT 0")
+                keys = [col.name for col in cursor.description]
+                converters = [_converter(col.type_code) for col in cursor.description]
+
+            def produce():
+                try:
+                    with dbapi_conn.cursor() as copy_cursor:
+                        copy_cursor.copy_expert(
+                            f"COPY ({sql}) TO STDOUT "
+                            f"WITH (FORMAT csv, FORCE_QUOTE *, NULL '{NULL_MARKER}')",
+                            writer,
+                        )
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    writer.close()
+
+            producer = threading.Thread(target=produce, name="copy-extract", daemon=True)
+            producer.start()
+
+            rows = []
+            for record in csv.reader(reader, quoting=csv.QUOTE_NONNUMERIC):
+                rows.append(tuple(conv(v) for conv, v in zip(converters, record)))
+                if len(rows) >= self.batch_size:
+                    yield keys, rows
+                    rows = []
+            if rows:
+                yield keys, rows
+            producer.join()
+            if errors:
+                raise errors[0]
+        finally:
+            aborted = producer is not None and producer.is_alive()
+            if aborted:
+                # El consumidor se detuvo antes del fin del COPY: cancelarlo
+                dbapi_conn.cancel()
+            reader.close()
+            if producer is not None:
+                producer.join()
+            else:
+                writer.close()
+            if aborted or errors:
+                # Una conexión con un COPY interrumpido no vuelve al pool
+                connection.invalidate()
+            else:
+                connection.close()
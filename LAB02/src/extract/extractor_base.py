@@ -5,13 +5,16 @@ import logging
 from abc import ABC, abstractmethod
 from typing import Any, Iterator
 
+import pandas as pd
+
 logger = logging.getLogger(__name__)
 
 
 class ExtractorBase(ABC):
     """
     Interfaz que deben implementar todos los extractores.
-    Define el contrato: extract() retorna un iterador de dicts.
+    Define el contrato: extract() retorna un iterador de dicts y
+    extract_columnar() el mismo resultado como DataFrames (una columna por campo).
     """
 
     def __init__(self, batch_size: int = 1000):
@@ -26,6 +29,15 @@ class ExtractorBase(ABC):
         """
         raise NotImplementedError
 
+    def extract_columnar(self, *args, **kwargs) -> Iterator[pd.DataFrame]:
+        """
+        Variante columnar de extract(): cada yield es un DataFrame por batch.
+        Esta implementación convierte los batches de dicts; los extractores
+        concretos la sobreescriben para construirlo sin dicts por fila.
+        """
+        for batch in self.extract(*args, **kwargs):
+            yield pd.DataFrame.from_records(batch)
+
     def log_start(self, source: str):
         self.logger.info("Iniciando extracción desde: %s", source)
 
@@ -1,21 +1,102 @@
 """
 Extractor de datos desde la base OLTP (PostgreSQL - AdventureWorks).
 Ejecuta queries SQL y retorna resultados en batches de dicts.
+
+Con `stream_results=True` el query se ejecuta con un cursor con nombre del
+lado del servidor: psycopg2 trae `batch_size` filas por fetch en lugar de
+materializar todo el resultado en memoria antes del primer batch.
+
+`extract_columnar` entrega cada batch como DataFrame construido directamente
+desde las tuplas del cursor, sin un dict por fila.
+
+`extract_partitioned` divide un query por rangos de una clave entera y
+ejecuta cada rango en su propia conexión OLTP (un hilo por rango); los
+batches se combinan en una cola acotada sin orden global entre rangos.
+
+Con un `ExtractionCache` (uno por corrida, compartido entre pipelines) los
+queries chicos marcados como cacheables (territorios, productos) se
+materializan una sola vez; cada llamada a extract registra si fue hit o miss
+del caché. Los demás extracts toman de ahí los datos de referencia en vez de
+repetir los joins: CustomerPipeline enriquece clientes con los territorios y
+SalesPipeline toma standard_cost de los productos.
+
+`extract_orders` lee cabeceras y detalles en una sola pasada ordenada por
+orden y entrega, por batch, las líneas (fact_sales) y las cabeceras completas
+(fact_orders), con line_count acumulado al recorrer las líneas.
 """
 import logging
-from typing import Iterator
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+
+import numpy as np
+import pandas as pd
 from sqlalchemy import text
 
 from src.extract.extractor_base import ExtractorBase
-from src.utils.db import oltp_session
+from src.utils.db import oltp_session, get_oltp_engine
 from src.utils.exceptions import ExtractionError
+from src.utils.helpers import split_range
 
 logger = logging.getLogger(__name__)
 
+# Columnas de cabecera de QUERY_ORDERS (se repiten en cada línea de la orden)
+ORDER_HEADER_COLUMNS = [
+    "sales_order_id", "order_date", "customer_id", "territory_id", "is_online",
+    "sub_total", "tax_amt", "freight", "total_due", "customer_order_number",
+    "is_first_order", "is_recurring", "months_since_first",
+]
+
+
+class ExtractionCache:
+    """
+    Resultados materializados de queries chicos, por (query, parámetros),
+    compartidos por los extractores de una misma corrida. Thread-safe.
+    Se guardan las filas del cursor tal cual ((columnas, filas) por batch); los
+    dicts se arman recién al entregarlas.
+    """
+
+    def __init__(self):
+        self._results: dict[tuple, list[tuple[list, list]]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(query: str, params: dict | None) -> tuple:
+        return query, repr(sorted((params or {}).items()))
+
+    def get(self, query: str, params: dict | None) -> list[tuple[list, list]] | None:
+        """Batches guardados del query o None; registra el hit / miss."""
+        with self._lock:
+            batches = self._results.get(self.key(query, params))
+            if batches is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        logger.info("Caché de extracción %s: %s...", "hit" if batches is not None else "miss",
+                    " ".join(query.split())[:60])
+        return batches
+
+    def put(self, query: str, params: dict | None, batches: list[tuple[list, list]]):
+        with self._lock:
+            self._results[self.key(query, params)] = batches
+
+    def log_summary(self):
+        logger.info("Caché de extracción: %d hits, %d misses, %d queries materializados",
+                    self.hits, self.misses, len(self._results))
+
 
 class SQLExtractor(ExtractorBase):
     """Extrae datos del OLTP usando SQLAlchemy + queries SQL."""
 
+    def __init__(self, batch_size: int = 1000, stream_results: bool = True,
+                 cache: ExtractionCache | None = None):
+        super().__init__(batch_size=batch_size)
+        self.stream_results = stream_results
+        self.cache = cache
+
     # ── Queries de extracción ────────────────────────────────────────────────
 
     QUERY_CUSTOMERS = """
@@ -25,13 +106,9 @@ class SQLExtractor(ExtractorBase):
             c.territory_id,
             p.first_name,
             p.last_name,
-            TRIM(COALESCE(p.first_name,'') || ' ' || COALESCE(p.last_name,'')) AS full_name,
-            st.name          AS territory_name,
-            st.group         AS region_group,
-            st.country_region_code AS country_code
+            TRIM(COALESCE(p.first_name,'') || ' ' || COALESCE(p.last_name,'')) AS full_name
         FROM sales.customer c
         LEFT JOIN person.person p              ON p.business_entity_id = c.person_id
-        LEFT JOIN sales.sales_territory st     ON st.territory_id      = c.territory_id
         ORDER BY c.customer_id
     """
 
@@ -64,52 +141,109 @@ class SQLExtractor(ExtractorBase):
         ORDER BY territory_id
     """
 
-    QUERY_ORDER_DETAILS = """
+    # Clientes con alguna orden modificada desde el watermark / con órdenes en un periodo.
+    # Se filtran dentro del CTE (sobre la columna del PARTITION BY): las ventanas ven
+    # el historial completo de esos clientes y el OLTP no procesa el resto
+    _CHANGED_CUSTOMERS = """
+              AND soh.customer_id IN (
+                  SELECT h.customer_id
+                  FROM sales.sales_order_header h
+                  WHERE h.modified_date > :header_since
+                  UNION
+                  SELECT h.customer_id
+                  FROM sales.sales_order_header h
+                  JOIN sales.sales_order_detail d ON d.sales_order_id = h.sales_order_id
+                  WHERE d.modified_date > :detail_since
+              )"""
+
+    _PERIOD_CUSTOMERS = """
+              AND soh.customer_id IN (
+                  SELECT h.customer_id
+                  FROM sales.sales_order_header h
+                  WHERE h.order_date >= :period_start AND h.order_date < :period_end
+              )"""
+
+    # Cabecera + detalle en una pasada: una fila por línea con las columnas de
+    # la cabecera; la numeración por cliente usa DENSE_RANK sobre las líneas
+    # (un número por orden, sobre el historial completo del cliente). `line_changed`
+    # marca las líneas que hay que escribir en fact_sales: en incremental las
+    # demás líneas de los clientes afectados solo cuentan para las cabeceras
+    _SELECT_ORDERS = """
+        WITH lines AS (
+            SELECT
+                sod.sales_order_id,
+                sod.sales_order_detail_id,
+                soh.order_date,
+                soh.customer_id,
+                soh.territory_id,
+                soh.online_order_flag AS is_online,
+                sod.product_id,
+                sod.order_qty,
+                sod.unit_price,
+                sod.unit_price_discount,
+                soh.sub_total,
+                soh.tax_amt,
+                soh.freight,
+                soh.total_due,
+                {line_changed} AS line_changed,
+                DENSE_RANK() OVER (PARTITION BY soh.customer_id
+                                   ORDER BY soh.order_date, soh.sales_order_id) AS customer_order_number,
+                MIN(soh.order_date) OVER (PARTITION BY soh.customer_id)         AS first_order_date
+            FROM sales.sales_order_detail sod
+            JOIN sales.sales_order_header soh   ON soh.sales_order_id = sod.sales_order_id
+            WHERE soh.status = 5{customers}
+        )
         SELECT
-            sod.sales_order_id,
-            sod.sales_order_detail_id,
-            soh.order_date,
-            soh.customer_id,
-            soh.territory_id,
-            soh.online_order_flag AS is_online,
-            sod.product_id,
-            sod.order_qty,
-            sod.unit_price,
-            sod.unit_price_discount,
-            p.standard_cost,
-            p.list_price,
-            p.product_subcategory_id AS subcategory_id,
-            ps.name                  AS subcategory_name,
-            pc.product_category_id   AS category_id,
-            pc.name                  AS category_name
-        FROM sales.sales_order_detail sod
-        JOIN sales.sales_order_header soh   ON soh.sales_order_id = sod.sales_order_id
-        JOIN production.product p           ON p.product_id        = sod.product_id
-        LEFT JOIN production.product_subcategory ps ON ps.product_subcategory_id = p.product_subcategory_id
-        LEFT JOIN production.product_category    pc ON pc.product_category_id    = ps.product_category_id
-        WHERE soh.status = 5
-        ORDER BY soh.order_date, sod.sales_order_id, sod.sales_order_detail_id
+            l.sales_order_id, l.sales_order_detail_id, l.order_date, l.customer_id,
+            l.territory_id, l.is_online, l.product_id, l.order_qty, l.unit_price,
+            l.unit_price_discount, l.sub_total, l.tax_amt, l.freight, l.total_due,
+            l.line_changed,
+            l.customer_order_number,
+            l.customer_order_number = 1 AS is_first_order,
+            l.customer_order_number > 1 AS is_recurring,
+            CAST((EXTRACT(YEAR FROM l.order_date) - EXTRACT(YEAR FROM l.first_order_date)) * 12
+                 + EXTRACT(MONTH FROM l.order_date) - EXTRACT(MONTH FROM l.first_order_date)
+                 AS INT) AS months_since_first
+        FROM lines l
+        WHERE TRUE
+    """
+
+    # Las líneas salen ordenadas por orden: _extract_orders_stream lo necesita
+    # para acumular line_count (también en los rangos de extract_partitioned)
+    ORDERS_ORDER_BY = "sales_order_id, sales_order_detail_id"
+
+    QUERY_ORDERS = _SELECT_ORDERS.format(line_changed="TRUE", customers="") + f"""
+        ORDER BY {ORDERS_ORDER_BY}
+    """
+
+    # Incremental: todas las líneas de los clientes con alguna orden modificada
+    # (las cabeceras necesitan el line_count completo y la renumeración); solo las
+    # líneas cuya cabecera o detalle cambió llevan line_changed
+    QUERY_ORDERS_CHANGED = _SELECT_ORDERS.format(
+        line_changed="(soh.modified_date > :header_since OR sod.modified_date > :detail_since)",
+        customers=_CHANGED_CUSTOMERS,
+    ) + f"""
+        ORDER BY {ORDERS_ORDER_BY}
     """
 
-    QUERY_ORDER_HEADERS = """
+    QUERY_ORDERS_PERIOD = _SELECT_ORDERS.format(line_changed="TRUE",
+                                                customers=_PERIOD_CUSTOMERS) + f"""
+          AND l.order_date >= :period_start AND l.order_date < :period_end
+        ORDER BY {ORDERS_ORDER_BY}
+    """
+
+    QUERY_MODIFIED_HIGH_MARKS = """
         SELECT
-            soh.sales_order_id,
-            soh.order_date,
-            soh.customer_id,
-            soh.territory_id,
-            soh.online_order_flag AS is_online,
-            soh.sub_total,
-            soh.tax_amt,
-            soh.freight,
-            soh.total_due,
-            COUNT(sod.sales_order_detail_id) AS line_count
-        FROM sales.sales_order_header soh
-        JOIN sales.sales_order_detail sod ON sod.sales_order_id = soh.sales_order_id
-        WHERE soh.status = 5
-        GROUP BY soh.sales_order_id, soh.order_date, soh.customer_id,
-                 soh.territory_id, soh.online_order_flag,
-                 soh.sub_total, soh.tax_amt, soh.freight, soh.total_due
-        ORDER BY soh.order_date, soh.sales_order_id
+            (SELECT MAX(modified_date) FROM sales.sales_order_header) AS header_max,
+            (SELECT MAX(modified_date) FROM sales.sales_order_detail) AS detail_max
+    """
+
+    # Rangos de clientes para extraer órdenes en paralelo: cada rango contiene
+    # historiales completos, como requieren las ventanas por cliente
+    QUERY_CUSTOMER_ID_BOUNDS = """
+        SELECT MIN(customer_id) AS lo, MAX(customer_id) AS hi
+        FROM sales.sales_order_header
+        WHERE status = 5
     """
 
     QUERY_FIRST_ORDERS = """
@@ -121,48 +255,232 @@ class SQLExtractor(ExtractorBase):
         GROUP BY customer_id
     """
 
-    def extract(self, query: str, **kwargs) -> Iterator[list[dict]]:
-        """Ejecuta un query y retorna resultados en batches."""
+    def _execution_options(self) -> dict:
+        """Opciones de ejecución: cursor del servidor con fetch de `batch_size` filas."""
+        if not self.stream_results:
+            return {}
+        return {"stream_results": True, "yield_per": self.batch_size}
+
+    def _iter_partitions(self, query: str, params: dict | None) -> Iterator[tuple[list, list]]:
+        """Ejecuta el query y entrega (columnas, filas) de a `batch_size` filas."""
+        with oltp_session() as session:
+            result = session.execute(text(query), params or {},
+                                     execution_options=self._execution_options())
+            keys = list(result.keys())
+            for rows in result.partitions(self.batch_size):
+                yield keys, rows
+
+    def extract(self, query: str, params: dict | None = None, cacheable: bool = False,
+                **kwargs) -> Iterator[list[dict]]:
+        """
+        Ejecuta un query y retorna resultados en batches. Con `cacheable=True`
+        (solo para resultados chicos) el resultado se guarda en el caché de la corrida.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(query, params)
+            if cached is not None:
+                for keys, rows in cached:
+                    yield [dict(zip(keys, row)) for row in rows]
+                return
+        self.log_start(query[:60] + "...")
+        total = 0
+        stored = [] if cacheable and self.cache is not None else None
+        try:
+            for keys, rows in self._iter_partitions(query, params):
+                batch = [dict(zip(keys, row)) for row in rows]
+                total += len(batch)
+                if stored is not None:
+                    stored.append((keys, rows))
+                yield batch
+        except Exception as e:
+            raise ExtractionError(f"Error extrayendo datos: {e}") from e
+        if stored is not None:
+            self.cache.put(query, params, stored)
+        self.log_done(total, "OLTP")
+
+    def extract_columnar(self, query: str, params: dict | None = None,
+                         **kwargs) -> Iterator[pd.DataFrame]:
+        """Ejecuta un query y retorna resultados en batches columnares (DataFrame)."""
+        if self.cache is not None:
+            # Los streams columnares (líneas de orden) no se materializan: siempre miss
+            self.cache.get(query, params)
         self.log_start(query[:60] + "...")
         total = 0
         try:
-            with oltp_session() as session:
-                result = session.execute(text(query))
-                keys = list(result.keys())
-                batch = []
-                for row in result:
-                    batch.append(dict(zip(keys, row)))
-                    if len(batch) >= self.batch_size:
-                        total += len(batch)
-                        yield batch
-                        batch = []
-                if batch:
-                    total += len(batch)
-                    yield batch
+            for keys, rows in self._iter_partitions(query, params):
+                frame = pd.DataFrame.from_records(rows, columns=keys)
+                total += len(frame)
+                yield frame
         except Exception as e:
             raise ExtractionError(f"Error extrayendo datos: {e}") from e
         self.log_done(total, "OLTP")
 
+    @staticmethod
+    def _range_query(query: str, key: str, order_by: str | None = None) -> str:
+        """
+        Restringe un query a un rango [range_lo, range_hi] de la columna `key`.
+        El ORDER BY de un subquery no se conserva en el query externo: si el
+        consumidor necesita orden, `order_by` (columnas del query) se aplica afuera.
+        """
+        query = f"SELECT * FROM ({query}) q WHERE q.{key} BETWEEN :range_lo AND :range_hi"
+        if order_by:
+            query += " ORDER BY " + ", ".join(f"q.{col.strip()}" for col in order_by.split(","))
+        return query
+
+    def extract_partitioned(self, query: str, key: str, bounds_query: str,
+                            partitions: int, params: dict | None = None,
+                            columnar: bool = False,
+                            extract_fn: Callable[[str, dict], Iterator] | None = None,
+                            order_by: str | None = None) -> Iterator:
+        """
+        Extrae `query` en paralelo dividiendo `key` en rangos.
+        `bounds_query` debe retornar (lo, hi) de la clave. El número de hilos
+        se limita al tamaño del pool OLTP; el orden entre rangos no se conserva.
+        Con `columnar=True` los batches son DataFrames (ver extract_columnar);
+        `extract_fn(query, params)` reemplaza la extracción de cada rango y
+        `order_by` ordena las filas dentro de cada rango.
+        """
+        extract_fn = extract_fn or (self.extract_columnar if columnar else self.extract)
+        params = params or {}
+        with oltp_session() as session:
+            lo, hi = session.execute(text(bounds_query), params).fetchone()
+        if lo is None:
+            return
+        engine = get_oltp_engine()
+        ranges = split_range(lo, hi, min(partitions, engine.pool.size()))
+        self.logger.info("Extracción particionada: %d rangos de %s [%s, %s]",
+                         len(ranges), key, lo, hi)
+
+        range_query = self._range_query(query, key, order_by)
+        out = queue.Queue(maxsize=2 * len(ranges))
+        stop = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker(range_lo: int, range_hi: int):
+            try:
+                bounds = {**params, "range_lo": range_lo, "range_hi": range_hi}
+                for batch in extract_fn(range_query, bounds):
+                    if not put(batch):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="extract") as pool:
+            for range_lo, range_hi in ranges:
+                pool.submit(worker, range_lo, range_hi)
+            try:
+                pending = len(ranges)
+                while pending:
+                    item = out.get()
+                    if item is done:
+                        pending -= 1
+                    elif isinstance(item, Exception):
+                        raise ExtractionError(f"Error en extracción particionada: {item}") from item
+                    else:
+                        yield item
+            finally:
+                stop.set()
+
     def extract_customers(self) -> Iterator[list[dict]]:
+        """Clientes sin datos de territorio (ver CustomerPipeline, que usa extract_territories)."""
         yield from self.extract(self.QUERY_CUSTOMERS)
 
     def extract_products(self) -> Iterator[list[dict]]:
-        yield from self.extract(self.QUERY_PRODUCTS)
+        yield from self.extract(self.QUERY_PRODUCTS, cacheable=True)
 
     def extract_territories(self) -> Iterator[list[dict]]:
-        yield from self.extract(self.QUERY_TERRITORIES)
+        yield from self.extract(self.QUERY_TERRITORIES, cacheable=True)
 
-    def extract_order_details(self) -> Iterator[list[dict]]:
-        yield from self.extract(self.QUERY_ORDER_DETAILS)
+    @staticmethod
+    def _order_starts(order_ids: np.ndarray) -> np.ndarray:
+        """Posiciones donde empieza cada orden en líneas ordenadas por sales_order_id."""
+        if not len(order_ids):
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(np.r_[True, order_ids[1:] != order_ids[:-1]])
 
-    def extract_order_headers(self) -> Iterator[list[dict]]:
-        yield from self.extract(self.QUERY_ORDER_HEADERS)
+    def _extract_orders_stream(self, query: str,
+                               params: dict | None = None) -> Iterator[tuple[pd.DataFrame, list[dict]]]:
+        """
+        Recorre las líneas (ordenadas por orden) y entrega (líneas, cabeceras).
+        La última orden de cada batch puede seguir en el siguiente: su cabecera
+        queda pendiente, acumulando line_count, hasta ver la orden siguiente.
+        Solo se entregan las líneas con `line_changed` (todas, salvo en incremental).
+        """
+        pending = None
+        for frame in self.extract_columnar(query, params):
+            if not len(frame):
+                continue
+            order_ids = frame["sales_order_id"].to_numpy()
+            previous = pending["sales_order_id"] if pending is not None else order_ids[0]
+            if order_ids[0] < previous or (np.diff(order_ids) < 0).any():
+                raise ExtractionError("Las líneas de orden no llegan ordenadas por sales_order_id")
+            starts = self._order_starts(order_ids)
+            counts = np.diff(np.r_[starts, len(frame)])
+            headers = frame.iloc[starts][ORDER_HEADER_COLUMNS].to_dict("records")
+            for header, count in zip(headers, counts.tolist()):
+                header["line_count"] = count
+
+            if pending is not None and pending["sales_order_id"] == headers[0]["sales_order_id"]:
+                pending["line_count"] += headers[0]["line_count"]
+                headers[0] = pending
+            elif pending is not None:
+                headers.insert(0, pending)
+            pending = headers.pop()
+
+            changed = frame["line_changed"].to_numpy(dtype=bool)
+            if not changed.all():
+                frame = frame[changed]
+            yield frame, headers
+        if pending is not None:
+            yield frame.iloc[:0], [pending]
+
+    def extract_orders(self, since: dict | None = None,
+                       partitions: int = 1) -> Iterator[tuple[pd.DataFrame, list[dict]]]:
+        """
+        Cabeceras y líneas de orden en una sola pasada: cada yield es
+        (DataFrame de líneas, cabeceras completas). Con `partitions` > 1 cada
+        rango de customer_id se recorre por separado (órdenes completas por rango).
+        `since` = {"header_since": ts, "detail_since": ts}: solo órdenes de los
+        clientes con cambios desde el watermark; sin `since`, el historial completo.
+        """
+        query = self.QUERY_ORDERS_CHANGED if since else self.QUERY_ORDERS
+        if partitions > 1:
+            yield from self.extract_partitioned(query, "customer_id", self.QUERY_CUSTOMER_ID_BOUNDS,
+                                                partitions, since,
+                                                extract_fn=self._extract_orders_stream,
+                                                order_by=self.ORDERS_ORDER_BY)
+        else:
+            yield from self._extract_orders_stream(query, since)
+
+    def extract_orders_period(self, start, end) -> Iterator[tuple[pd.DataFrame, list[dict]]]:
+        """Cabeceras y líneas (una pasada) de las órdenes con order_date en [start, end)."""
+        yield from self._extract_orders_stream(self.QUERY_ORDERS_PERIOD,
+                                               {"period_start": start, "period_end": end})
+
+    def extract_modified_high_marks(self) -> dict:
+        """Retorna el MAX(modified_date) actual de cabeceras y detalles de órdenes."""
+        with oltp_session() as session:
+            row = session.execute(text(self.QUERY_MODIFIED_HIGH_MARKS)).fetchone()
+        return {
+            "sales.sales_order_header": row.header_max,
+            "sales.sales_order_detail": row.detail_max,
+        }
 
     def extract_first_orders(self) -> dict:
         """Retorna un dict {customer_id: first_order_date}."""
         result = {}
-        with oltp_session() as session:
-            rows = session.execute(text(self.QUERY_FIRST_ORDERS))
-            for row in rows:
-                result[row.customer_id] = row.first_order_date
+        for batch in self.extract(self.QUERY_FIRST_ORDERS):
+            for row in batch:
+                result[row["customer_id"]] = row["first_order_date"]
         return result
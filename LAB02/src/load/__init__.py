@@ -1,48 +1,217 @@
 """
 Módulo de carga al Data Warehouse OLAP.
 Implementa upsert (insert-or-update) para todas las tablas del DW.
+Los hechos se cargan en full refresh (TRUNCATE + INSERT o COPY, ver
+copy_loader) o, en modo incremental, con upsert sobre su clave natural y un
+watermark por fuente. En modo ELT fact_sales se resuelve en SQL desde una
+tabla de staging (ver elt). Hechos y agregaciones pueden escribirse en tablas
+shadow que luego se publican con un swap atómico (ver swap).
 """
 import logging
-from datetime import datetime
+from datetime import date, datetime
 from typing import Any
 
-from sqlalchemy import text
+import numpy as np
+import pandas as pd
+from sqlalchemy import Integer, column, literal_column, table, text, tuple_
 from sqlalchemy.orm import Session
 from sqlalchemy.dialects.postgresql import insert
 
 from src.models.entities import (
     DimDate, DimCustomer, DimProduct, DimTerritory,
     FactSales, FactOrders,
-    AggMarketBasket, AggCohortRetention, AggProductMargin, AggCustomerRecurrence
+    AggMarketBasket, AggCohortRetention, AggProductMargin, AggCustomerRecurrence,
+    EtlWatermark
 )
+from src.load.copy_loader import copy_rows, copy_fact_sales, copy_fact_orders, scaled_columns
+from src.load.swap import create_shadow_tables, drop_shadow_tables, swap_shadow_tables
+from src.load.load_phase import LoadPhaseManager
+from src.load.partitions import ensure_fact_partitions, create_reload_table, swap_partition
+from src.load.elt import (
+    truncate_staging, stage_order_details, staged_margin_cells, load_fact_sales_elt
+)
+from src.transform import scaled_to_decimal
+from src.transform.market_basket import BasketAccumulator
 from src.utils.exceptions import LoadError
+from src.utils.helpers import chunked, date_to_key
 
 logger = logging.getLogger(__name__)
 
+# Upserts: a partir de este tamaño se usa tabla de staging + COPY
+STAGING_THRESHOLD = 5000
+# Filas por sentencia VALUES (límite de parámetros de PostgreSQL: 65535)
+UPSERT_CHUNK_SIZE = 1000
+# Filas por fetch al leer fact_sales para el market basket disperso
+BASKET_FETCH_SIZE = 50000
+# Columna de RETURNING que distingue filas insertadas de actualizadas en un upsert
+INSERTED_FLAG = "(xmax = 0) AS inserted"
+
+# Nombre físico de cada tabla del DW. Los loaders de hechos y agregaciones
+# aceptan `tables` para redirigir algunas a su copia shadow (ver load.swap).
+DW_TABLES = {
+    name: f"dw.{name}"
+    for name in ("dim_date", "dim_customer", "dim_product", "dim_territory",
+                 "fact_sales", "fact_orders",
+                 "agg_market_basket", "agg_product_margin",
+                 "agg_cohort_retention", "agg_customer_recurrence")
+}
+
 
 # ── Helpers ─────────────────────────────────────────────────────────────────
 
+def _resolve_tables(tables: dict | None) -> dict:
+    """DW_TABLES con los reemplazos de `tables` ({nombre: tabla física})."""
+    return {**DW_TABLES, **(tables or {})}
+
+
+def resolve_table(name: str, tables: dict | None = None) -> str:
+    """Tabla física de `name` (su shadow si figura en `tables`)."""
+    return _resolve_tables(tables)[name]
+
+
+def _insert_target(model, tables: dict | None):
+    """Tabla destino de un INSERT: la del modelo o su shadow (misma estructura)."""
+    schema, name = _resolve_tables(tables)[model.__tablename__].split(".")
+    if name == model.__tablename__:
+        return model.__table__
+    return table(name, *(column(c.name) for c in model.__table__.columns), schema=schema)
+
+
+def _as_records(rows, model=None) -> list[dict]:
+    """
+    Acepta list[dict] o un batch columnar (DataFrame); NaN/NaT se cargan como NULL.
+    Con `model`, los importes escalados del batch (int64 × 10^4) vuelven a Decimal
+    y las columnas enteras que pandas pasó a float por tener NaN vuelven a int.
+    Solo para las rutas por fila (VALUES / executemany); el COPY usa el DataFrame.
+    """
+    if isinstance(rows, pd.DataFrame):
+        records = rows.astype(object).where(rows.notna(), None)
+        if model is not None:
+            for col in scaled_columns(model, rows):
+                records[col] = scaled_to_decimal(rows[col].to_numpy())
+            for col in model.__table__.columns:
+                if isinstance(col.type, Integer) and rows.get(col.name) is not None \
+                        and rows[col.name].dtype.kind == "f":
+                    ints = rows[col.name].astype("Int64").astype(object)
+                    records[col.name] = ints.where(ints.notna(), None)
+        return records.to_dict("records")
+    return rows
+
+
+def _row_columns(rows) -> list[str]:
+    """Columnas de un batch (DataFrame o list[dict] no vacía)."""
+    if isinstance(rows, pd.DataFrame):
+        return list(rows.columns)
+    return list(rows[0].keys())
+
+
+def _update_columns(model, conflict_cols: list[str], update_cols: list[str] | None) -> list[str]:
+    """
+    Columnas a actualizar en el upsert: todas excepto las de conflicto; la clave
+    surrogada (PK) y created_at se conservan para no romper las FKs.
+    """
+    if update_cols:
+        return list(update_cols)
+    return [
+        col.name for col in model.__table__.columns
+        if col.name not in conflict_cols
+        and col.name not in ("etl_loaded_at", "created_at")
+        and not col.primary_key
+    ]
+
+
+def _values_upsert(session: Session, model, rows: list[dict], conflict_cols: list[str],
+                   update_cols: list[str], changed_cols: list[str] | None = None,
+                   returning: list[str] | None = None) -> list:
+    """INSERT ... VALUES (...), (...) ON CONFLICT DO UPDATE en chunks de UPSERT_CHUNK_SIZE filas."""
+    returned = []
+    for chunk in chunked(rows, UPSERT_CHUNK_SIZE):
+        stmt = insert(model.__table__).values(chunk)
+        update_dict = {col: getattr(stmt.excluded, col) for col in update_cols}
+        where = None
+        if changed_cols:
+            current  = [model.__table__.c[col] for col in changed_cols]
+            incoming = [getattr(stmt.excluded, col) for col in changed_cols]
+            if len(changed_cols) > 1:
+                current, incoming = [tuple_(*current)], [tuple_(*incoming)]
+            where = current[0].is_distinct_from(incoming[0])
+        stmt = stmt.on_conflict_do_update(index_elements=conflict_cols, set_=update_dict,
+                                          where=where)
+        if returning:
+            stmt = stmt.returning(*(model.__table__.c[col] if col in model.__table__.c
+                                    else literal_column(col) for col in returning))
+            returned.extend(session.execute(stmt).fetchall())
+        else:
+            session.execute(stmt)
+    return returned
+
+
+def _staged_upsert(session: Session, model, rows: list[dict], conflict_cols: list[str],
+                   update_cols: list[str], changed_cols: list[str] | None = None,
+                   returning: list[str] | None = None) -> list:
+    """
+    COPY de las filas a una tabla temporal y un único INSERT ... SELECT ... ON CONFLICT
+    set-based hacia la tabla del DW. La tabla temporal se elimina al hacer commit.
+    """
+    table   = f"{model.__table__.schema}.{model.__tablename__}"
+    staging = f"stg_{model.__tablename__}"
+    columns = _row_columns(rows)
+    col_list = ", ".join(columns)
+    set_list = ",\n            ".join(f"{col} = EXCLUDED.{col}" for col in update_cols)
+    where = ""
+    if changed_cols:
+        current  = ", ".join(f"t.{col}" for col in changed_cols)
+        incoming = ", ".join(f"EXCLUDED.{col}" for col in changed_cols)
+        if len(changed_cols) > 1:
+            current, incoming = f"({current})", f"({incoming})"
+        where = f"\n        WHERE {current} IS DISTINCT FROM {incoming}"
+    returning_sql = f"\n        RETURNING {', '.join(returning)}" if returning else ""
+
+    # Solo las columnas cargadas, sin defaults ni constraints (no consume secuencias)
+    session.execute(text(
+        f"CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DROP AS "
+        f"SELECT {col_list} FROM {table} WITH NO DATA"
+    ))
+    session.execute(text(f"TRUNCATE {staging}"))
+    scaled = scaled_columns(model, rows) if isinstance(rows, pd.DataFrame) else ()
+    copy_rows(session, staging, columns, rows, scaled)
+    result = session.execute(text(f"""
+        INSERT INTO {table} AS t ({col_list})
+        SELECT {col_list} FROM {staging}
+        ON CONFLICT ({", ".join(conflict_cols)}) DO UPDATE SET
+            {set_list}{where}{returning_sql}
+    """))
+    return result.fetchall() if returning else []
+
+
 def _bulk_upsert(session: Session, model, rows: list[dict], conflict_cols: list[str],
-                 update_cols: list[str] | None = None):
+                 update_cols: list[str] | None = None, only_changed: bool = False,
+                 returning: list[str] | None = None) -> list:
     """
     Inserta o actualiza (upsert) un lote de filas usando ON CONFLICT DO UPDATE.
+    Lotes grandes (>= STAGING_THRESHOLD) pasan por una tabla temporal cargada con
+    COPY; los pequeños usan VALUES multi-fila en chunks.
+    Con only_changed=True solo se actualizan las filas que cambiaron: se compara
+    row_hash si las filas lo traen y, si no, todas las columnas cargadas. Con
+    `returning` se retornan esas columnas de las filas insertadas o actualizadas.
+    Los DataFrames van tal cual al COPY; solo la ruta VALUES los pasa a dicts.
     """
-    if not rows:
-        return
+    if len(rows) == 0:
+        return []
     try:
-        stmt = insert(model.__table__).values(rows)
-        if update_cols:
-            update_dict = {col: getattr(stmt.excluded, col) for col in update_cols}
+        columns = _update_columns(model, conflict_cols, update_cols)
+        loaded  = _row_columns(rows)
+        changed = None
+        if only_changed:
+            changed = ["row_hash"] if "row_hash" in loaded else [c for c in columns if c in loaded]
+        if len(rows) >= STAGING_THRESHOLD:
+            returned = _staged_upsert(session, model, rows, conflict_cols, columns, changed,
+                                      returning)
         else:
-            # Actualizar todas las columnas excepto las de conflicto
-            update_dict = {
-                col.name: getattr(stmt.excluded, col.name)
-                for col in model.__table__.columns
-                if col.name not in conflict_cols and col.name not in ("etl_loaded_at",)
-            }
-        stmt = stmt.on_conflict_do_update(index_elements=conflict_cols, set_=update_dict)
-        session.execute(stmt)
+            returned = _values_upsert(session, model, _as_records(rows, model), conflict_cols,
+                                      columns, changed, returning)
         logger.debug("Upserted %d rows en %s", len(rows), model.__tablename__)
+        return returned
     except Exception as e:
         raise LoadError(f"Error en upsert a {model.__tablename__}: {e}") from e
 
@@ -55,70 +224,183 @@ def load_dim_dates(session: Session, rows: list[dict]):
     logger.info("Cargados %d registros en dim_date", len(rows))
 
 
-def load_dim_territories(session: Session, rows: list[dict]):
-    """Carga dim_territory."""
-    _bulk_upsert(session, DimTerritory, rows, conflict_cols=["territory_id"])
-    logger.info("Cargados %d registros en dim_territory", len(rows))
+def missing_dim_dates(session: Session, start: date, end: date) -> pd.DatetimeIndex:
+    """
+    Días de [start, end] que faltan en dim_date. Si la cobertura está completa
+    basta un COUNT sobre la PK; solo si faltan días se leen las claves existentes.
+    """
+    days = pd.date_range(start, end, freq="D")
+    params = {"lo": date_to_key(start), "hi": date_to_key(end)}
+    try:
+        present = session.execute(text(
+            "SELECT COUNT(*) FROM dw.dim_date WHERE date_key BETWEEN :lo AND :hi"
+        ), params).scalar()
+        if present == len(days):
+            return days[:0]
+        existing = np.fromiter((row.date_key for row in session.execute(text(
+            "SELECT date_key FROM dw.dim_date WHERE date_key BETWEEN :lo AND :hi"
+        ), params)), dtype=np.int64)
+    except Exception as e:
+        raise LoadError(f"Error leyendo cobertura de dim_date: {e}") from e
+    keys = days.year * 10000 + days.month * 100 + days.day
+    return days[~np.isin(keys, existing)]
+
+
+def _upsert_dimension(session: Session, model, rows: list[dict], natural_key: str,
+                      surrogate_key: str) -> list:
+    """
+    Upsert de una dimensión por su id natural reescribiendo solo las filas cuyo
+    row_hash cambió. Registra insertadas / actualizadas / sin cambios y retorna
+    (id natural, clave surrogada) de las insertadas o actualizadas.
+    """
+    returned = _bulk_upsert(session, model, rows, conflict_cols=[natural_key], only_changed=True,
+                            returning=[natural_key, surrogate_key, INSERTED_FLAG])
+    inserted = sum(1 for row in returned if row[2])
+    logger.info("%s: %d insertados, %d actualizados, %d sin cambios", model.__tablename__,
+                inserted, len(returned) - inserted, len(rows) - len(returned))
+    return [(row[0], row[1]) for row in returned]
+
+
+def load_dim_territories(session: Session, rows: list[dict]) -> list:
+    """Carga dim_territory; retorna (territory_id, territory_key) de las filas nuevas o modificadas."""
+    return _upsert_dimension(session, DimTerritory, rows, "territory_id", "territory_key")
 
 
-def load_dim_customers(session: Session, rows: list[dict]):
-    """Carga dim_customer."""
-    _bulk_upsert(session, DimCustomer, rows, conflict_cols=["customer_id"])
-    logger.info("Cargados %d registros en dim_customer", len(rows))
+def load_dim_customers(session: Session, rows: list[dict]) -> list:
+    """Carga dim_customer; retorna (customer_id, customer_key) de las filas nuevas o modificadas."""
+    return _upsert_dimension(session, DimCustomer, rows, "customer_id", "customer_key")
 
 
-def load_dim_products(session: Session, rows: list[dict]):
-    """Carga dim_product."""
-    _bulk_upsert(session, DimProduct, rows, conflict_cols=["product_id"])
-    logger.info("Cargados %d registros en dim_product", len(rows))
+def load_dim_products(session: Session, rows: list[dict]) -> list:
+    """Carga dim_product; retorna (product_id, product_key) de las filas nuevas o modificadas."""
+    return _upsert_dimension(session, DimProduct, rows, "product_id", "product_key")
 
 
 # ── Fact loaders ────────────────────────────────────────────────────────────
 
-def load_fact_sales(session: Session, rows: list[dict]):
-    """Carga fact_sales (insert only, no upsert)."""
+def truncate_fact_tables(session: Session, tables: dict | None = None):
+    """Vacía fact_sales y fact_orders una sola vez antes de una carga por batches."""
+    t = _resolve_tables(tables)
+    try:
+        session.execute(text(
+            f"TRUNCATE {t['fact_sales']}, {t['fact_orders']} RESTART IDENTITY CASCADE"
+        ))
+        logger.info("%s y %s truncadas", t["fact_sales"], t["fact_orders"])
+    except Exception as e:
+        raise LoadError(f"Error truncando tablas de hechos: {e}") from e
+
+
+def load_fact_sales(session: Session, rows: list[dict], truncate: bool = True,
+                    tables: dict | None = None):
+    """
+    Carga fact_sales (insert only, no upsert).
+    Con truncate=False agrega el batch (carga en streaming tras truncate_fact_tables).
+    """
+    rows = _as_records(rows, FactSales)
     if not rows:
         return
+    target = _insert_target(FactSales, tables)
     try:
-        # Truncar y recargar (full refresh)
-        session.execute(text("TRUNCATE dw.fact_sales RESTART IDENTITY CASCADE"))
-        session.execute(FactSales.__table__.insert(), rows)
-        logger.info("Cargados %d registros en fact_sales", len(rows))
+        if truncate:
+            # Truncar y recargar (full refresh)
+            session.execute(text(f"TRUNCATE {target.fullname} RESTART IDENTITY CASCADE"))
+        session.execute(target.insert(), rows)
+        logger.info("Cargados %d registros en %s", len(rows), target.fullname)
     except Exception as e:
         raise LoadError(f"Error cargando fact_sales: {e}") from e
 
 
-def load_fact_orders(session: Session, rows: list[dict]):
-    """Carga fact_orders (insert only, full refresh)."""
+def load_fact_orders(session: Session, rows: list[dict], truncate: bool = True,
+                     tables: dict | None = None):
+    """Carga fact_orders (insert only, full refresh; truncate=False agrega el batch)."""
+    rows = _as_records(rows, FactOrders)
     if not rows:
         return
+    target = _insert_target(FactOrders, tables)
     try:
-        session.execute(text("TRUNCATE dw.fact_orders RESTART IDENTITY CASCADE"))
-        session.execute(FactOrders.__table__.insert(), rows)
-        logger.info("Cargados %d registros en fact_orders", len(rows))
+        if truncate:
+            session.execute(text(f"TRUNCATE {target.fullname} RESTART IDENTITY CASCADE"))
+        session.execute(target.insert(), rows)
+        logger.info("Cargados %d registros en %s", len(rows), target.fullname)
     except Exception as e:
         raise LoadError(f"Error cargando fact_orders: {e}") from e
 
 
+def _delete_moved_orders(session: Session, model, rows: list[dict]):
+    """
+    Borra las versiones previas de órdenes cuya date_key cambió: la clave única
+    incluye date_key (partición), así que el upsert no las reemplazaría.
+    """
+    if isinstance(rows, pd.DataFrame):
+        last = rows.drop_duplicates("sales_order_id", keep="last")
+        orders = dict(zip(last["sales_order_id"].tolist(), last["date_key"].tolist()))
+    else:
+        orders = {row["sales_order_id"]: row["date_key"] for row in rows}
+    try:
+        session.execute(text(f"""
+            DELETE FROM {model.__table__.fullname} f
+            USING unnest(CAST(:order_ids AS int[]), CAST(:date_keys AS int[]))
+                  AS n(sales_order_id, date_key)
+            WHERE f.sales_order_id = n.sales_order_id AND f.date_key <> n.date_key
+        """), {"order_ids": list(orders), "date_keys": list(orders.values())})
+    except Exception as e:
+        raise LoadError(f"Error depurando órdenes movidas en {model.__tablename__}: {e}") from e
+
+
+def upsert_fact_sales(session: Session, rows: list[dict]):
+    """Carga incremental de fact_sales: upsert por (sales_order_id, sales_order_detail_id, date_key)."""
+    if len(rows) == 0:
+        return
+    _delete_moved_orders(session, FactSales, rows)
+    _bulk_upsert(session, FactSales, rows,
+                 conflict_cols=["sales_order_id", "sales_order_detail_id", "date_key"])
+    logger.info("Upserted %d registros en fact_sales", len(rows))
+
+
+def upsert_fact_orders(session: Session, rows: list[dict]):
+    """Carga incremental de fact_orders: upsert por (sales_order_id, date_key)."""
+    if len(rows) == 0:
+        return
+    _delete_moved_orders(session, FactOrders, rows)
+    _bulk_upsert(session, FactOrders, rows, conflict_cols=["sales_order_id", "date_key"])
+    logger.info("Upserted %d registros en fact_orders", len(rows))
+
+
+# ── Watermarks (carga incremental) ──────────────────────────────────────────
+
+def get_watermarks(session: Session) -> dict:
+    """Retorna {source_name: last_value} desde dw.etl_watermark."""
+    result = session.execute(text("SELECT source_name, last_value FROM dw.etl_watermark"))
+    return {row.source_name: row.last_value for row in result}
+
+
+def save_watermarks(session: Session, marks: dict):
+    """Guarda el high-water mark procesado por cada fuente."""
+    rows = [{"source_name": name, "last_value": value} for name, value in marks.items()]
+    _bulk_upsert(session, EtlWatermark, rows, conflict_cols=["source_name"])
+    logger.info("Watermarks actualizados: %s", marks)
+
+
 # ── Aggregation loaders ─────────────────────────────────────────────────────
 
-def load_agg_market_basket(session: Session):
+def load_agg_market_basket(session: Session, tables: dict | None = None):
     """Calcula y carga la tabla de análisis de canasta desde fact_sales."""
     logger.info("Calculando análisis de canasta...")
+    t = _resolve_tables(tables)
     try:
-        session.execute(text("TRUNCATE dw.agg_market_basket RESTART IDENTITY"))
+        session.execute(text(f"TRUNCATE {t['agg_market_basket']} RESTART IDENTITY"))
         sql = """
-        INSERT INTO dw.agg_market_basket (product_key_a, product_key_b, co_occurrences, support)
+        INSERT INTO {agg_market_basket} (product_key_a, product_key_b, co_occurrences, support)
         WITH total_orders AS (
-            SELECT COUNT(DISTINCT sales_order_id) AS n FROM dw.fact_sales
+            SELECT COUNT(DISTINCT sales_order_id) AS n FROM {fact_sales}
         ),
         pairs AS (
             SELECT
                 LEAST(a.product_key, b.product_key)    AS product_key_a,
                 GREATEST(a.product_key, b.product_key) AS product_key_b,
                 COUNT(DISTINCT a.sales_order_id)        AS co_occurrences
-            FROM dw.fact_sales a
-            JOIN dw.fact_sales b
+            FROM {fact_sales} a
+            JOIN {fact_sales} b
                 ON a.sales_order_id = b.sales_order_id
                AND a.product_key   <> b.product_key
             GROUP BY 1, 2
@@ -136,19 +418,63 @@ def load_agg_market_basket(session: Session):
                 support        = EXCLUDED.support,
                 etl_loaded_at  = NOW()
         """
-        session.execute(text(sql))
+        session.execute(text(sql.format(**t)))
         logger.info("Análisis de canasta cargado.")
     except Exception as e:
         raise LoadError(f"Error calculando market basket: {e}") from e
 
 
-def load_agg_product_margin(session: Session):
-    """Calcula y carga márgenes por producto y periodo."""
-    logger.info("Calculando márgenes por producto...")
+def load_agg_market_basket_sparse(session: Session, tables: dict | None = None):
+    """
+    Market basket sin self-join: lee (orden, producto) de fact_sales en streaming,
+    ordenado por orden, y acumula Aᵀ·A por batch sobre la matriz de incidencia
+    dispersa (transform.market_basket); las líneas no se retienen en memoria.
+    Las columnas de la matriz son las product_key de dim_product. El resultado
+    se carga con COPY.
+    """
+    logger.info("Calculando análisis de canasta (matriz dispersa)...")
+    t = _resolve_tables(tables)
     try:
-        session.execute(text("TRUNCATE dw.agg_product_margin"))
-        sql = """
-        INSERT INTO dw.agg_product_margin
+        max_key = session.execute(
+            text(f"SELECT COALESCE(MAX(product_key), 0) FROM {t['dim_product']}")
+        ).scalar()
+        accumulator = BasketAccumulator(int(max_key) + 1)
+        result = session.execute(
+            text(f"SELECT sales_order_id, product_key FROM {t['fact_sales']} "
+                 f"ORDER BY sales_order_id"),
+            execution_options={"stream_results": True, "yield_per": BASKET_FETCH_SIZE},
+        )
+        lines = 0
+        for rows in result.partitions(BASKET_FETCH_SIZE):
+            batch = np.array(rows, dtype=np.int64).reshape(-1, 2)
+            accumulator.add(batch[:, 0], batch[:, 1])
+            lines += len(batch)
+        pairs = accumulator.frame()
+
+        session.execute(text(f"TRUNCATE {t['agg_market_basket']} RESTART IDENTITY"))
+        copy_rows(session, t["agg_market_basket"], list(pairs.columns), pairs)
+        logger.info("Análisis de canasta cargado: %d pares de %d líneas", len(pairs), lines)
+    except Exception as e:
+        raise LoadError(f"Error calculando market basket: {e}") from e
+
+
+# Motores de market basket seleccionables con etl.market_basket_engine
+MARKET_BASKET_ENGINES = {
+    "sql":    load_agg_market_basket,
+    "sparse": load_agg_market_basket_sparse,
+}
+
+
+# Celdas (product_key, YYYYMM) a recalcular; cada una cubre los date_key
+# [YYYYMM00, (YYYYMM + 1) * 100) de fact_sales
+_MARGIN_CELLS = """
+        JOIN unnest(CAST(:product_keys AS int[]), CAST(:periods AS int[])) AS c(product_key, period)
+          ON fs.product_key = c.product_key
+         AND fs.date_key >= c.period * 100 AND fs.date_key < (c.period + 1) * 100
+"""
+
+_PRODUCT_MARGIN_SQL = """
+        INSERT INTO {agg_product_margin}
             (product_key, year, month, total_qty, total_revenue, total_cost, total_margin, margin_pct)
         SELECT
             fs.product_key,
@@ -161,8 +487,9 @@ def load_agg_product_margin(session: Session):
             CASE WHEN SUM(fs.line_total) > 0
                  THEN ROUND(SUM(fs.gross_margin) / SUM(fs.line_total) * 100, 4)
                  ELSE 0 END                  AS margin_pct
-        FROM dw.fact_sales fs
-        JOIN dw.dim_date dd ON dd.date_key = fs.date_key
+        FROM {fact_sales} fs
+        {cells}
+        JOIN {dim_date} dd ON dd.date_key = fs.date_key
         GROUP BY fs.product_key, dd.year, dd.month
         ON CONFLICT (product_key, year, month) DO UPDATE
             SET total_qty     = EXCLUDED.total_qty,
@@ -171,47 +498,125 @@ def load_agg_product_margin(session: Session):
                 total_margin  = EXCLUDED.total_margin,
                 margin_pct    = EXCLUDED.margin_pct,
                 etl_loaded_at = NOW()
-        """
-        session.execute(text(sql))
+"""
+
+
+def load_agg_product_margin(session: Session, tables: dict | None = None):
+    """Calcula y carga márgenes por producto y periodo."""
+    logger.info("Calculando márgenes por producto...")
+    t = _resolve_tables(tables)
+    try:
+        session.execute(text(f"TRUNCATE {t['agg_product_margin']}"))
+        session.execute(text(_PRODUCT_MARGIN_SQL.format(cells="", **t)))
         logger.info("Márgenes por producto cargados.")
     except Exception as e:
         raise LoadError(f"Error calculando márgenes: {e}") from e
 
 
-def load_agg_cohort_retention(session: Session):
+def margin_cells(session: Session, order_ids: list[int] | None = None,
+                 date_key_range: tuple[int, int] | None = None) -> set[tuple[int, int]]:
+    """
+    Celdas (product_key, YYYYMM) que hoy tienen líneas en fact_sales para las
+    órdenes `order_ids` o el rango [desde, hasta) de date_key. Se consultan antes
+    de reemplazar esas líneas: sus celdas cambian aunque las filas nuevas caigan
+    en otras.
+    """
+    if order_ids is not None:
+        where, params = "sales_order_id = ANY(CAST(:order_ids AS int[]))", {"order_ids": order_ids}
+    else:
+        where, params = "date_key >= :lo AND date_key < :hi", dict(zip(("lo", "hi"), date_key_range))
+    result = session.execute(text(
+        f"SELECT DISTINCT product_key, date_key / 100 AS period FROM dw.fact_sales WHERE {where}"
+    ), params)
+    return {(row.product_key, row.period) for row in result}
+
+
+def refresh_agg_product_margin(session: Session, cells: set[tuple[int, int]],
+                               tables: dict | None = None):
+    """
+    Recalcula solo las celdas (product_key, YYYYMM) de `cells` con el mismo
+    ON CONFLICT de la carga completa; las celdas que quedaron sin líneas se borran.
+    """
+    if not cells:
+        logger.info("Márgenes por producto: sin celdas modificadas")
+        return
+    t = _resolve_tables(tables)
+    product_keys, periods = (list(col) for col in zip(*sorted(cells)))
+    params = {"product_keys": product_keys, "periods": periods}
+    try:
+        session.execute(text(_PRODUCT_MARGIN_SQL.format(cells=_MARGIN_CELLS, **t)), params)
+        session.execute(text(f"""
+            DELETE FROM {t['agg_product_margin']} a
+            USING unnest(CAST(:product_keys AS int[]), CAST(:periods AS int[])) AS c(product_key, period)
+            WHERE a.product_key = c.product_key AND a.year * 100 + a.month = c.period
+              AND NOT EXISTS (
+                  SELECT 1 FROM {t['fact_sales']} fs
+                  WHERE fs.product_key = c.product_key
+                    AND fs.date_key >= c.period * 100 AND fs.date_key < (c.period + 1) * 100
+              )
+        """), params)
+        logger.info("Márgenes por producto: %d celdas recalculadas", len(cells))
+    except Exception as e:
+        raise LoadError(f"Error recalculando márgenes: {e}") from e
+
+
+def load_agg_cohort_retention(session: Session, tables: dict | None = None):
     """Calcula y carga análisis de cohortes."""
     logger.info("Calculando análisis de cohortes...")
+    t = _resolve_tables(tables)
     try:
-        session.execute(text("TRUNCATE dw.agg_cohort_retention"))
+        session.execute(text(f"TRUNCATE {t['agg_cohort_retention']}"))
         sql = """
-        INSERT INTO dw.agg_cohort_retention
+        INSERT INTO {agg_cohort_retention}
             (cohort_key, cohort_year, cohort_month, period_number, active_period_key,
              customer_count, initial_customers, retention_rate, total_revenue, total_margin,
              avg_revenue_per_customer)
-        WITH cohort_base AS (
+        WITH order_margin AS (
+            -- Margen y líneas por orden: fact_sales se agrega antes del join, así
+            -- cada cabecera aparece una sola vez. total_revenue conserva la cifra
+            -- publicada, que suma total_due una vez por línea de la orden (el join
+            -- original con fact_sales); una orden sin líneas cuenta una vez
+            SELECT sales_order_id, SUM(gross_margin) AS gross_margin, COUNT(*) AS line_count
+            FROM {fact_sales}
+            GROUP BY sales_order_id
+        ),
+        cohort_base AS (
             SELECT
                 dc.cohort_key,
                 dc.cohort_year,
                 dc.cohort_month,
                 COUNT(DISTINCT dc.customer_key) AS initial_customers
-            FROM dw.dim_customer dc
+            FROM {dim_customer} dc
             WHERE dc.cohort_key IS NOT NULL
             GROUP BY dc.cohort_key, dc.cohort_year, dc.cohort_month
         ),
-        cohort_activity AS (
+        customer_activity AS (
+            -- Una fila por cliente y periodo activo: el conteo posterior no necesita DISTINCT
             SELECT
                 dc.cohort_key,
                 fo.months_since_first                                AS period_number,
                 TO_CHAR(dd.full_date, 'YYYY-MM')                    AS active_period_key,
-                COUNT(DISTINCT fo.customer_key)                      AS customer_count,
-                SUM(fo.total_due)                                    AS total_revenue,
-                SUM(fs.gross_margin)                                 AS total_margin
-            FROM dw.fact_orders fo
-            JOIN dw.dim_customer dc  ON dc.customer_key = fo.customer_key
-            JOIN dw.dim_date    dd   ON dd.date_key     = fo.date_key
-            LEFT JOIN dw.fact_sales fs ON fs.sales_order_id = fo.sales_order_id
+                fo.customer_key,
+                SUM(fo.total_due * COALESCE(om.line_count, 1))       AS revenue,
+                SUM(om.gross_margin)                                 AS margin
+            FROM {fact_orders} fo
+            JOIN {dim_customer} dc  ON dc.customer_key = fo.customer_key
+            JOIN {dim_date}    dd   ON dd.date_key     = fo.date_key
+            LEFT JOIN order_margin om ON om.sales_order_id = fo.sales_order_id
             WHERE dc.cohort_key IS NOT NULL AND fo.months_since_first IS NOT NULL
-            GROUP BY dc.cohort_key, fo.months_since_first, TO_CHAR(dd.full_date, 'YYYY-MM')
+            GROUP BY dc.cohort_key, fo.months_since_first, TO_CHAR(dd.full_date, 'YYYY-MM'),
+                     fo.customer_key
+        ),
+        cohort_activity AS (
+            SELECT
+                cohort_key,
+                period_number,
+                active_period_key,
+                COUNT(*)         AS customer_count,
+                SUM(revenue)     AS total_revenue,
+                SUM(margin)      AS total_margin
+            FROM customer_activity
+            GROUP BY cohort_key, period_number, active_period_key
         )
         SELECT
             ca.cohort_key,
@@ -236,19 +641,20 @@ def load_agg_cohort_retention(session: Session):
                 avg_revenue_per_customer = EXCLUDED.avg_revenue_per_customer,
                 etl_loaded_at            = NOW()
         """
-        session.execute(text(sql))
+        session.execute(text(sql.format(**t)))
         logger.info("Análisis de cohortes cargado.")
     except Exception as e:
         raise LoadError(f"Error calculando cohortes: {e}") from e
 
 
-def load_agg_customer_recurrence(session: Session):
+def load_agg_customer_recurrence(session: Session, tables: dict | None = None):
     """Calcula y carga resumen de clientes recurrentes vs no-recurrentes."""
     logger.info("Calculando recurrencia de clientes...")
+    t = _resolve_tables(tables)
     try:
-        session.execute(text("TRUNCATE dw.agg_customer_recurrence"))
+        session.execute(text(f"TRUNCATE {t['agg_customer_recurrence']}"))
         sql = """
-        INSERT INTO dw.agg_customer_recurrence
+        INSERT INTO {agg_customer_recurrence}
             (year, quarter, customer_type, customer_count, order_count, total_revenue, revenue_pct)
         WITH customer_order_counts AS (
             SELECT
@@ -257,8 +663,8 @@ def load_agg_customer_recurrence(session: Session):
                 dd.quarter,
                 COUNT(DISTINCT fo.sales_order_id)  AS order_count,
                 SUM(fo.total_due)                  AS total_revenue
-            FROM dw.fact_orders fo
-            JOIN dw.dim_date dd ON dd.date_key = fo.date_key
+            FROM {fact_orders} fo
+            JOIN {dim_date} dd ON dd.date_key = fo.date_key
             GROUP BY fo.customer_key, dd.year, dd.quarter
         ),
         classified AS (
@@ -293,7 +699,7 @@ def load_agg_customer_recurrence(session: Session):
                 revenue_pct    = EXCLUDED.revenue_pct,
                 etl_loaded_at  = NOW()
         """
-        session.execute(text(sql))
+        session.execute(text(sql.format(**t)))
         logger.info("Recurrencia de clientes cargada.")
     except Exception as e:
         raise LoadError(f"Error calculando recurrencia: {e}") from e
@@ -0,0 +1,185 @@
+"""
+Carga masiva al DW con COPY ... FROM STDIN (formato text de PostgreSQL).
+Los batches (list[dict] o DataFrame) se serializan de forma perezosa en un
+stream que psycopg2 `copy_expert` consume por bloques, sin armar el buffer
+completo en memoria. Los DataFrames se codifican por columna (vectorizado) y
+los importes escalados (int64 × 10^4, ver transform.FACT_SALES_AMOUNTS) se
+formatean directamente como NUMERIC, sin pasar por Decimal.
+"""
+import io
+import logging
+import math
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.orm import Session
+
+from sqlalchemy import Numeric
+
+from src.models.entities import FactSales, FactOrders
+from src.transform import SCALE
+from src.utils.exceptions import LoadError
+
+logger = logging.getLogger(__name__)
+
+NULL = "\\N"
+_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def encode_value(value) -> str:
+    """Codifica un valor Python/NumPy al formato text de COPY."""
+    if value is None or value is pd.NaT or value is pd.NA:
+        return NULL
+    if isinstance(value, (bool, np.bool_)):
+        return "t" if value else "f"
+    if isinstance(value, Decimal):
+        return NULL if value.is_nan() else format(value, "f")
+    if isinstance(value, (float, np.floating)):
+        return NULL if math.isnan(value) else repr(float(value))
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value).translate(_ESCAPES)
+
+
+def _iter_tuples(rows, columns: list[str]) -> Iterator[tuple]:
+    if isinstance(rows, pd.DataFrame):
+        return rows[columns].itertuples(index=False, name=None)
+    return (tuple(row.get(col) for col in columns) for row in rows)
+
+
+# Filas por bloque al codificar un DataFrame
+COPY_BLOCK_ROWS = 10_000
+
+
+def scaled_columns(model, frame: pd.DataFrame) -> list[str]:
+    """
+    Columnas de `frame` con importes escalados: columnas Numeric(_, 4) del
+    modelo que en el batch columnar vienen como enteros (× SCALE).
+    """
+    return [
+        col.name for col in model.__table__.columns
+        if isinstance(col.type, Numeric) and col.type.scale == 4
+        and col.name in frame and frame[col.name].dtype.kind in "iu"
+    ]
+
+
+def format_scaled(values: np.ndarray) -> np.ndarray:
+    """Enteros × 10^4 → texto NUMERIC con 4 decimales ("-12.0500"), vectorizado."""
+    values = np.asarray(values, dtype=np.int64)
+    whole, frac = np.divmod(np.abs(values), SCALE)
+    sign = np.where(values < 0, "-", "")
+    return (pd.Series(sign) + pd.Series(whole).astype(str) + "."
+            + pd.Series(frac).astype(str).str.zfill(4)).to_numpy(dtype=object)
+
+
+def _encode_column(values: pd.Series, scaled: bool = False) -> np.ndarray:
+    """Codifica una columna completa al formato text de COPY."""
+    kind = values.dtype.kind
+    if scaled:
+        return format_scaled(values.to_numpy())
+    if kind == "b":
+        return np.where(values.to_numpy(), "t", "f").astype(object)
+    if kind in "iu":
+        return values.astype(str).to_numpy(dtype=object)
+    encoded = values.map(encode_value).to_numpy(dtype=object)
+    if kind == "f":
+        # Enteros guardados como float por tener NaN (p. ej. territory_id): sin ".0"
+        floats = values.to_numpy()
+        integral = np.isfinite(floats) & (np.mod(floats, 1) == 0) & (np.abs(floats) < 2 ** 53)
+        encoded[integral] = floats[integral].astype(np.int64).astype(str)
+    return encoded
+
+
+def _frame_lines(frame: pd.DataFrame, columns: list[str], scaled=()) -> Iterator[str]:
+    """Bloques de líneas COPY de un DataFrame, codificado por columnas."""
+    for start in range(0, len(frame), COPY_BLOCK_ROWS):
+        block = frame.iloc[start:start + COPY_BLOCK_ROWS]
+        lines = None
+        for col in columns:
+            encoded = _encode_column(block[col], col in scaled)
+            lines = encoded if lines is None else lines + "\t" + encoded
+        yield "\n".join(lines) + "\n"
+
+
+class _CopyStream(io.RawIOBase):
+    """Archivo de solo lectura que genera las líneas COPY a medida que se leen."""
+
+    def __init__(self, lines: Iterable[str]):
+        self._lines = iter(lines)
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line.encode("utf-8")
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+def copy_rows(session: Session, table: str, columns: list[str], rows, scaled=()) -> int:
+    """
+    Envía `rows` a `table` con COPY FROM STDIN dentro de la transacción de `session`.
+    `scaled` son las columnas de un DataFrame con importes int64 × 10^4.
+    Retorna la cantidad de filas enviadas.
+    """
+    count = 0
+
+    def lines():
+        nonlocal count
+        if isinstance(rows, pd.DataFrame):
+            count = len(rows)
+            yield from _frame_lines(rows, columns, scaled)
+            return
+        for values in _iter_tuples(rows, columns):
+            count += 1
+            yield "\t".join(encode_value(v) for v in values) + "\n"
+
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    dbapi_conn = session.connection().connection.dbapi_connection
+    with dbapi_conn.cursor() as cursor:
+        cursor.copy_expert(sql, _CopyStream(lines()))
+    logger.debug("COPY %d filas a %s", count, table)
+    return count
+
+
+def _copy_fact(session: Session, model, rows, tables: dict | None = None) -> int:
+    """
+    COPY de un batch de hechos; las columnas salen del batch (keys/columnas).
+    `tables` redirige la tabla del modelo a otra física (p. ej. su shadow).
+    """
+    if isinstance(rows, pd.DataFrame):
+        columns = list(rows.columns)
+    else:
+        columns = list(rows[0].keys()) if rows else []
+    if not columns or len(rows) == 0:
+        return 0
+    table = (tables or {}).get(model.__tablename__, model.__table__.fullname)
+    try:
+        scaled = scaled_columns(model, rows) if isinstance(rows, pd.DataFrame) else ()
+        count = copy_rows(session, table, columns, rows, scaled)
+        logger.info("COPY: cargados %d registros en %s", count, table)
+        return count
+    except Exception as e:
+        raise LoadError(f"Error en COPY a {model.__tablename__}: {e}") from e
+
+
+def copy_fact_sales(session: Session, rows, tables: dict | None = None) -> int:
+    """Agrega un batch a fact_sales con COPY (usar tras truncate_fact_tables)."""
+    return _copy_fact(session, FactSales, rows, tables)
+
+
+def copy_fact_orders(session: Session, rows, tables: dict | None = None) -> int:
+    """Agrega un batch a fact_orders con COPY (usar tras truncate_fact_tables)."""
+    return _copy_fact(session, FactOrders, rows, tables)
@@ -0,0 +1,183 @@
+"""
+Modo ELT para fact_sales: las líneas de orden extraídas se copian tal cual
+(COPY) a la tabla de staging `dw.stg_order_detail` y el resto se resuelve en
+el DW con SQL set-based:
+
+- claves surrogadas con joins contra dim_customer / dim_product / dim_territory,
+- las líneas sin alguna clave van a `dw.etl_quarantine_sales` en un solo
+  INSERT ... SELECT (con las claves que faltaron); antes se borran de la
+  cuarentena las órdenes en staging, así una orden reprocesada no se duplica
+  y la que ya resuelve sus claves sale de la cuarentena,
+- las medidas (line_total, cost_total, gross_margin, gross_margin_pct) se
+  calculan en el INSERT hacia fact_sales.
+
+Los importes se guardan en NUMERIC(19,4) igual que en el transform Python;
+gross_margin_pct usa ROUND de PostgreSQL (mitades lejos del cero), así que solo
+difiere del transform en empates exactos en el quinto decimal.
+"""
+import logging
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from src.load.copy_loader import copy_rows
+from src.utils.exceptions import LoadError
+
+logger = logging.getLogger(__name__)
+
+STAGING_TABLE = "dw.stg_order_detail"
+QUARANTINE_TABLE = "dw.etl_quarantine_sales"
+# Columnas del extract de líneas de orden que se copian a staging
+STAGING_COLUMNS = [
+    "sales_order_id", "sales_order_detail_id", "order_date",
+    "customer_id", "territory_id", "product_id", "is_online",
+    "order_qty", "unit_price", "unit_price_discount", "standard_cost",
+]
+
+_DATE_KEY = "CAST(TO_CHAR(s.order_date, 'YYYYMMDD') AS INT)"
+
+# Medidas de fact_sales sobre la fila de staging `s` (las de transform_fact_sales_batch)
+_LINE_TOTAL = "s.order_qty * s.unit_price * (1 - s.unit_price_discount)"
+_COST_TOTAL = "s.order_qty * s.standard_cost"
+MEASURES = {
+    "line_total":       _LINE_TOTAL,
+    "cost_total":       _COST_TOTAL,
+    "gross_margin":     f"{_LINE_TOTAL} - {_COST_TOTAL}",
+    "gross_margin_pct": f"CASE WHEN {_LINE_TOTAL} > 0 "
+                        f"THEN ROUND(({_LINE_TOTAL} - {_COST_TOTAL}) * 100 / ({_LINE_TOTAL}), 4) "
+                        f"ELSE 0 END",
+}
+
+_RESOLVED_LINES = """
+    SELECT
+        {date_key} AS date_key,
+        dc.customer_key,
+        dp.product_key,
+        dt.territory_key,
+        s.sales_order_id,
+        s.sales_order_detail_id,
+        s.order_qty,
+        s.unit_price,
+        s.unit_price_discount,
+        s.standard_cost,
+        """ + ",\n        ".join(f"{expr} AS {name}" for name, expr in MEASURES.items()) + """,
+        COALESCE(s.is_online, FALSE) AS is_online
+    FROM {staging} s
+    JOIN {dim_customer}  dc ON dc.customer_id  = s.customer_id
+    JOIN {dim_product}   dp ON dp.product_id   = s.product_id
+    JOIN {dim_territory} dt ON dt.territory_id = s.territory_id
+"""
+
+FACT_COLUMNS = [
+    "date_key", "customer_key", "product_key", "territory_key",
+    "sales_order_id", "sales_order_detail_id", "order_qty", "unit_price",
+    "unit_price_discount", "standard_cost", "line_total", "cost_total",
+    "gross_margin", "gross_margin_pct", "is_online",
+]
+
+
+def truncate_staging(session: Session):
+    """Vacía la tabla de staging antes de copiar los extracts de la corrida."""
+    try:
+        session.execute(text(f"TRUNCATE {STAGING_TABLE}"))
+    except Exception as e:
+        raise LoadError(f"Error truncando {STAGING_TABLE}: {e}") from e
+
+
+def stage_order_details(session: Session, frame: pd.DataFrame) -> int:
+    """COPY de un batch de líneas de orden extraídas (sin transformar) a staging."""
+    if not len(frame):
+        return 0
+    try:
+        return copy_rows(session, STAGING_TABLE, STAGING_COLUMNS, frame)
+    except Exception as e:
+        raise LoadError(f"Error copiando líneas de orden a {STAGING_TABLE}: {e}") from e
+
+
+def staged_margin_cells(session: Session, tables: dict) -> set:
+    """
+    Celdas (product_key, YYYYMM) de agg_product_margin afectadas por las órdenes
+    en staging: las de sus versiones ya cargadas y las de las nuevas.
+    Debe llamarse antes de escribir los hechos.
+    """
+    result = session.execute(text(f"""
+        SELECT f.product_key, f.date_key / 100 AS period
+        FROM {tables['fact_sales']} f
+        WHERE f.sales_order_id IN (SELECT sales_order_id FROM {STAGING_TABLE})
+        UNION
+        SELECT dp.product_key, CAST(TO_CHAR(s.order_date, 'YYYYMM') AS INT)
+        FROM {STAGING_TABLE} s
+        JOIN {tables['dim_product']} dp ON dp.product_id = s.product_id
+    """))
+    return {(row.product_key, row.period) for row in result}
+
+
+def quarantine_orphan_lines(session: Session, tables: dict) -> int:
+    """
+    Mueve a cuarentena las líneas en staging sin cliente, producto o territorio
+    en el DW, reemplazando lo que la cuarentena tenía de esas órdenes.
+    """
+    session.execute(text(f"""
+        DELETE FROM {QUARANTINE_TABLE}
+        WHERE sales_order_id IN (SELECT sales_order_id FROM {STAGING_TABLE})
+    """))
+    result = session.execute(text(f"""
+        INSERT INTO {QUARANTINE_TABLE}
+            (sales_order_id, sales_order_detail_id, order_date,
+             customer_id, product_id, territory_id, missing_keys)
+        SELECT s.sales_order_id, s.sales_order_detail_id, s.order_date,
+               s.customer_id, s.product_id, s.territory_id,
+               CONCAT_WS(',',
+                   CASE WHEN dc.customer_key  IS NULL THEN 'customer'  END,
+                   CASE WHEN dp.product_key   IS NULL THEN 'product'   END,
+                   CASE WHEN dt.territory_key IS NULL THEN 'territory' END)
+        FROM {STAGING_TABLE} s
+        LEFT JOIN {tables['dim_customer']}  dc ON dc.customer_id  = s.customer_id
+        LEFT JOIN {tables['dim_product']}   dp ON dp.product_id   = s.product_id
+        LEFT JOIN {tables['dim_territory']} dt ON dt.territory_id = s.territory_id
+        WHERE dc.customer_key IS NULL OR dp.product_key IS NULL OR dt.territory_key IS NULL
+    """))
+    return result.rowcount
+
+
+def load_fact_sales_elt(session: Session, tables: dict, incremental: bool = False) -> tuple[int, int]:
+    """
+    Carga fact_sales desde staging con SQL set-based. En modo incremental se
+    borran las versiones de órdenes cuya fecha cambió y se hace upsert por la
+    clave natural; si no, se inserta (tras truncate_fact_tables).
+    `tables` es el mapeo completo de tablas físicas (ver load.DW_TABLES).
+    Retorna (líneas cargadas, líneas en cuarentena).
+    """
+    fact_sales = tables["fact_sales"]
+    columns = ", ".join(FACT_COLUMNS)
+    select = _RESOLVED_LINES.format(date_key=_DATE_KEY, staging=STAGING_TABLE, **tables)
+    try:
+        quarantined = quarantine_orphan_lines(session, tables)
+        if quarantined:
+            logger.warning("%d líneas de orden sin clave surrogada enviadas a %s",
+                           quarantined, QUARANTINE_TABLE)
+        if incremental:
+            session.execute(text(f"""
+                DELETE FROM {fact_sales} f
+                USING (SELECT DISTINCT s.sales_order_id, {_DATE_KEY} AS date_key
+                       FROM {STAGING_TABLE} s) n
+                WHERE f.sales_order_id = n.sales_order_id AND f.date_key <> n.date_key
+            """))
+            updates = ",\n                    ".join(
+                f"{col} = EXCLUDED.{col}" for col in FACT_COLUMNS
+                if col not in ("sales_order_id", "sales_order_detail_id", "date_key")
+            )
+            sql = f"""
+                INSERT INTO {fact_sales} ({columns})
+                {select}
+                ON CONFLICT (sales_order_id, sales_order_detail_id, date_key) DO UPDATE SET
+                    {updates}
+            """
+        else:
+            sql = f"INSERT INTO {fact_sales} ({columns})\n{select}"
+        loaded = session.execute(text(sql)).rowcount
+        logger.info("fact_sales (ELT): %d líneas cargadas en %s", loaded, fact_sales)
+        return loaded, quarantined
+    except Exception as e:
+        raise LoadError(f"Error cargando fact_sales desde staging: {e}") from e
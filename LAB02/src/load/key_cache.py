@@ -0,0 +1,135 @@
+"""
+Caché persistente de claves surrogadas ({id natural: clave surrogada}).
+
+Los loaders de dimensiones capturan con RETURNING las claves de las filas
+insertadas o modificadas; el resto se toma de un archivo .npz por dimensión
+(`etl.key_cache_dir`) guardado al final de la corrida anterior, así los
+pipelines no vuelven a leer la dimensión completa para resolver los hechos.
+
+El archivo guarda también la identidad de la tabla: system_identifier del
+cluster, base de datos, oid y filenode. Apuntar el ETL a otro DW (otro cluster,
+otra base o un restore), recrear la tabla o un TRUNCATE la cambian y el caché se
+descarta (se relee la dimensión una vez). Las claves
+son serial y el ETL nunca las reasigna, así que lo que falte en el caché (p. ej.
+filas de una corrida que falló antes de guardarlo) se recupera leyendo solo
+las claves mayores a la última conocida.
+"""
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from config.settings import BASE_DIR, get_etl_setting
+from src.utils.exceptions import LoadError
+
+logger = logging.getLogger(__name__)
+
+# Dimensiones con caché: (id natural, clave surrogada)
+KEY_COLUMNS = {
+    "dim_customer":  ("customer_id", "customer_key"),
+    "dim_product":   ("product_id", "product_key"),
+    "dim_territory": ("territory_id", "territory_key"),
+}
+
+QUERY_TABLE_IDENTITY = """
+    SELECT current_database(),
+           CAST(CAST(:table AS regclass) AS oid),
+           pg_relation_filenode(CAST(:table AS regclass))
+"""
+
+
+class SurrogateKeyCache:
+    """Mapa id natural → clave surrogada de una dimensión, persistido entre corridas."""
+
+    def __init__(self, dimension: str, directory: str | Path | None = None):
+        self.dimension = dimension
+        self.natural_key, self.surrogate_key = KEY_COLUMNS[dimension]
+        directory = Path(directory or get_etl_setting("key_cache_dir", "cache/keys"))
+        self.path = (directory if directory.is_absolute() else BASE_DIR / directory) / f"{dimension}.npz"
+        self.keys: dict[int, int] = {}
+        # (system_identifier, base, oid, filenode) como texto; None = desconocida
+        self.identity: tuple | None = None
+
+    def _read(self) -> bool:
+        """Carga el archivo del caché; False si no existe o no se puede leer."""
+        if not self.path.exists():
+            return False
+        try:
+            with np.load(self.path) as data:
+                self.keys = dict(zip(data["ids"].tolist(), data["keys"].tolist()))
+                # Archivos sin identidad (versiones anteriores) nunca coinciden
+                self.identity = tuple(data["identity"].tolist()) if "identity" in data.files else None
+            return True
+        except Exception as e:
+            logger.warning("Caché de claves %s ilegible, se reconstruye: %s", self.path, e)
+            return False
+
+    def _identity(self, session: Session) -> tuple:
+        """
+        Identidad actual de la tabla. pg_control_system() requiere superusuario o
+        pg_monitor: sin permiso se compara solo base, oid y filenode (el error se
+        aísla en un savepoint para no abortar la transacción).
+        """
+        try:
+            with session.begin_nested():
+                system_id = session.execute(
+                    text("SELECT system_identifier FROM pg_control_system()")
+                ).scalar()
+        except SQLAlchemyError as e:
+            logger.warning("Sin acceso a pg_control_system(): %s", e)
+            system_id = None
+        database, oid, filenode = session.execute(
+            text(QUERY_TABLE_IDENTITY), {"table": f"dw.{self.dimension}"}
+        ).one()
+        return tuple(str(v) for v in (system_id, database, oid, filenode))
+
+    def _query(self, session: Session, where: str = "", params: dict | None = None) -> dict:
+        result = session.execute(text(
+            f"SELECT {self.natural_key} AS id, {self.surrogate_key} AS key "
+            f"FROM dw.{self.dimension} {where}"
+        ), params or {})
+        return {row.id: row.key for row in result}
+
+    def resolve(self, session: Session, changed=()) -> dict:
+        """
+        {id natural: clave surrogada} de toda la dimensión: caché en disco + filas
+        `changed` ((id, clave) retornadas por el upsert) + claves posteriores a la
+        última conocida. Solo si el caché no es válido se lee la dimensión completa.
+        """
+        try:
+            identity = self._identity(session)
+            if not self._read() or self.identity != identity:
+                logger.info("Caché de claves de %s no disponible: se lee la dimensión",
+                            self.dimension)
+                self.keys = self._query(session)
+            else:
+                # La última clave se toma del archivo, antes de sumar `changed`: así
+                # también se recuperan claves de una corrida que no alcanzó a guardarlo
+                last = max(self.keys.values(), default=0)
+                self.keys.update((int(i), int(k)) for i, k in changed)
+                missing = self._query(session, f"WHERE {self.surrogate_key} > :last",
+                                      {"last": last})
+                self.keys.update(missing)
+                logger.info("Claves de %s: %d en caché, %d modificadas, %d recuperadas",
+                            self.dimension, len(self.keys), len(changed), len(missing))
+            self.identity = identity
+            return self.keys
+        except Exception as e:
+            raise LoadError(f"Error resolviendo claves de {self.dimension}: {e}") from e
+
+    def save(self):
+        """
+        Escribe el caché (reemplazo atómico). Debe llamarse después del commit
+        del upsert: el caché nunca debe tener claves que el DW no confirmó.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.stem}.tmp.npz")
+        np.savez(tmp,
+                 ids=np.fromiter(self.keys.keys(), dtype=np.int64, count=len(self.keys)),
+                 keys=np.fromiter(self.keys.values(), dtype=np.int64, count=len(self.keys)),
+                 identity=np.array(self.identity or (), dtype=str))
+        os.replace(tmp, self.path)
@@ -0,0 +1,175 @@
+"""
+Etapa de carga masiva consciente de índices.
+
+En una carga completa los índices secundarios de los hechos se eliminan antes
+de insertar y se recrean al final (en paralelo, una sesión OLAP por índice):
+construir un índice de una vez es mucho más barato que mantenerlo fila a fila.
+Los índices que respaldan constraints (PK, UNIQUE) se conservan porque los usan
+ON CONFLICT y las FK.
+
+Las definiciones eliminadas se registran en `dw.etl_pending_index` dentro de la
+misma transacción que el DROP y cada rebuild borra su fila al crear el índice:
+si el proceso muere o un CREATE INDEX falla después del commit de la carga, la
+corrida siguiente recrea los índices pendientes al iniciar (recover_pending).
+
+Luego se ejecuta ANALYZE sobre las tablas tocadas para que
+las agregaciones se planifiquen con estadísticas frescas y, opcionalmente, se
+precargan las agg_* del dashboard con pg_prewarm.
+"""
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from src.utils.db import olap_session, get_olap_engine
+from src.utils.exceptions import LoadError
+
+logger = logging.getLogger(__name__)
+
+PENDING_INDEX_TABLE = "dw.etl_pending_index"
+
+QUERY_SECONDARY_INDEXES = """
+    SELECT CAST(CAST(i.indexrelid AS regclass) AS text) AS index_name,
+           CAST(CAST(i.indrelid AS regclass) AS text)   AS table_name,
+           pg_get_indexdef(i.indexrelid)                AS definition
+    FROM pg_index i
+    WHERE i.indrelid = CAST(:table AS regclass)
+      AND NOT EXISTS (
+          SELECT 1 FROM pg_constraint k
+          WHERE k.conrelid = i.indrelid AND k.conindid = i.indexrelid
+      )
+"""
+
+
+def _rebuild_definition(definition: str) -> str:
+    """
+    CREATE INDEX idempotente a partir de pg_get_indexdef. En tablas particionadas
+    pg_get_indexdef usa "ON ONLY": el rebuild debe crear el índice también en
+    todas las particiones.
+    """
+    definition = definition.replace(" ON ONLY ", " ON ", 1)
+    return re.sub(r"^CREATE (UNIQUE )?INDEX ", r"CREATE \1INDEX IF NOT EXISTS ", definition)
+
+
+class LoadPhaseManager:
+    """
+    Coordina la etapa de carga: drop/rebuild de índices secundarios,
+    ANALYZE y prewarm. Las definiciones eliminadas quedan en `dropped`
+    ([(índice, CREATE INDEX)]) y en dw.etl_pending_index hasta el rebuild.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.workers = max(1, workers)
+        self.dropped: list[tuple[str, str]] = []
+
+    def drop_secondary_indexes(self, session: Session, tables: list[str]):
+        """
+        Elimina los índices secundarios de `tables` dentro de la transacción de
+        carga y registra sus definiciones en la misma transacción.
+        """
+        try:
+            for table in tables:
+                result = session.execute(text(QUERY_SECONDARY_INDEXES), {"table": table})
+                for row in result.fetchall():
+                    definition = _rebuild_definition(row.definition)
+                    session.execute(text(f"""
+                        INSERT INTO {PENDING_INDEX_TABLE} (index_name, table_name, definition)
+                        VALUES (:name, :table, :definition)
+                        ON CONFLICT (index_name) DO UPDATE SET
+                            table_name = EXCLUDED.table_name,
+                            definition = EXCLUDED.definition,
+                            dropped_at = NOW()
+                    """), {"name": row.index_name, "table": row.table_name,
+                           "definition": definition})
+                    session.execute(text(f"DROP INDEX {row.index_name}"))
+                    self.dropped.append((row.index_name, definition))
+                    logger.info("Índice %s eliminado para la carga masiva", row.index_name)
+        except Exception as e:
+            raise LoadError(f"Error eliminando índices secundarios: {e}") from e
+
+    def recover_pending(self) -> int:
+        """
+        Recrea los índices que una corrida anterior eliminó y no alcanzó a
+        reconstruir. Las filas de tablas que ya no existen (p. ej. shadow
+        descartadas) solo se borran. Retorna la cantidad de índices recreados.
+        """
+        with olap_session() as session:
+            rows = session.execute(text(f"""
+                SELECT index_name, definition,
+                       to_regclass(table_name) IS NOT NULL AS table_exists
+                FROM {PENDING_INDEX_TABLE}
+                ORDER BY dropped_at
+            """)).fetchall()
+            stale = [row.index_name for row in rows if not row.table_exists]
+            if stale:
+                session.execute(text(f"DELETE FROM {PENDING_INDEX_TABLE} "
+                                     f"WHERE index_name = ANY(:names)"), {"names": stale})
+        pending = [(row.index_name, row.definition) for row in rows if row.table_exists]
+        if not pending:
+            return 0
+        logger.warning("%d índices pendientes de una carga anterior: se recrean", len(pending))
+        self.dropped.extend(pending)
+        self.rebuild_indexes()
+        return len(pending)
+
+    def rebuild_indexes(self):
+        """
+        Recrea los índices eliminados, en paralelo (limitado al pool OLAP).
+        Debe llamarse después del commit de la carga: cada índice se construye
+        en su propia sesión y solo ve datos confirmados.
+        """
+        if not self.dropped:
+            return
+        workers = min(self.workers, len(self.dropped), get_olap_engine().pool.size())
+        logger.info("Recreando %d índices con %d workers...", len(self.dropped), workers)
+        start = time.time()
+
+        def build(name: str, definition: str):
+            # El índice y el borrado de su fila pendiente se confirman juntos
+            with olap_session() as session:
+                session.execute(text(definition))
+                session.execute(text(f"DELETE FROM {PENDING_INDEX_TABLE} WHERE index_name = :name"),
+                                {"name": name})
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="index-build") as pool:
+            futures = [(d, pool.submit(build, n, d)) for n, d in self.dropped]
+            for definition, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("Error recreando índice: %s", definition)
+                    errors.append(e)
+        if errors:
+            # Las definiciones siguen en dw.etl_pending_index: la próxima corrida las recrea
+            self.dropped = []
+            raise LoadError(f"Error recreando índices: {errors[0]}") from errors[0]
+        logger.info("Índices recreados en %.1f s", time.time() - start)
+        self.dropped = []
+
+    @staticmethod
+    def analyze(tables: list[str]):
+        """Actualiza estadísticas del planner de las tablas tocadas por la carga."""
+        with olap_session() as session:
+            session.execute(text(f"ANALYZE {', '.join(tables)}"))
+        logger.info("ANALYZE: %s", ", ".join(tables))
+
+    @staticmethod
+    def prewarm(tables: list[str]) -> bool:
+        """Carga `tables` en shared_buffers si la extensión pg_prewarm está instalada."""
+        with olap_session() as session:
+            installed = session.execute(text(
+                "SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm'"
+            )).fetchone()
+            if not installed:
+                logger.info("pg_prewarm no está instalado: se omite el prewarm")
+                return False
+            for table in tables:
+                blocks = session.execute(
+                    text("SELECT pg_prewarm(CAST(:table AS regclass))"), {"table": table}
+                ).scalar()
+                logger.info("Prewarm %s: %s bloques", table, blocks)
+        return True
@@ -0,0 +1,168 @@
+"""
+Particiones por rango de date_key de las tablas de hechos.
+
+Un periodo es "YYYY-MM" (granularidad mensual) o "YYYY" (anual) y corresponde
+a la partición `dw.<tabla>_pYYYY_MM` / `dw.<tabla>_pYYYY`. Las particiones se
+crean para el rango de dim_date; una partición se puede reemplazar sola sin
+tocar el resto de la tabla: el periodo se carga en una tabla aparte (LIKE la
+partición) y luego una transacción corta hace DETACH + DROP + ATTACH. El lock
+ACCESS EXCLUSIVE sobre los hechos dura solo ese swap, no la extracción ni la carga.
+"""
+import logging
+import re
+from datetime import date
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from src.utils.exceptions import LoadError
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = "dw"
+PARTITIONED_TABLES = ("fact_sales", "fact_orders")
+GRANULARITIES = ("month", "year")
+
+_PERIOD = re.compile(r"^(\d{4})(?:-(\d{2}))?$")
+
+
+def period_bounds(period: str) -> tuple[int, int]:
+    """Rango [desde, hasta) de date_key de un periodo "YYYY-MM" o "YYYY"."""
+    match = _PERIOD.match(period)
+    if not match or (match.group(2) and not 1 <= int(match.group(2)) <= 12):
+        raise ValueError(f"Periodo inválido: {period} (se espera YYYY-MM o YYYY)")
+    year = int(match.group(1))
+    if match.group(2) is None:
+        return year * 10000 + 101, (year + 1) * 10000 + 101
+    month = int(match.group(2))
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return year * 10000 + month * 100 + 1, next_year * 10000 + next_month * 100 + 1
+
+
+def validate_period(period: str, granularity: str = "month"):
+    """Verifica que `period` corresponda a una partición de la granularidad configurada."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Granularidad de partición desconocida: {granularity}")
+    period_bounds(period)
+    if (granularity == "month") != ("-" in period):
+        expected = "YYYY-MM" if granularity == "month" else "YYYY"
+        raise ValueError(f"Periodo {period} no corresponde a particiones por {granularity} "
+                         f"(se espera {expected})")
+
+
+def period_dates(period: str) -> tuple[date, date]:
+    """Rango [desde, hasta) de fechas de un periodo (para filtrar el OLTP)."""
+    lo, hi = period_bounds(period)
+    as_date = lambda key: date(key // 10000, key // 100 % 100, key % 100)
+    return as_date(lo), as_date(hi)
+
+
+def periods_between(start: date, end: date, granularity: str = "month") -> list[str]:
+    """Periodos que cubren [start, end] con la granularidad indicada."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Granularidad de partición desconocida: {granularity}")
+    if granularity == "year":
+        return [str(year) for year in range(start.year, end.year + 1)]
+    periods = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        periods.append(f"{year}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return periods
+
+
+def partition_name(name: str, period: str) -> str:
+    return f"{SCHEMA}.{name}_p{period.replace('-', '_')}"
+
+
+def _existing_partitions(session: Session) -> set[str]:
+    """Particiones ("dw.<partición>") de los hechos, en una sola consulta al catálogo."""
+    result = session.execute(text("""
+        SELECT cn.nspname || '.' || c.relname AS name
+        FROM pg_inherits i
+        JOIN pg_class c       ON c.oid  = i.inhrelid
+        JOIN pg_namespace cn  ON cn.oid = c.relnamespace
+        JOIN pg_class p       ON p.oid  = i.inhparent
+        JOIN pg_namespace pn  ON pn.oid = p.relnamespace
+        WHERE pn.nspname = :schema AND p.relname = ANY(:tables)
+    """), {"schema": SCHEMA, "tables": list(PARTITIONED_TABLES)})
+    return {row.name for row in result}
+
+
+def ensure_fact_partitions(session: Session, start: date, end: date,
+                           granularity: str = "month") -> int:
+    """Crea las particiones faltantes de los hechos para [start, end]; retorna cuántas creó."""
+    created = 0
+    try:
+        existing = _existing_partitions(session)
+        for name in PARTITIONED_TABLES:
+            for period in periods_between(start, end, granularity):
+                partition = partition_name(name, period)
+                if partition in existing:
+                    continue
+                lo, hi = period_bounds(period)
+                session.execute(text(
+                    f"CREATE TABLE {partition} PARTITION OF {SCHEMA}.{name} "
+                    f"FOR VALUES FROM ({lo}) TO ({hi})"
+                ))
+                created += 1
+    except Exception as e:
+        raise LoadError(f"Error creando particiones de hechos: {e}") from e
+    if created:
+        logger.info("Creadas %d particiones de hechos (%s, %s a %s)",
+                    created, granularity, start, end)
+    return created
+
+
+def reload_table_name(name: str, period: str) -> str:
+    return f"{partition_name(name, period)}__reload"
+
+
+def create_reload_table(session: Session, name: str, period: str) -> str:
+    """
+    Crea la tabla donde se recarga el periodo: LIKE la partición (columnas,
+    defaults e índices) más un CHECK del rango de date_key, para que el ATTACH
+    no tenga que recorrerla. Retorna su nombre para cargarla directamente
+    (p. ej. con tables={name: tabla} en los loaders).
+    """
+    partition = partition_name(name, period)
+    table = reload_table_name(name, period)
+    lo, hi = period_bounds(period)
+    try:
+        if not session.execute(text("SELECT to_regclass(:name)"), {"name": partition}).scalar():
+            raise LoadError(f"No existe la partición {partition}")
+        session.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        session.execute(text(f"CREATE TABLE {table} (LIKE {partition} INCLUDING ALL)"))
+        session.execute(text(
+            f"ALTER TABLE {table} ADD CONSTRAINT reload_range "
+            f"CHECK (date_key >= {lo} AND date_key < {hi})"
+        ))
+        logger.info("Tabla de recarga %s creada", table)
+        return table
+    except LoadError:
+        raise
+    except Exception as e:
+        raise LoadError(f"Error creando la tabla de recarga de {partition}: {e}") from e
+
+
+def swap_partition(session: Session, name: str, period: str):
+    """
+    Reemplaza la partición de `period` por su tabla de recarga ya cargada:
+    DETACH + DROP de la partición anterior, RENAME y ATTACH. Debe ejecutarse en
+    una transacción corta propia, separada de la carga.
+    """
+    partition = partition_name(name, period)
+    table = reload_table_name(name, period)
+    lo, hi = period_bounds(period)
+    try:
+        session.execute(text(f"ALTER TABLE {SCHEMA}.{name} DETACH PARTITION {partition}"))
+        session.execute(text(f"DROP TABLE {partition}"))
+        session.execute(text(f"ALTER TABLE {table} RENAME TO {partition.split('.', 1)[1]}"))
+        session.execute(text(
+            f"ALTER TABLE {SCHEMA}.{name} ATTACH PARTITION {partition} "
+            f"FOR VALUES FROM ({lo}) TO ({hi})"
+        ))
+        session.execute(text(f"ALTER TABLE {partition} DROP CONSTRAINT reload_range"))
+        logger.info("Partición %s reemplazada", partition)
+    except Exception as e:
+        raise LoadError(f"Error reemplazando la partición {partition}: {e}") from e
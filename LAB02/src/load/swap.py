@@ -0,0 +1,167 @@
+"""
+Recarga sin bloqueo de lectores mediante tablas shadow.
+
+Las tablas se reconstruyen en copias `dw.<tabla>__shadow` (misma estructura,
+defaults, checks e índices) mientras el dashboard sigue leyendo las vigentes.
+Al final, `swap_shadow_tables` las publica en una sola transacción corta:
+DROP de la tabla vigente + RENAME de la shadow. Los lectores solo esperan
+ese instante (ACCESS EXCLUSIVE del rename), nunca la carga completa.
+Si la tabla vigente está particionada, la shadow replica su clave y sus
+particiones (`dw.<partición>__shadow`), que también se renombran en el swap.
+"""
+import logging
+import re
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from src.utils.exceptions import LoadError
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = "dw"
+SHADOW_SUFFIX = "__shadow"
+FACT_TABLES = ("fact_sales", "fact_orders")
+SALES_AGG_TABLES = ("agg_market_basket", "agg_product_margin")
+CUSTOMER_AGG_TABLES = ("agg_cohort_retention", "agg_customer_recurrence")
+AGG_TABLES = SALES_AGG_TABLES + CUSTOMER_AGG_TABLES
+# Espera máxima por el lock del swap (una consulta larga del dashboard no
+# debe dejar encolados a todos los lectores detrás del RENAME)
+SWAP_LOCK_TIMEOUT = "10s"
+
+_INDEX_NAME = re.compile(r"INDEX \S+ ON (ONLY )?\S+")
+
+
+def shadow_name(name: str) -> str:
+    return f"{SCHEMA}.{name}{SHADOW_SUFFIX}"
+
+
+def create_shadow_tables(session: Session, names) -> dict:
+    """
+    Crea (vacías) las tablas shadow de `names` y retorna {nombre: tabla shadow},
+    el mapeo que aceptan los loaders en `tables`. Una shadow que haya quedado de
+    una corrida fallida se descarta.
+    """
+    tables = {}
+    try:
+        for name in names:
+            live, shadow = f"{SCHEMA}.{name}", shadow_name(name)
+            session.execute(text(f"DROP TABLE IF EXISTS {shadow}"))
+            partition_key = session.execute(
+                text("SELECT pg_get_partkeydef(CAST(:table AS regclass))"), {"table": live}
+            ).scalar()
+            if partition_key:
+                session.execute(text(
+                    f"CREATE TABLE {shadow} (LIKE {live} INCLUDING ALL) PARTITION BY {partition_key}"
+                ))
+                for partition in _partitions(session, live):
+                    session.execute(text(
+                        f"CREATE TABLE {shadow_name(partition.name)} "
+                        f"PARTITION OF {shadow} {partition.bound}"
+                    ))
+            else:
+                session.execute(text(f"CREATE TABLE {shadow} (LIKE {live} INCLUDING ALL)"))
+            tables[name] = shadow
+        logger.info("Tablas shadow creadas: %s", ", ".join(tables.values()))
+        return tables
+    except Exception as e:
+        raise LoadError(f"Error creando tablas shadow: {e}") from e
+
+
+def drop_shadow_tables(session: Session, tables: dict):
+    """Descarta las tablas shadow (corrida abortada antes del swap)."""
+    for shadow in tables.values():
+        session.execute(text(f"DROP TABLE IF EXISTS {shadow}"))
+
+
+def _partitions(session: Session, table: str) -> list:
+    """Particiones de `table`: (name, bound) con bound = "FOR VALUES FROM (..) TO (..)"."""
+    result = session.execute(text("""
+        SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST(:table AS regclass)
+        ORDER BY c.relname
+    """), {"table": table})
+    return result.fetchall()
+
+
+def _restore_index_names(session: Session, table: str, original: dict):
+    """Renombra los índices de `table` a los de `original` con la misma definición."""
+    for definition, index_name in _index_names(session, table).items():
+        name = original.get(definition)
+        if name and name != index_name:
+            session.execute(text(f"ALTER INDEX {SCHEMA}.{index_name} RENAME TO {name}"))
+
+
+def _index_names(session: Session, table: str) -> dict:
+    """{definición del índice sin nombre ni tabla: nombre del índice}."""
+    result = session.execute(text("""
+        SELECT c.relname AS index_name, pg_get_indexdef(i.indexrelid) AS definition
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = CAST(:table AS regclass)
+    """), {"table": table})
+    return {_INDEX_NAME.sub("INDEX ON", row.definition): row.index_name for row in result}
+
+
+def _foreign_keys(session: Session, table: str) -> list:
+    result = session.execute(text("""
+        SELECT conname, pg_get_constraintdef(oid) AS definition
+        FROM pg_constraint
+        WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'
+    """), {"table": table})
+    return result.fetchall()
+
+
+def _owned_sequences(session: Session, table: str) -> list:
+    """Secuencias (serial) que pertenecen a columnas de `table`."""
+    result = session.execute(text("""
+        SELECT CAST(CAST(s.oid AS regclass) AS text) AS sequence_name, a.attname AS column_name
+        FROM pg_depend d
+        JOIN pg_class s     ON s.oid = d.objid AND s.relkind = 'S'
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.refobjid = CAST(:table AS regclass) AND d.deptype = 'a'
+    """), {"table": table})
+    return result.fetchall()
+
+
+def swap_shadow_tables(session: Session, tables: dict):
+    """
+    Publica las shadow de `tables` ({nombre: tabla shadow}) en una sola transacción.
+    Antes de tomar locks sobre las tablas vigentes se copian las FK a la shadow
+    (LIKE no las copia); después, por cada tabla: las secuencias serial pasan a la
+    shadow, se elimina la vigente, se renombra la shadow (y sus particiones) y los
+    índices recuperan los nombres originales (pkey, uq_*, idx_*).
+    """
+    if not tables:
+        return
+    try:
+        for name, shadow in tables.items():
+            for fk in _foreign_keys(session, f"{SCHEMA}.{name}"):
+                session.execute(text(
+                    f"ALTER TABLE {shadow} ADD CONSTRAINT {fk.conname} {fk.definition}"
+                ))
+
+        session.execute(text(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'"))
+        for name, shadow in tables.items():
+            live = f"{SCHEMA}.{name}"
+            relations = [name] + [p.name for p in _partitions(session, live)]
+            index_names = {rel: _index_names(session, f"{SCHEMA}.{rel}") for rel in relations}
+            for seq in _owned_sequences(session, live):
+                session.execute(text(
+                    f"ALTER SEQUENCE {seq.sequence_name} OWNED BY {shadow}.{seq.column_name}"
+                ))
+            session.execute(text(f"DROP TABLE {live}"))
+            session.execute(text(f"ALTER TABLE {shadow} RENAME TO {name}"))
+            for partition in _partitions(session, live):
+                if partition.name.endswith(SHADOW_SUFFIX):
+                    session.execute(text(
+                        f"ALTER TABLE {SCHEMA}.{partition.name} "
+                        f"RENAME TO {partition.name[:-len(SHADOW_SUFFIX)]}"
+                    ))
+            for rel, original in index_names.items():
+                _restore_index_names(session, f"{SCHEMA}.{rel}", original)
+        logger.info("Swap de tablas shadow completado: %s", ", ".join(tables))
+    except Exception as e:
+        raise LoadError(f"Error en swap de tablas shadow: {e}") from e
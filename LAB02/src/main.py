@@ -2,24 +2,50 @@
 Punto de entrada del proceso ETL completo.
 Ejecuta los pipelines en orden correcto:
   1. CustomerPipeline  → dim_customer
-  2. SalesPipeline     → dims (fecha, territorio, producto) + facts + aggs de ventas
-  3. CustomerPipeline  → aggs de cohortes (necesitan facts cargados)
+  2. SalesPipeline     → dims (fecha, territorio, producto) + facts
+  3. Agregaciones      → las cuatro agg_* en paralelo (necesitan facts cargados)
+  4. Swap de tablas shadow (si etl.swap_tables): hechos y aggs se publican juntos
+  5. Prewarm de las agg_* del dashboard (si etl.prewarm_aggregates)
+
+Uso:
+  python -m src.main                 # hechos incrementales (watermark)
+  python -m src.main --full-refresh  # TRUNCATE + recarga completa de hechos
+  python -m src.main --reload-period 2014-06  # reemplaza solo esa partición de hechos
 """
 import sys
 import logging
 import time
+import argparse
 
-from config.settings import setup_logging
+from config.settings import setup_logging, get_etl_setting
+from src.extract import ExtractionCache
+from src.load import LoadPhaseManager
+from src.load.swap import AGG_TABLES
 from src.utils.db import test_connections
 from src.pipelines.customer_pipeline import CustomerPipeline
 from src.pipelines.sales_pipeline import SalesPipeline
+from src.pipelines.aggregation_stage import AggregationStage
 
 # Configurar logging antes de cualquier otra cosa
 setup_logging()
 logger = logging.getLogger("main")
 
 
-def main():
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="AdventureWorks ETL - Lab02")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--full-refresh", action="store_true",
+        help="Ignora los watermarks y recarga completa de fact_sales / fact_orders",
+    )
+    mode.add_argument(
+        "--reload-period", metavar="YYYY-MM|YYYY",
+        help="Recarga solo la partición de hechos de ese periodo (según etl.partition_granularity)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(full_refresh: bool = False, reload_period: str | None = None):
     logger.info("╔══════════════════════════════════════════╗")
     logger.info("║   AdventureWorks ETL Pipeline - Lab02   ║")
     logger.info("╚══════════════════════════════════════════╝")
@@ -34,22 +60,49 @@ def main():
     logger.info("Todas las conexiones OK.")
 
     start_time = time.time()
+    # Resultados chicos del OLTP compartidos por los pipelines de esta corrida
+    extraction_cache = ExtractionCache() if get_etl_setting("extraction_cache", True) else None
 
     # 2. Pipeline de clientes (dim_customer sin cohortes aún)
     logger.info("─── Fase 1: Cargando dimensión de clientes ───")
-    customer_pipeline = CustomerPipeline()
+    customer_pipeline = CustomerPipeline(extraction_cache)
     customer_pipeline._load_dim_customer(
         customer_pipeline.extractor.extract_first_orders()
     )
 
-    # 3. Pipeline de ventas (dimensiones + hechos + aggs de ventas)
+    # 3. Pipeline de ventas (dimensiones + hechos)
     logger.info("─── Fase 2: Pipeline de ventas ───")
-    sales_pipeline = SalesPipeline()
-    sales_pipeline.run()
+    sales_pipeline = SalesPipeline(full_refresh=full_refresh, reload_period=reload_period,
+                                   extraction_cache=extraction_cache)
+    sales_pipeline.run(publish=False, aggregate=False)
+
+    # 4. Agregaciones de ventas y clientes en paralelo (en modo swap leen las shadow)
+    logger.info("─── Fase 3: Agregaciones ───")
+    shadow_tables = {}
+    try:
+        shadow_tables, customer_tasks = customer_pipeline.aggregation_tasks(
+            sales_pipeline.shadow_tables
+        )
+        AggregationStage(
+            {**sales_pipeline.aggregation_tasks(), **customer_tasks},
+            get_etl_setting("aggregation_workers", 4),
+        ).run()
+
+        # 5. Publicar hechos y agregaciones en una sola transacción
+        if shadow_tables:
+            logger.info("─── Fase 4: Swap de tablas shadow ───")
+            sales_pipeline.publish(shadow_tables)
+    except Exception:
+        # Las shadow sin publicar no deben quedar ocupando espacio hasta la próxima corrida
+        sales_pipeline.discard(shadow_tables)
+        raise
+
+    # 6. Dejar en caché las tablas que consulta el dashboard
+    if get_etl_setting("prewarm_aggregates", False):
+        LoadPhaseManager.prewarm([f"dw.{name}" for name in AGG_TABLES])
 
-    # 4. Agregaciones de clientes (necesitan facts cargados)
-    logger.info("─── Fase 3: Agregaciones de clientes ───")
-    customer_pipeline._load_aggregations()
+    if extraction_cache is not None:
+        extraction_cache.log_summary()
 
     elapsed = time.time() - start_time
     logger.info("╔══════════════════════════════════════════╗")
@@ -58,4 +111,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    main(full_refresh=args.full_refresh, reload_period=args.reload_period)
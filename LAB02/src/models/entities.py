@@ -7,7 +7,7 @@ from datetime import datetime, date
 from decimal import Decimal
 from sqlalchemy import (
     Column, Integer, SmallInteger, BigInteger, String, Boolean,
-    Numeric, DateTime, Date, ForeignKey, Text, CHAR
+    Numeric, DateTime, Date, ForeignKey, Text, CHAR, UniqueConstraint
 )
 from sqlalchemy.orm import relationship, DeclarativeBase
 
@@ -248,6 +248,7 @@ class DimCustomer(OLAPBase):
     cohort_year       = Column(SmallInteger)
     cohort_month      = Column(SmallInteger)
     cohort_key        = Column(CHAR(7))
+    row_hash          = Column(CHAR(32))
     created_at        = Column(DateTime, default=datetime.now)
     updated_at        = Column(DateTime, default=datetime.now)
 
@@ -274,6 +275,7 @@ class DimProduct(OLAPBase):
     category_name    = Column(String(50))
     is_bike          = Column(Boolean, default=False)
     is_accessory     = Column(Boolean, default=False)
+    row_hash         = Column(CHAR(32))
     created_at       = Column(DateTime, default=datetime.now)
     updated_at       = Column(DateTime, default=datetime.now)
 
@@ -289,6 +291,7 @@ class DimTerritory(OLAPBase):
     territory_name = Column(String(50), nullable=False)
     country_code   = Column(String(3), nullable=False)
     region_group   = Column(String(50), nullable=False)
+    row_hash       = Column(CHAR(32))
 
     fact_sales  = relationship("FactSales",  back_populates="territory_dim")
     fact_orders = relationship("FactOrders", back_populates="territory_dim")
@@ -296,10 +299,14 @@ class DimTerritory(OLAPBase):
 
 class FactSales(OLAPBase):
     __tablename__ = "fact_sales"
-    __table_args__ = {"schema": "dw"}
-
-    sales_key             = Column(BigInteger, primary_key=True)
-    date_key              = Column(Integer, ForeignKey("dw.dim_date.date_key"), nullable=False)
+    __table_args__ = (
+        UniqueConstraint("sales_order_id", "sales_order_detail_id", "date_key",
+                         name="uq_fs_order_line"),
+        {"schema": "dw", "postgresql_partition_by": "RANGE (date_key)"},
+    )
+
+    sales_key             = Column(BigInteger, primary_key=True, autoincrement=True)
+    date_key              = Column(Integer, ForeignKey("dw.dim_date.date_key"), primary_key=True)
     customer_key          = Column(Integer, ForeignKey("dw.dim_customer.customer_key"), nullable=False)
     product_key           = Column(Integer, ForeignKey("dw.dim_product.product_key"), nullable=False)
     territory_key         = Column(Integer, ForeignKey("dw.dim_territory.territory_key"), nullable=False)
@@ -324,13 +331,16 @@ class FactSales(OLAPBase):
 
 class FactOrders(OLAPBase):
     __tablename__ = "fact_orders"
-    __table_args__ = {"schema": "dw"}
+    __table_args__ = (
+        UniqueConstraint("sales_order_id", "date_key", name="uq_fo_order"),
+        {"schema": "dw", "postgresql_partition_by": "RANGE (date_key)"},
+    )
 
-    order_key             = Column(BigInteger, primary_key=True)
-    date_key              = Column(Integer, ForeignKey("dw.dim_date.date_key"), nullable=False)
+    order_key             = Column(BigInteger, primary_key=True, autoincrement=True)
+    date_key              = Column(Integer, ForeignKey("dw.dim_date.date_key"), primary_key=True)
     customer_key          = Column(Integer, ForeignKey("dw.dim_customer.customer_key"), nullable=False)
     territory_key         = Column(Integer, ForeignKey("dw.dim_territory.territory_key"), nullable=False)
-    sales_order_id        = Column(Integer, nullable=False, unique=True)
+    sales_order_id        = Column(Integer, nullable=False)
     sub_total             = Column(Numeric(19, 4), nullable=False)
     tax_amt               = Column(Numeric(19, 4), nullable=False)
     freight               = Column(Numeric(19, 4), nullable=False)
@@ -404,3 +414,12 @@ class AggCustomerRecurrence(OLAPBase):
     total_revenue = Column(Numeric(19, 4), nullable=False)
     revenue_pct   = Column(Numeric(8, 4))
     etl_loaded_at = Column(DateTime, default=datetime.now)
+
+
+class EtlWatermark(OLAPBase):
+    __tablename__ = "etl_watermark"
+    __table_args__ = {"schema": "dw"}
+
+    source_name = Column(String(100), primary_key=True)
+    last_value  = Column(DateTime)
+    updated_at  = Column(DateTime, default=datetime.now)
@@ -0,0 +1,64 @@
+"""
+Etapa de agregaciones: ejecuta los loaders agg_* en paralelo.
+
+Cada agregación solo lee los hechos ya cargados y escribe su propia tabla, así
+que se ejecutan a la vez, cada una en su sesión (conexión del pool OLAP) y con
+su propio commit. El tiempo de pared de la etapa queda cerca del de la
+agregación más lenta.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from src.utils.db import olap_session, get_olap_engine
+from src.utils.exceptions import LoadError
+
+logger = logging.getLogger(__name__)
+
+
+class AggregationStage:
+    """
+    Ejecuta `tasks` ({tabla agg: función(session)}) concurrentemente.
+    Los workers se limitan al pool OLAP; con workers=1 la ejecución es secuencial.
+    """
+
+    def __init__(self, tasks: dict[str, Callable[[Session], None]], workers: int = 4):
+        self.tasks = tasks
+        self.workers = max(1, workers)
+        self.timings: dict[str, float] = {}
+
+    def _run_task(self, name: str, task: Callable[[Session], None]) -> float:
+        start = time.time()
+        with olap_session() as session:
+            task(session)
+        elapsed = time.time() - start
+        logger.info("Agregación %s completada en %.1f s", name, elapsed)
+        return elapsed
+
+    def run(self) -> dict[str, float]:
+        """Ejecuta todas las agregaciones; si alguna falla, se lanza tras esperar al resto."""
+        if not self.tasks:
+            return {}
+        workers = min(self.workers, len(self.tasks), get_olap_engine().pool.size())
+        logger.info("Calculando %d agregaciones con %d workers...", len(self.tasks), workers)
+        start = time.time()
+        errors = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aggregation") as pool:
+            futures = {name: pool.submit(self._run_task, name, task)
+                       for name, task in self.tasks.items()}
+            for name, future in futures.items():
+                try:
+                    self.timings[name] = future.result()
+                except Exception as e:
+                    logger.error("Agregación %s fallida: %s", name, e)
+                    errors[name] = e
+
+        logger.info("Etapa de agregaciones: %.1f s de pared (%s)", time.time() - start,
+                    ", ".join(f"{n} {t:.1f} s" for n, t in self.timings.items()))
+        if errors:
+            name, error = next(iter(errors.items()))
+            raise LoadError(f"Agregación {name} fallida: {error}") from error
+        return self.timings
@@ -3,14 +3,20 @@ Pipeline de clientes: extrae clientes OLTP, carga dim_customer
 y calcula agregaciones de cohortes y recurrencia.
 """
 import logging
+from functools import partial
 
-from src.extract.sql_extractor import SQLExtractor
+from config.settings import get_etl_setting
+from src.extract import create_extractor, ExtractionCache
 from src.transform import transform_customer
 from src.load import (
     load_dim_customers,
     load_agg_cohort_retention,
     load_agg_customer_recurrence,
+    create_shadow_tables, swap_shadow_tables,
 )
+from src.load.key_cache import SurrogateKeyCache
+from src.load.swap import CUSTOMER_AGG_TABLES
+from src.pipelines.aggregation_stage import AggregationStage
 from src.utils.db import olap_session
 from src.utils.exceptions import ETLException
 
@@ -21,13 +27,15 @@ class CustomerPipeline:
     """
     Orquesta el ETL para la dimensión de clientes.
     1. Extrae clientes del OLTP
-    2. Enriquece con fecha de primera orden (para cohortes)
+    2. Enriquece con su territorio y la fecha de primera orden (para cohortes)
     3. Carga dim_customer
     4. Calcula cohortes y recurrencia
     """
 
-    def __init__(self):
-        self.extractor = SQLExtractor(batch_size=1000)
+    def __init__(self, extraction_cache: ExtractionCache | None = None):
+        self.extractor = create_extractor(cache=extraction_cache)
+        self.swap_tables = get_etl_setting("swap_tables", False)
+        self.aggregation_workers = get_etl_setting("aggregation_workers", 4)
 
     def run(self):
         logger.info("=== Iniciando CustomerPipeline ===")
@@ -40,21 +48,58 @@ class CustomerPipeline:
             logger.error("Error en CustomerPipeline: %s", e)
             raise ETLException(f"CustomerPipeline fallido: {e}") from e
 
+    def _territories(self) -> dict:
+        """
+        {territory_id: datos del territorio}. Sale del caché de extracción: el
+        mismo extract lo usa SalesPipeline para dim_territory.
+        """
+        territories = {}
+        for batch in self.extractor.extract_territories():
+            for row in batch:
+                territories[row["territory_id"]] = {
+                    "territory_name": row["territory_name"],
+                    "region_group":   row["region_group"],
+                    "country_code":   row["country_code"],
+                }
+        return territories
+
     def _load_dim_customer(self, first_orders: dict):
-        """Extrae y carga dim_customer con datos de cohorte."""
+        """Extrae y carga dim_customer con datos de territorio y de cohorte."""
         logger.info("Cargando dim_customer...")
+        territories = self._territories()
         rows = []
         for batch in self.extractor.extract_customers():
             for row in batch:
+                row.update(territories.get(row["territory_id"], {}))
                 fod = first_orders.get(row["customer_id"])
                 rows.append(transform_customer(row, fod))
 
+        cache = SurrogateKeyCache("dim_customer")
         with olap_session() as session:
-            load_dim_customers(session, rows)
+            changed = load_dim_customers(session, rows)
+            cache.resolve(session, changed)
+        cache.save()
         logger.info("dim_customer: %d clientes cargados", len(rows))
 
+    def aggregation_tasks(self, tables: dict | None = None) -> tuple[dict, dict]:
+        """
+        Prepara cohortes y recurrencia: retorna (tablas destino, {tabla agg: función(session)}).
+        `tables` indica las shadow ya cargadas por SalesPipeline (p. ej. los hechos);
+        en modo swap se agregan las shadow de estas agregaciones.
+        """
+        tables = dict(tables or {})
+        if self.swap_tables:
+            with olap_session() as session:
+                tables.update(create_shadow_tables(session, CUSTOMER_AGG_TABLES))
+        return tables, {
+            "agg_cohort_retention":    partial(load_agg_cohort_retention, tables=tables),
+            "agg_customer_recurrence": partial(load_agg_customer_recurrence, tables=tables),
+        }
+
     def _load_aggregations(self):
-        """Calcula cohortes y recurrencia (después de cargar facts)."""
-        with olap_session() as session:
-            load_agg_cohort_retention(session)
-            load_agg_customer_recurrence(session)
+        """Calcula cohortes y recurrencia (después de cargar facts) y publica sus shadow."""
+        tables, tasks = self.aggregation_tasks()
+        AggregationStage(tasks, self.aggregation_workers).run()
+        if tables:
+            with olap_session() as session:
+                swap_shadow_tables(session, tables)
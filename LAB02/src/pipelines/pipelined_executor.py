@@ -0,0 +1,165 @@
+"""
+Ejecución en pipeline (productor / consumidor) de las etapas de un flujo ETL.
+
+Cada etapa corre en su propio hilo y se comunica con la siguiente por una cola
+acotada: mientras el DW carga un batch, Python transforma el siguiente y el OLTP
+entrega el que sigue. Las colas dan backpressure: si la carga es la etapa lenta,
+la extracción se bloquea en vez de acumular batches en memoria.
+
+Si una etapa falla se cancelan todas: las demás dejan de tomar o entregar items,
+se cierra el iterador de origen (liberando su cursor / conexión) y `run` lanza
+el error original una vez terminados los hilos.
+
+Por etapa se registra el tiempo ocupado (procesando), el tiempo ocioso esperando
+entrada y el tiempo bloqueado esperando lugar en la cola de salida.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+# Intervalo con que las etapas bloqueadas revisan si el pipeline fue cancelado
+_POLL_SECONDS = 0.5
+
+
+class PipelinedExecutor:
+    """
+    Recorre `source` y pasa cada item por `stages` ([(nombre, función(item))]).
+    Cada función recibe el resultado de la anterior; el de la última se descarta
+    (la última etapa es la de carga). `queue_size` acota los items en tránsito
+    entre cada par de etapas.
+    """
+
+    def __init__(self, source: Iterable, stages: list[tuple[str, Callable]],
+                 queue_size: int = 4, name: str = "pipeline"):
+        self.source = source
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.name = name
+        self.stats: dict[str, dict] = {}
+        self._stop = threading.Event()
+        self._errors: list[tuple[str, BaseException]] = []
+        self._lock = threading.Lock()
+
+    def _new_stats(self, stage: str) -> dict:
+        stats = {"items": 0, "busy": 0.0, "idle": 0.0, "blocked": 0.0}
+        self.stats[stage] = stats
+        return stats
+
+    def _fail(self, stage: str, error: BaseException):
+        with self._lock:
+            self._errors.append((stage, error))
+        logger.error("%s: etapa %s fallida: %s", self.name, stage, error)
+        self._stop.set()
+
+    def _put(self, out: queue.Queue, item, stats: dict) -> bool:
+        """Entrega `item` esperando lugar en la cola; False si el pipeline se canceló."""
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    out.put(item, timeout=_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stats["blocked"] += time.perf_counter() - start
+
+    def _get(self, inbox: queue.Queue, stats: dict):
+        """Siguiente item de la cola; _DONE al terminar o si el pipeline se canceló."""
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    return inbox.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+            return _DONE
+        finally:
+            stats["idle"] += time.perf_counter() - start
+
+    def _produce(self, out: queue.Queue, stats: dict):
+        iterator = iter(self.source)
+        try:
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stats["busy"] += time.perf_counter() - start
+                stats["items"] += 1
+                if not self._put(out, item, stats):
+                    break
+        except BaseException as e:
+            self._fail("extract", e)
+        finally:
+            # Cierra el generador en este hilo: libera cursores y workers del origen
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    logger.warning("%s: error cerrando el origen: %s", self.name, e)
+            self._put(out, _DONE, stats)
+
+    def _consume(self, stage: str, func: Callable, inbox: queue.Queue,
+                 out: queue.Queue | None, stats: dict):
+        try:
+            while True:
+                item = self._get(inbox, stats)
+                if item is _DONE:
+                    break
+                start = time.perf_counter()
+                try:
+                    result = func(item)
+                finally:
+                    stats["busy"] += time.perf_counter() - start
+                stats["items"] += 1
+                if out is not None and not self._put(out, result, stats):
+                    break
+        except BaseException as e:
+            self._fail(stage, e)
+        finally:
+            if out is not None:
+                self._put(out, _DONE, stats)
+
+    def run(self) -> dict[str, dict]:
+        """Ejecuta el pipeline hasta agotar el origen; lanza el primer error de una etapa."""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = [threading.Thread(target=self._produce, name=f"{self.name}-extract",
+                                    args=(queues[0], self._new_stats("extract")))]
+        for i, (stage, func) in enumerate(self.stages):
+            out = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._consume, name=f"{self.name}-{stage}",
+                                            args=(stage, func, queues[i], out,
+                                                  self._new_stats(stage))))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            # Interrupción en el hilo principal: cancelar y esperar a las etapas
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            raise
+        elapsed = time.perf_counter() - start
+
+        for stage, stats in self.stats.items():
+            logger.info("%s: %s %d items, ocupado %.1f s, esperando entrada %.1f s, "
+                        "bloqueado %.1f s", self.name, stage, stats["items"], stats["busy"],
+                        stats["idle"], stats["blocked"])
+        logger.info("%s: %.1f s de pared", self.name, elapsed)
+        if self._errors:
+            stage, error = self._errors[0]
+            raise error
+        return self.stats
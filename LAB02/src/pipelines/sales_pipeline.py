@@ -1,22 +1,63 @@
 """
 Pipeline de ventas: extrae órdenes OLTP y carga fact_sales + fact_orders.
+
+Por defecto la carga de hechos es incremental: solo se extraen las órdenes
+modificadas desde el último watermark (dw.etl_watermark) y se hace upsert.
+Con `full_refresh=True`, o si aún no hay watermark, se recarga todo.
+
+Con etl.swap_tables los hechos (en carga completa) y las agregaciones se
+construyen en tablas shadow y se publican al final con un swap atómico, así el
+dashboard sigue leyendo las tablas vigentes durante toda la corrida.
+
+En carga completa los índices secundarios de los hechos se eliminan antes de
+insertar y se recrean al final; antes de las agregaciones se ejecuta ANALYZE
+sobre las tablas cargadas (ver load.load_phase).
+
+Los hechos están particionados por date_key; con `reload_period` ("YYYY-MM" o
+"YYYY") solo se reemplazan las particiones de ese periodo (ver load.partitions).
+
+Fuera de la carga completa, agg_product_margin se mantiene en forma incremental:
+solo se recalculan las celdas (producto, año, mes) tocadas por la corrida.
+
+La carga de hechos corre como pipeline extract ‖ transform ‖ load (un hilo por
+etapa, colas acotadas; ver pipelines.pipelined_executor).
+
+Con etl.elt_facts, fact_sales se carga en modo ELT: las líneas extraídas se
+copian a staging y las claves, la cuarentena y las medidas se resuelven en SQL.
 """
 import logging
 from datetime import date, datetime
-from collections import defaultdict
+from functools import partial
+
+import pandas as pd
+from sqlalchemy import text as sa_text
 
-from src.extract.sql_extractor import SQLExtractor
+from config.settings import get_etl_setting
+from src.extract import create_extractor, ExtractionCache
 from src.transform import (
-    transform_fact_sales, transform_fact_orders,
-    transform_date, transform_territory, transform_product
+    transform_fact_sales_batch, transform_fact_orders,
+    transform_dates, transform_territory, transform_product
 )
 from src.load import (
-    load_dim_dates, load_dim_territories, load_dim_products,
-    load_fact_sales, load_fact_orders,
-    load_agg_market_basket, load_agg_product_margin
+    load_dim_dates, missing_dim_dates, load_dim_territories, load_dim_products,
+    truncate_fact_tables, load_fact_sales, load_fact_orders,
+    copy_fact_sales, copy_fact_orders,
+    upsert_fact_sales, upsert_fact_orders,
+    get_watermarks, save_watermarks,
+    MARKET_BASKET_ENGINES, load_agg_product_margin,
+    margin_cells, refresh_agg_product_margin,
+    create_shadow_tables, drop_shadow_tables, swap_shadow_tables,
+    resolve_table, LoadPhaseManager,
+    ensure_fact_partitions, create_reload_table, swap_partition,
+    truncate_staging, stage_order_details, staged_margin_cells, load_fact_sales_elt
 )
+from src.load.key_cache import SurrogateKeyCache
+from src.transform.key_map import KeyMap, MISSING
+from src.load.partitions import period_bounds, period_dates, validate_period
+from src.pipelines.aggregation_stage import AggregationStage
+from src.pipelines.pipelined_executor import PipelinedExecutor
+from src.load.swap import FACT_TABLES, SALES_AGG_TABLES
 from src.utils.db import olap_session
-from src.utils.helpers import generate_date_range
 from src.utils.exceptions import ETLException
 
 logger = logging.getLogger(__name__)
@@ -30,29 +71,77 @@ class SalesPipeline:
     3. Calcula agregaciones: market basket, márgenes
     """
 
-    def __init__(self):
-        self.extractor = SQLExtractor(batch_size=1000)
+    def __init__(self, full_refresh: bool = False, reload_period: str | None = None,
+                 extraction_cache: ExtractionCache | None = None):
+        self.full_refresh = full_refresh
+        self.reload_period = reload_period
+        self.partition_granularity = get_etl_setting("partition_granularity", "month")
+        if reload_period:
+            # Valida el periodo contra las particiones antes de correr
+            validate_period(reload_period, self.partition_granularity)
+        self.extractor = create_extractor(cache=extraction_cache)
+        self.extract_partitions = get_etl_setting("extract_partitions", 1)
+        self.pipeline_queue_size = get_etl_setting("pipeline_queue_size", 4)
+        self.fact_loader = get_etl_setting("fact_loader", "copy")
+        self.elt_facts = get_etl_setting("elt_facts", False)
+        self.swap_tables = get_etl_setting("swap_tables", False)
+        self.rebuild_indexes = get_etl_setting("rebuild_indexes", True)
+        self.load_phase = LoadPhaseManager(get_etl_setting("index_build_workers", 4))
+        self.incremental_aggregates = get_etl_setting("incremental_aggregates", True)
+        self.aggregation_workers = get_etl_setting("aggregation_workers", 4)
+        engine = get_etl_setting("market_basket_engine", "sql")
+        if engine not in MARKET_BASKET_ENGINES:
+            raise ValueError(f"Motor de market basket desconocido: {engine}")
+        self.load_market_basket = MARKET_BASKET_ENGINES[engine]
+        # {tabla: shadow} que reciben la carga en modo swap (vacío = tablas vigentes)
+        self.shadow_tables: dict = {}
+        self.full_load = True
+        # Celdas (product_key, YYYYMM) de agg_product_margin afectadas por la corrida
+        self.margin_cells: set[tuple[int, int]] = set()
+        # standard_cost por product_id, del extract de productos (ver _load_dim_product)
+        self.product_costs = pd.Series(dtype=object)
 
-    def run(self):
+    def run(self, publish: bool = True, aggregate: bool = True):
+        """
+        Ejecuta el pipeline. Con publish=False las shadow quedan sin publicar y con
+        aggregate=False no se calculan las agregaciones de ventas: main las ejecuta
+        junto con las de clientes (aggregation_tasks) y publica todo al final.
+        """
         logger.info("=== Iniciando SalesPipeline ===")
         try:
+            # Índices que una corrida anterior eliminó y no alcanzó a recrear
+            self.load_phase.recover_pending()
             self._load_dim_date()
             territory_map = self._load_dim_territory()
             product_map   = self._load_dim_product()
             customer_map  = self._get_customer_key_map()
-            self._load_facts(territory_map, product_map, customer_map)
-            self._load_aggregations()
+            since = None if self.reload_period else self._get_watermark_since()
+            self.full_load = not (since or self.reload_period)
+            if self.swap_tables:
+                self._create_shadow_tables()
+            if self.reload_period:
+                self._reload_period(territory_map, product_map, customer_map)
+            else:
+                self._load_facts(territory_map, product_map, customer_map, since)
+            self._analyze_loaded_tables()
+            if aggregate:
+                self._load_aggregations()
+            if publish:
+                self.publish()
             logger.info("=== SalesPipeline completado ===")
         except Exception as e:
             logger.error("Error en SalesPipeline: %s", e)
+            self.discard()
             raise ETLException(f"SalesPipeline fallido: {e}") from e
 
     # ── Private methods ──────────────────────────────────────────────────────
 
     def _load_dim_date(self):
-        """Genera y carga la dimensión fecha cubriendo el rango real de datos."""
+        """
+        Completa la dimensión fecha para el rango real de datos: solo se generan
+        (en forma vectorizada) e insertan los días que aún no están en dim_date.
+        """
         logger.info("Detectando rango de fechas en OLTP...")
-        from sqlalchemy import text as sa_text
         from src.utils.db import oltp_session as _oltp
         with _oltp() as session:
             row = session.execute(sa_text(
@@ -64,86 +153,312 @@ class SalesPipeline:
         # Extender un año antes y después para cobertura
         start = date(min_d.year - 1, 1, 1)
         end   = date(max_d.year + 1, 12, 31)
-        logger.info("Generando dim_date desde %s hasta %s", start, end)
-        rows  = [transform_date(d) for d in generate_date_range(start, end)]
         with olap_session() as session:
-            load_dim_dates(session, rows)
+            missing = missing_dim_dates(session, start, end)
+            if len(missing):
+                logger.info("Generando %d días faltantes de dim_date (%s a %s)",
+                            len(missing), missing[0].date(), missing[-1].date())
+                load_dim_dates(session, transform_dates(missing))
+            else:
+                logger.info("dim_date ya cubre %s a %s", start, end)
+            ensure_fact_partitions(session, start, end, self.partition_granularity)
 
-    def _load_dim_territory(self) -> dict:
-        """Carga dim_territory y retorna {territory_id: territory_key}."""
+    def _load_dim_territory(self) -> KeyMap:
+        """Carga dim_territory y retorna el mapa territory_id → territory_key."""
         logger.info("Cargando dim_territory...")
         rows = []
         for batch in self.extractor.extract_territories():
             rows.extend([transform_territory(r) for r in batch])
 
+        cache = SurrogateKeyCache("dim_territory")
         with olap_session() as session:
-            load_dim_territories(session, rows)
-            # Leer keys asignadas
-            from sqlalchemy import text
-            result = session.execute(text("SELECT territory_id, territory_key FROM dw.dim_territory"))
-            return {row.territory_id: row.territory_key for row in result}
-
-    def _load_dim_product(self) -> dict:
-        """Carga dim_product y retorna {product_id: product_key}."""
+            changed = load_dim_territories(session, rows)
+            keys = cache.resolve(session, changed)
+        cache.save()
+        return KeyMap.from_dict(keys)
+
+    def _load_dim_product(self) -> KeyMap:
+        """
+        Carga dim_product y retorna el mapa product_id → product_key. Guarda el
+        standard_cost de cada producto: el extract de líneas no lo repite.
+        """
         logger.info("Cargando dim_product...")
-        from src.transform import transform_product
         rows = []
         for batch in self.extractor.extract_products():
             rows.extend([transform_product(r) for r in batch])
+        self.product_costs = pd.Series({row["product_id"]: row["standard_cost"] for row in rows},
+                                       dtype=object)
 
+        cache = SurrogateKeyCache("dim_product")
         with olap_session() as session:
-            load_dim_products(session, rows)
-            from sqlalchemy import text
-            result = session.execute(text("SELECT product_id, product_key FROM dw.dim_product"))
-            return {row.product_id: row.product_key for row in result}
-
-    def _get_customer_key_map(self) -> dict:
-        """Lee {customer_id: customer_key} desde dim_customer ya cargado."""
-        from sqlalchemy import text
+            changed = load_dim_products(session, rows)
+            keys = cache.resolve(session, changed)
+        cache.save()
+        return KeyMap.from_dict(keys)
+
+    def _get_customer_key_map(self) -> KeyMap:
+        """Mapa customer_id → customer_key desde el caché de claves (ver CustomerPipeline)."""
+        cache = SurrogateKeyCache("dim_customer")
         with olap_session() as session:
-            result = session.execute(text("SELECT customer_id, customer_key FROM dw.dim_customer"))
-            return {row.customer_id: row.customer_key for row in result}
-
-    def _load_facts(self, territory_map: dict, product_map: dict, customer_map: dict):
-        """Carga fact_sales y fact_orders."""
-        logger.info("Cargando fact_sales...")
-        sales_rows  = []
-        for batch in self.extractor.extract_order_details():
-            for row in batch:
-                c_key = customer_map.get(row["customer_id"])
-                p_key = product_map.get(row["product_id"])
-                t_key = territory_map.get(row.get("territory_id"))
-                if not all([c_key, p_key, t_key]):
-                    logger.warning("Skipping detail order %s - key not found", row["sales_order_id"])
-                    continue
-                sales_rows.append(transform_fact_sales(row, c_key, p_key, t_key))
+            keys = cache.resolve(session)
+        cache.save()
+        return KeyMap.from_dict(keys)
 
+    def _get_watermark_since(self) -> dict | None:
+        """Parámetros `since` para la extracción incremental; None = carga completa."""
+        if self.full_refresh:
+            return None
         with olap_session() as session:
-            load_fact_sales(session, sales_rows)
-
-        # fact_orders
-        logger.info("Cargando fact_orders...")
-        first_orders = self.extractor.extract_first_orders()
-        customer_order_counter = defaultdict(int)
-        order_rows = []
-
-        for batch in self.extractor.extract_order_headers():
-            for row in batch:
-                c_id  = row["customer_id"]
-                c_key = customer_map.get(c_id)
-                t_key = territory_map.get(row.get("territory_id"))
-                if not c_key or not t_key:
-                    continue
-                customer_order_counter[c_id] += 1
-                num    = customer_order_counter[c_id]
-                fod    = first_orders.get(c_id)
-                order_rows.append(transform_fact_orders(row, c_key, t_key, num, fod))
+            marks = get_watermarks(session)
+        header = marks.get("sales.sales_order_header")
+        detail = marks.get("sales.sales_order_detail")
+        if header is None or detail is None:
+            logger.info("Sin watermark previo: se ejecuta carga completa de hechos")
+            return None
+        return {"header_since": header, "detail_since": detail}
+
+    def _with_standard_cost(self, frame: pd.DataFrame) -> pd.DataFrame:
+        """Agrega a un batch de líneas el standard_cost de su producto (NaN si no existe)."""
+        return frame.assign(
+            standard_cost=self.product_costs.reindex(frame["product_id"]).to_numpy()
+        )
 
+    @staticmethod
+    def _transform_detail_batch(frame: pd.DataFrame, customer_map: KeyMap, product_map: KeyMap,
+                                territory_map: KeyMap) -> pd.DataFrame:
+        """Resuelve claves surrogadas de un batch columnar y aplica el transform vectorizado."""
+        c_keys = customer_map.lookup(frame["customer_id"])
+        p_keys = product_map.lookup(frame["product_id"])
+        t_keys = territory_map.lookup(frame["territory_id"])
+        found  = (c_keys != MISSING) & (p_keys != MISSING) & (t_keys != MISSING)
+        if not found.all():
+            skipped = frame.loc[~found, "sales_order_id"].unique()
+            logger.warning("Skipping %d detail lines - key not found (orders %s)",
+                           int((~found).sum()), ", ".join(map(str, skipped[:10])))
+        return transform_fact_sales_batch(frame[found], c_keys[found], p_keys[found], t_keys[found])
+
+    @property
+    def _refresh_margin_cells(self) -> bool:
+        """agg_product_margin se actualiza por celdas (en la tabla vigente)."""
+        return self.incremental_aggregates and not self.full_load
+
+    def _create_shadow_tables(self):
+        """
+        Shadow de las agregaciones de ventas y, en carga completa, de los hechos.
+        agg_product_margin no necesita shadow si se actualiza por celdas: el upsert
+        solo toma locks de fila y los lectores no esperan.
+        """
+        names = FACT_TABLES + SALES_AGG_TABLES if self.full_load else SALES_AGG_TABLES
+        if self._refresh_margin_cells:
+            names = tuple(n for n in names if n != "agg_product_margin")
         with olap_session() as session:
-            load_fact_orders(session, order_rows)
+            self.shadow_tables = create_shadow_tables(session, names)
 
-    def _load_aggregations(self):
-        """Calcula todas las tablas de agregación."""
+    def _analyze_loaded_tables(self):
+        """ANALYZE de dimensiones y hechos para planificar las agregaciones."""
+        names = ("dim_date", "dim_territory", "dim_product", "dim_customer") + FACT_TABLES
+        self.load_phase.analyze([resolve_table(n, self.shadow_tables) for n in names])
+
+    def publish(self, tables: dict | None = None):
+        """Publica las shadow (más `tables`, si se indican) en una sola transacción."""
+        tables = {**self.shadow_tables, **(tables or {})}
+        if not tables:
+            return
         with olap_session() as session:
-            load_agg_market_basket(session)
-            load_agg_product_margin(session)
+            swap_shadow_tables(session, tables)
+        self.shadow_tables = {}
+
+    def discard(self, tables: dict | None = None):
+        """
+        Descarta las shadow sin publicar (más `tables`, si se indican) tras una
+        corrida fallida. Un error aquí solo se registra: no debe ocultar el original.
+        """
+        tables = {**self.shadow_tables, **(tables or {})}
+        self.shadow_tables = {}
+        if not tables:
+            return
+        try:
+            with olap_session() as session:
+                drop_shadow_tables(session, tables)
+            logger.info("Tablas shadow descartadas: %s", ", ".join(tables.values()))
+        except Exception as e:
+            logger.warning("No se pudieron descartar las tablas shadow: %s", e)
+
+    @staticmethod
+    def _transform_header_batch(batch: list[dict], customer_map: KeyMap,
+                                territory_map: KeyMap) -> list[dict]:
+        """
+        Transforma cabeceras; la numeración por cliente viene del query de
+        extracción, así que los batches no dependen del orden ni entre sí.
+        Las cabeceras sin cliente o territorio en el DW se omiten con un warning
+        (sus líneas quedan en la cuarentena en modo ELT).
+        """
+        c_keys = customer_map.lookup([row["customer_id"] for row in batch]).tolist()
+        t_keys = territory_map.lookup([row.get("territory_id") for row in batch]).tolist()
+        order_rows, skipped = [], []
+        for row, c_key, t_key in zip(batch, c_keys, t_keys):
+            if c_key == MISSING or t_key == MISSING:
+                skipped.append(row["sales_order_id"])
+                continue
+            order_rows.append(transform_fact_orders(row, c_key, t_key))
+        if skipped:
+            logger.warning("Skipping %d order headers - key not found (orders %s)",
+                           len(skipped), ", ".join(map(str, skipped[:10])))
+        return order_rows
+
+    def _track_margin_cells(self, batch: pd.DataFrame):
+        if self._refresh_margin_cells and len(batch):
+            periods = batch["date_key"].to_numpy() // 100
+            self.margin_cells.update(zip(batch["product_key"].tolist(), periods.tolist()))
+
+    def _write_sales(self, session, batch, incremental: bool, tables: dict):
+        if incremental:
+            upsert_fact_sales(session, batch)
+        elif self.fact_loader == "copy":
+            copy_fact_sales(session, batch, tables)
+        else:
+            load_fact_sales(session, batch, truncate=False, tables=tables)
+
+    def _write_orders(self, session, rows, incremental: bool, tables: dict):
+        if incremental:
+            upsert_fact_orders(session, rows)
+        elif self.fact_loader == "copy":
+            copy_fact_orders(session, rows, tables)
+        else:
+            load_fact_orders(session, rows, truncate=False, tables=tables)
+
+    def _load_facts(self, territory_map: KeyMap, product_map: KeyMap, customer_map: KeyMap,
+                    since: dict | None):
+        """
+        Carga fact_sales y fact_orders (full refresh o incremental) en streaming:
+        extracción, transform y escritura se solapan (ver _stream_facts) dentro de
+        una única transacción OLAP, y la memoria queda acotada a unos pocos batches.
+        En carga completa con swap los batches van a las shadow de los hechos.
+        """
+        tables = self.shadow_tables
+        # Se toma antes de extraer: lo modificado durante la corrida se reprocesa
+        # en la siguiente (el upsert es idempotente)
+        high_marks = self.extractor.extract_modified_high_marks()
+
+        with olap_session() as session:
+            if not since:
+                truncate_fact_tables(session, tables)
+                if self.rebuild_indexes:
+                    self.load_phase.drop_secondary_indexes(
+                        session, [resolve_table(n, tables) for n in FACT_TABLES]
+                    )
+
+            logger.info("Cargando fact_sales y fact_orders (%s)...",
+                        "incremental" if since else "full refresh")
+            if self.elt_facts:
+                truncate_staging(session)
+            # Una sola pasada por el OLTP: cada batch trae las líneas y las cabeceras completas
+            total_sales, total_orders = self._stream_facts(
+                session, self.extractor.extract_orders(since, self.extract_partitions),
+                customer_map, product_map, territory_map,
+                incremental=bool(since), tables=tables, stage=self.elt_facts,
+            )
+            if self.elt_facts:
+                logger.info("Staging: %d líneas de orden copiadas", total_sales)
+                total_sales = self._load_fact_sales_elt(session, since, tables)
+            logger.info("fact_sales: %d líneas cargadas", total_sales)
+            logger.info("fact_orders: %d órdenes cargadas", total_orders)
+
+            save_watermarks(session, high_marks)
+
+        # Fuera de la transacción de carga: las sesiones del rebuild ven los datos
+        self.load_phase.rebuild_indexes()
+
+    def _stream_facts(self, session, orders, customer_map: KeyMap, product_map: KeyMap,
+                      territory_map: KeyMap, incremental: bool, tables: dict,
+                      stage: bool = False) -> tuple[int, int]:
+        """
+        Transforma y escribe los batches de `orders` ((líneas, cabeceras), ver
+        extract_orders) en un pipeline extract ‖ transform ‖ load: la extracción,
+        el transform y la escritura en `session` se solapan, cada una en su hilo.
+        Con `stage=True` las líneas van sin transformar a staging (modo ELT).
+        Retorna (líneas escritas, órdenes escritas).
+        """
+        totals = {"sales": 0, "orders": 0}
+
+        def transform(item):
+            frame, headers = item
+            frame = self._with_standard_cost(frame)
+            if not stage:
+                frame = self._transform_detail_batch(frame, customer_map, product_map, territory_map)
+            return frame, self._transform_header_batch(headers, customer_map, territory_map)
+
+        # La sesión OLAP solo se usa desde el hilo de carga
+        def load(item):
+            batch, order_rows = item
+            if stage:
+                totals["sales"] += stage_order_details(session, batch)
+            else:
+                if incremental and self._refresh_margin_cells:
+                    # Celdas de las versiones previas de estas órdenes (antes del upsert)
+                    self.margin_cells |= margin_cells(
+                        session, order_ids=batch["sales_order_id"].unique().tolist()
+                    )
+                self._write_sales(session, batch, incremental, tables)
+                self._track_margin_cells(batch)
+                totals["sales"] += len(batch)
+            self._write_orders(session, order_rows, incremental, tables)
+            totals["orders"] += len(order_rows)
+
+        PipelinedExecutor(orders, [("transform", transform), ("load", load)],
+                          queue_size=self.pipeline_queue_size, name="Hechos").run()
+        return totals["sales"], totals["orders"]
+
+    def _load_fact_sales_elt(self, session, since: dict | None, tables: dict) -> int:
+        """
+        Modo ELT: con las líneas ya copiadas a staging, resuelve claves,
+        cuarentena y medidas en el DW (ver load.elt). Retorna las líneas cargadas.
+        """
+        physical = {name: resolve_table(name, tables)
+                    for name in ("dim_customer", "dim_product", "dim_territory", "fact_sales")}
+        if self._refresh_margin_cells:
+            self.margin_cells |= staged_margin_cells(session, physical)
+        loaded, _ = load_fact_sales_elt(session, physical, incremental=bool(since))
+        return loaded
+
+    def _reload_period(self, territory_map: KeyMap, product_map: KeyMap, customer_map: KeyMap):
+        """
+        Reemplaza solo las particiones de `reload_period` en fact_sales y fact_orders.
+        Las órdenes OLTP del periodo se cargan en tablas de recarga (LIKE la partición)
+        en una transacción que no bloquea los hechos; después una transacción corta
+        hace el swap (DETACH + DROP + ATTACH), único momento con lock exclusivo.
+        La numeración de órdenes por cliente se calcula en el OLTP sobre el historial
+        completo de cada cliente; los watermarks no se modifican.
+        """
+        period = self.reload_period
+        start, end = period_dates(period)
+        logger.info("Recargando particiones del periodo %s [%s, %s)...", period, start, end)
+
+        with olap_session() as session:
+            if self._refresh_margin_cells:
+                self.margin_cells |= margin_cells(session, date_key_range=period_bounds(period))
+            targets = {name: create_reload_table(session, name, period) for name in FACT_TABLES}
+            total_sales, total_orders = self._stream_facts(
+                session, self.extractor.extract_orders_period(start, end),
+                customer_map, product_map, territory_map, incremental=False, tables=targets,
+            )
+
+        with olap_session() as session:
+            for name in FACT_TABLES:
+                swap_partition(session, name, period)
+        logger.info("Periodo %s recargado: %d líneas, %d órdenes", period, total_sales, total_orders)
+
+    def aggregation_tasks(self) -> dict:
+        """{tabla agg: función(session)} de las agregaciones de ventas."""
+        if self._refresh_margin_cells:
+            margin = partial(refresh_agg_product_margin, cells=self.margin_cells)
+        else:
+            margin = partial(load_agg_product_margin, tables=self.shadow_tables)
+        return {
+            "agg_market_basket":  partial(self.load_market_basket, tables=self.shadow_tables),
+            "agg_product_margin": margin,
+        }
+
+    def _load_aggregations(self):
+        """Calcula las tablas de agregación de ventas en paralelo."""
+        AggregationStage(self.aggregation_tasks(), self.aggregation_workers).run()
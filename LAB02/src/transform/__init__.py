@@ -1,12 +1,23 @@
 """
 Transformaciones para el ETL de AdventureWorks.
 Convierte datos OLTP crudos al formato OLAP (dimensiones y hechos).
+
+`transform_fact_sales_batch` es la versión vectorizada de `transform_fact_sales`
+para batches columnares: opera con enteros escalados (valor × 10^4) en NumPy,
+de modo que los resultados coinciden exactamente con Numeric(19,4).
+
+Las filas de dim_customer, dim_product y dim_territory llevan `row_hash`, un
+hash del contenido que permite al upsert reescribir solo las filas que cambiaron.
 """
+import hashlib
 import logging
 from datetime import date, datetime
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP, localcontext
 from typing import Optional
 
+import numpy as np
+import pandas as pd
+
 from src.utils.helpers import (
     date_to_key, get_quarter, get_fiscal_year,
     get_fiscal_quarter, price_range
@@ -40,20 +51,72 @@ def transform_date(d: date) -> dict:
     }
 
 
+def transform_dates(days) -> pd.DataFrame:
+    """
+    Versión vectorizada de transform_date para un conjunto de días (DatetimeIndex
+    o fechas): una fila de dim_date por día, con los mismos valores.
+    """
+    days = pd.DatetimeIndex(days).normalize()
+    year, month, day = days.year.to_numpy(), days.month.to_numpy(), days.day.to_numpy()
+    weekday = days.weekday.to_numpy()            # 0=Monday ... 6=Sunday
+    dow = (weekday + 1) % 7                      # 0=Sunday ... 6=Saturday
+    fiscal_month = (month - 7) % 12              # año fiscal desde julio (ver utils.helpers)
+    return pd.DataFrame({
+        "date_key":       year * 10000 + month * 100 + day,
+        "full_date":      days.date,
+        "year":           year,
+        "quarter":        (month - 1) // 3 + 1,
+        "month":          month,
+        "month_name":     np.array(MONTHS)[month - 1],
+        # %W: semanas que empiezan el lunes; los días previos al primer lunes son la semana 0
+        "week_of_year":   (days.dayofyear.to_numpy() - 1 - weekday + 7) // 7,
+        "day_of_month":   day,
+        "day_of_week":    dow,
+        "day_name":       np.array(DAYS)[dow],
+        "is_weekend":     (dow == 0) | (dow == 6),
+        "fiscal_year":    np.where(month >= 7, year + 1, year),
+        "fiscal_quarter": fiscal_month // 3 + 1,
+    })
+
+
+def _hash_value(value) -> str:
+    """Representación estable de un valor: 12.5 y Decimal("12.5000") coinciden."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (int, float, Decimal)):
+        return format(Decimal(str(value)).normalize(), "f")
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def row_hash(row: dict) -> str:
+    """MD5 (hex, 32 caracteres) del contenido de una fila de dimensión, en el orden de sus claves."""
+    content = "\x1f".join(_hash_value(v) for v in row.values())
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+
+def _with_hash(row: dict) -> dict:
+    row["row_hash"] = row_hash(row)
+    return row
+
+
 def transform_territory(row: dict) -> dict:
     """Transforma una fila de territory al formato de dim_territory."""
-    return {
+    return _with_hash({
         "territory_id":   row["territory_id"],
         "territory_name": row["territory_name"],
         "country_code":   row["country_code"],
         "region_group":   row["region_group"],
-    }
+    })
 
 
 def transform_product(row: dict) -> dict:
     """Transforma una fila de producto al formato de dim_product."""
     cat_name = row.get("category_name") or ""
-    return {
+    return _with_hash({
         "product_id":       row["product_id"],
         "product_number":   row["product_number"],
         "product_name":     row["product_name"],
@@ -68,7 +131,7 @@ def transform_product(row: dict) -> dict:
         "category_name":    cat_name,
         "is_bike":          cat_name == "Bikes",
         "is_accessory":     cat_name == "Accessories",
-    }
+    })
 
 
 def transform_customer(row: dict, first_order_date: Optional[date] = None) -> dict:
@@ -81,7 +144,7 @@ def transform_customer(row: dict, first_order_date: Optional[date] = None) -> di
         cohort_year  = first_order_date.year
         cohort_month = first_order_date.month
 
-    return {
+    return _with_hash({
         "customer_id":      row["customer_id"],
         "account_number":   row["account_number"],
         "first_name":       row.get("first_name"),
@@ -95,7 +158,7 @@ def transform_customer(row: dict, first_order_date: Optional[date] = None) -> di
         "cohort_year":      cohort_year,
         "cohort_month":     cohort_month,
         "cohort_key":       cohort_key,
-    }
+    })
 
 
 def transform_fact_sales(row: dict, customer_key: int, product_key: int,
@@ -136,23 +199,18 @@ def transform_fact_sales(row: dict, customer_key: int, product_key: int,
         raise TransformationError(f"Error transformando fact_sales: {e}") from e
 
 
-def transform_fact_orders(row: dict, customer_key: int, territory_key: int,
-                           customer_order_number: int, first_order_date: Optional[date]) -> dict:
-    """Transforma una cabecera de orden al formato de fact_orders."""
+def transform_fact_orders(row: dict, customer_key: int, territory_key: int) -> dict:
+    """
+    Transforma una cabecera de orden al formato de fact_orders.
+    customer_order_number, is_first_order, is_recurring y months_since_first
+    vienen calculados por el query de extracción (ventanas por cliente).
+    """
     try:
         order_date = row["order_date"]
         if isinstance(order_date, datetime):
             order_date = order_date.date()
 
-        is_first   = customer_order_number == 1
-        is_recurring = customer_order_number > 1
-
-        months_since = None
-        if first_order_date:
-            delta = (order_date.year - first_order_date.year) * 12 + \
-                    (order_date.month - first_order_date.month)
-            months_since = delta
-
+        months_since = row.get("months_since_first")
         return {
             "date_key":             date_to_key(order_date),
             "customer_key":         customer_key,
@@ -163,10 +221,189 @@ def transform_fact_orders(row: dict, customer_key: int, territory_key: int,
             "freight":              Decimal(str(row["freight"])),
             "total_due":            Decimal(str(row["total_due"])),
             "line_count":           int(row["line_count"]),
-            "customer_order_number":customer_order_number,
-            "is_first_order":       is_first,
-            "is_recurring":         is_recurring,
-            "months_since_first":   months_since,
+            "customer_order_number":int(row["customer_order_number"]),
+            "is_first_order":       bool(row["is_first_order"]),
+            "is_recurring":         bool(row["is_recurring"]),
+            "months_since_first":   None if months_since is None else int(months_since),
         }
     except Exception as e:
         raise TransformationError(f"Error transformando fact_orders: {e}") from e
+
+
+# ── Batch (vectorizado) ─────────────────────────────────────────────────────
+
+SCALE = 10_000          # 4 decimales de Numeric(19,4)
+# Columnas de importes de fact_sales: en los batches columnares van como int64 × SCALE
+FACT_SALES_AMOUNTS = ("unit_price", "unit_price_discount", "standard_cost",
+                      "line_total", "cost_total", "gross_margin", "gross_margin_pct")
+# Por debajo de este valor absoluto, float64 × 10^4 redondeado es exacto
+# para importes con hasta 4 decimales (error < 0.5 unidades escaladas).
+# Solo acota la conversión: los productos a escala 10^8 de
+# transform_fact_sales_batch se controlan aparte (ver _overflow_rows)
+_FLOAT_EXACT_LIMIT = 1e11
+# Cota de los intermedios en int64; 2^62 deja margen al error de la estimación en float64
+_INT64_SAFE = float(2 ** 62)
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _to_scaled(values) -> np.ndarray:
+    """
+    Convierte una columna numérica (Decimal, str, int, float) a int64 × 10^4.
+    Los importes del OLTP tienen a lo sumo 4 decimales, así que la conversión
+    vectorizada vía float64 es exacta bajo _FLOAT_EXACT_LIMIT; solo valores
+    mayores (o no numéricos) pasan por Decimal valor a valor.
+    """
+    series = pd.Series(values, copy=False)
+    if series.dtype.kind in "iu" and np.abs(series.to_numpy()).max(initial=0) <= _INT64_MAX // SCALE:
+        return series.to_numpy(dtype=np.int64) * SCALE
+    try:
+        floats = series.to_numpy(dtype=np.float64)
+    except (TypeError, ValueError):
+        floats = None
+    if floats is not None and np.isfinite(floats).all() \
+            and np.abs(floats).max(initial=0) < _FLOAT_EXACT_LIMIT:
+        return np.rint(floats * SCALE).astype(np.int64)
+    return np.fromiter((int(Decimal(str(v)).scaleb(4)) for v in series),
+                       dtype=np.int64, count=len(series))
+
+
+def scaled_to_decimal(values) -> list[Decimal]:
+    """Convierte enteros escalados × 10^4 a Decimal con 4 decimales (rutas por fila)."""
+    return [Decimal(int(v)).scaleb(-4) for v in values]
+
+
+def _div_half_away(num: np.ndarray, den: int) -> np.ndarray:
+    """num / den redondeado a entero, mitades lejos del cero (como NUMERIC en PostgreSQL)."""
+    q, r = np.divmod(np.abs(num), den)
+    return np.sign(num) * (q + (2 * r >= den))
+
+
+def _pct_half_even(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    """
+    num / den * 100 con 4 decimales (× 10^4), redondeo half-even como round(Decimal, 4).
+    División larga en pasos de 10^3 para no desbordar int64; requiere den > 0.
+    """
+    q, r = np.divmod(np.abs(num), den)
+    for _ in range(2):                       # × 10^6 = × 100 (porcentaje) × 10^4 (escala)
+        step, r = np.divmod(r * 1000, den)
+        q = q * 1000 + step
+    twice = 2 * r
+    q = q + ((twice > den) | ((twice == den) & (q % 2 == 1)))
+    return np.sign(num) * q
+
+
+def _overflow_rows(qty: np.ndarray, price: np.ndarray, discount: np.ndarray,
+                   std_cost: np.ndarray) -> np.ndarray:
+    """
+    Filas cuyos intermedios podrían desbordar int64: line_total y cost_total a
+    escala 10^8, `r * 1000` en _pct_half_even (r < line_total) y el cociente del
+    porcentaje (|margen| / line_total × 10^6). Se estiman en float64.
+    """
+    qty = np.abs(qty.astype(np.float64))
+    line = qty * np.abs(price.astype(np.float64)) * np.abs((SCALE - discount).astype(np.float64))
+    cost = qty * np.abs(std_cost.astype(np.float64)) * SCALE
+    ratio = np.divide(line + cost, line, out=np.zeros_like(line), where=line > 0)
+    return (line + cost >= _INT64_SAFE) | (line * 1000 >= _INT64_SAFE) | (ratio * 1e6 >= _INT64_SAFE)
+
+
+def _scaled_amounts(qty: np.ndarray, price: np.ndarray, discount: np.ndarray,
+                    std_cost: np.ndarray) -> tuple[np.ndarray, ...]:
+    """line_total, cost_total, gross_margin y gross_margin_pct (× 10^4) en int64."""
+    # Escala 10^8: qty * precio(10^4) * (1 - descuento)(10^4), exacto
+    line_total = qty * price * (SCALE - discount)
+    cost_total = qty * std_cost * SCALE
+    margin     = line_total - cost_total
+    margin_pct = np.zeros(len(qty), dtype=np.int64)
+    positive   = line_total > 0
+    margin_pct[positive] = _pct_half_even(margin[positive], line_total[positive])
+    return (_div_half_away(line_total, SCALE), _div_half_away(cost_total, SCALE),
+            _div_half_away(margin, SCALE), margin_pct)
+
+
+def _scaled_amounts_decimal(qty: np.ndarray, price: np.ndarray, discount: np.ndarray,
+                            std_cost: np.ndarray, detail_ids: np.ndarray) -> tuple[np.ndarray, ...]:
+    """
+    Igual que _scaled_amounts, pero fila a fila con Decimal (filas de _overflow_rows).
+    Un resultado que no cabe en int64 × 10^4 se rechaza con TransformationError.
+    """
+    out = tuple(np.empty(len(qty), dtype=np.int64) for _ in range(4))
+    with localcontext() as ctx:
+        ctx.prec = 60                        # exacto para Numeric(19,4) × SMALLINT
+        for i, (q, p, d, c) in enumerate(zip(qty.tolist(), price.tolist(),
+                                             discount.tolist(), std_cost.tolist())):
+            line_total = q * Decimal(p).scaleb(-4) * (1 - Decimal(d).scaleb(-4))
+            cost_total = q * Decimal(c).scaleb(-4)
+            margin     = line_total - cost_total
+            margin_pct = (margin / line_total * 100) if line_total > 0 else Decimal(0)
+            values = [v.scaleb(4).to_integral_value(ROUND_HALF_UP)
+                      for v in (line_total, cost_total, margin)]
+            values.append(round(margin_pct, 4).scaleb(4))
+            for column, value in zip(out, values):
+                value = int(value)
+                if not _INT64_MIN <= value <= _INT64_MAX:
+                    raise TransformationError(
+                        f"Importe fuera de rango en la línea {detail_ids[i]}: {value} × 10^-4"
+                    )
+                column[i] = value
+    return out
+
+
+def transform_fact_sales_batch(frame: pd.DataFrame, customer_keys, product_keys,
+                               territory_keys) -> pd.DataFrame:
+    """
+    Transforma un batch columnar de líneas de orden al formato de fact_sales.
+    Las claves surrogadas vienen alineadas con las filas de `frame`.
+    Equivalente a aplicar transform_fact_sales fila por fila (redondeado a 4
+    decimales), pero los importes (FACT_SALES_AMOUNTS) quedan como int64 × SCALE:
+    el COPY los formatea directamente y el resto de los loaders los convierte.
+    Las filas con importes que desbordarían int64 se calculan con Decimal.
+    """
+    try:
+        qty        = frame["order_qty"].to_numpy(dtype=np.int64)
+        price      = _to_scaled(frame["unit_price"])
+        discount   = _to_scaled(frame["unit_price_discount"])
+        std_cost   = _to_scaled(frame["standard_cost"])
+        detail_ids = frame["sales_order_detail_id"].to_numpy(dtype=np.int64)
+
+        wide = _overflow_rows(qty, price, discount, std_cost)
+        if not wide.any():
+            amounts = _scaled_amounts(qty, price, discount, std_cost)
+        else:
+            narrow = ~wide
+            amounts = tuple(np.empty(len(frame), dtype=np.int64) for _ in range(4))
+            for column, values in zip(amounts, _scaled_amounts(
+                    qty[narrow], price[narrow], discount[narrow], std_cost[narrow])):
+                column[narrow] = values
+            for column, values in zip(amounts, _scaled_amounts_decimal(
+                    qty[wide], price[wide], discount[wide], std_cost[wide], detail_ids[wide])):
+                column[wide] = values
+        line_total, cost_total, margin, margin_pct = amounts
+
+        order_date = pd.to_datetime(frame["order_date"])
+        date_key   = (order_date.dt.year * 10000 + order_date.dt.month * 100
+                      + order_date.dt.day).to_numpy(dtype=np.int64)
+
+        if "is_online" in frame:
+            is_online = frame["is_online"].fillna(False).astype(bool).to_numpy()
+        else:
+            is_online = np.zeros(len(frame), dtype=bool)
+
+        return pd.DataFrame({
+            "date_key":              date_key,
+            "customer_key":          np.asarray(customer_keys, dtype=np.int64),
+            "product_key":           np.asarray(product_keys, dtype=np.int64),
+            "territory_key":         np.asarray(territory_keys, dtype=np.int64),
+            "sales_order_id":        frame["sales_order_id"].to_numpy(dtype=np.int64),
+            "sales_order_detail_id": detail_ids,
+            "order_qty":             qty,
+            "unit_price":            price,
+            "unit_price_discount":   discount,
+            "standard_cost":         std_cost,
+            "line_total":            line_total,
+            "cost_total":            cost_total,
+            "gross_margin":          margin,
+            "gross_margin_pct":      margin_pct,
+            "is_online":             is_online,
+        })
+    except Exception as e:
+        raise TransformationError(f"Error transformando batch de fact_sales: {e}") from e
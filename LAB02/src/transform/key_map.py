@@ -0,0 +1,75 @@
+"""
+Mapas de claves surrogadas respaldados por arreglos NumPy.
+
+Los ids del OLTP son enteros densos, así que {id: clave} se guarda como un
+arreglo indexado por (id - id mínimo), int32 y MISSING = 0 para ids sin clave
+(las claves serial empiezan en 1). Resolver las claves de un batch es un solo
+gather `keys[ids - base]` en lugar de un lookup de dict por línea. Si los ids son demasiado
+dispersos para un arreglo denso se usan ids ordenados + searchsorted, con la
+misma interfaz.
+"""
+import numpy as np
+import pandas as pd
+
+MISSING = 0
+# Hasta este factor (posiciones del arreglo / claves) se usa el arreglo denso
+DENSE_FILL_LIMIT = 8
+
+
+def _as_ids(ids) -> tuple[np.ndarray, np.ndarray]:
+    """Ids como int64 y máscara de ids nulos (None/NaN, p. ej. territory_id), sin clave."""
+    if isinstance(ids, np.ndarray) and ids.dtype.kind in "iu":
+        return ids.astype(np.int64, copy=False), np.zeros(len(ids), dtype=bool)
+    ids = pd.Series(ids, copy=False)
+    null = ids.isna().to_numpy()
+    return ids.fillna(0).to_numpy(dtype=np.int64), null
+
+
+class KeyMap:
+    """{id natural: clave surrogada} con lookup vectorizado de columnas completas."""
+
+    def __init__(self, ids, keys):
+        ids = np.asarray(ids, dtype=np.int64)
+        keys = np.asarray(keys, dtype=np.int32)
+        self.size = len(ids)
+        self.base = int(ids.min()) if self.size else 0
+        span = int(ids.max()) - self.base + 1 if self.size else 0
+        self.dense = span <= DENSE_FILL_LIMIT * self.size
+        if self.dense:
+            self.keys = np.full(span, MISSING, dtype=np.int32)
+            self.keys[ids - self.base] = keys
+        else:
+            order = np.argsort(ids)
+            self.ids, self.keys = ids[order], keys[order]
+
+    @classmethod
+    def from_dict(cls, mapping: dict) -> "KeyMap":
+        return cls(np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping)),
+                   np.fromiter(mapping.values(), dtype=np.int64, count=len(mapping)))
+
+    def lookup(self, ids) -> np.ndarray:
+        """Claves de `ids` (alineadas); MISSING donde el id no tiene clave."""
+        ids, null = _as_ids(ids)
+        keys = np.full(len(ids), MISSING, dtype=np.int32)
+        if self.dense:
+            pos = ids - self.base
+            valid = (pos >= 0) & (pos < len(self.keys)) & ~null
+            keys[valid] = self.keys[pos[valid]]
+        else:
+            pos = np.searchsorted(self.ids, ids).clip(max=self.size - 1)
+            found = (self.ids[pos] == ids) & ~null
+            keys[found] = self.keys[pos[found]]
+        return keys
+
+    def get(self, natural_id, default=None):
+        """Lookup de un solo id (interfaz de dict)."""
+        if natural_id is None:
+            return default
+        key = int(self.lookup(np.array([natural_id], dtype=np.int64))[0])
+        return default if key == MISSING else key
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, natural_id) -> bool:
+        return self.get(natural_id) is not None
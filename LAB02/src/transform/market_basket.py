@@ -0,0 +1,176 @@
+"""
+Market basket con álgebra de matrices dispersas (NumPy).
+
+Las líneas de fact_sales forman una matriz de incidencia binaria A
+(orden × producto) en formato CSR. Las co-ocurrencias de cada par de productos
+son el triángulo superior (sin diagonal) de Aᵀ·A: por cada fila con k productos
+distintos se generan sus k(k-1)/2 pares, agrupando las filas por largo para
+hacerlo vectorizado. El resultado es el mismo que el self-join de
+`load_agg_market_basket` (COUNT(DISTINCT orden) por par, LEAST/GREATEST y
+support = ROUND(co_occurrences / total_orders, 6)).
+
+`BasketAccumulator` arma A por bloques de filas a medida que llegan los batches
+(líneas ordenadas por orden) y acumula Aᵀ·A = Σ A_bᵀ·A_b: ni las líneas ni la
+matriz completa quedan en memoria, solo los conteos por par.
+"""
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+SUPPORT_DECIMALS = 6
+# Con hasta esta cantidad de celdas P×P las co-ocurrencias se acumulan en un
+# arreglo denso (bincount) que vive durante toda la acumulación: 1 << 22 celdas
+# int64 son 32 MB (hasta ~2000 productos). Con más se acumulan solo los pares
+# presentes (orden + reduceat)
+DENSE_PAIR_LIMIT = 1 << 22
+# Modo disperso: los pares de los bloques se reducen junto con los ya
+# acumulados cuando suman al menos esta cantidad (o tantos como los acumulados)
+SPARSE_MERGE_CODES = 1 << 20
+
+COLUMNS = ["product_key_a", "product_key_b", "co_occurrences", "support"]
+
+
+def incidence_csr(order_ids: np.ndarray, cols: np.ndarray,
+                  n_cols: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Matriz de incidencia binaria orden × columna en CSR: (indptr, indices),
+    una fila por orden distinta y las columnas de cada fila ordenadas.
+    """
+    orders, row = np.unique(order_ids, return_inverse=True)
+    # Una orden con el mismo producto en dos líneas cuenta una vez
+    cells = np.unique(row.astype(np.int64) * n_cols + cols)
+    rows, indices = np.divmod(cells, n_cols)
+    indptr = np.searchsorted(rows, np.arange(len(orders) + 1))
+    return indptr, indices
+
+
+def cooccurrence_codes(indptr: np.ndarray, indices: np.ndarray, n_cols: int) -> np.ndarray:
+    """Pares (col_a < col_b) de cada fila como col_a * n_cols + col_b, uno por fila y par."""
+    sizes = np.diff(indptr)
+    codes = []
+    for k in np.unique(sizes[sizes > 1]):
+        starts = indptr[:-1][sizes == k]
+        block = indices[starts[:, None] + np.arange(k)]   # (filas, k), columnas crecientes
+        i, j = np.triu_indices(k, 1)
+        codes.append((block[:, i] * n_cols + block[:, j]).ravel())
+    return np.concatenate(codes) if codes else np.empty(0, dtype=np.int64)
+
+
+def support_decimal(co_occurrences: np.ndarray, total_orders: int) -> list[Decimal]:
+    """co / total redondeado a 6 decimales (mitad hacia arriba, como ROUND de numeric)."""
+    scale = 10 ** SUPPORT_DECIMALS
+    scaled = (2 * co_occurrences.astype(np.int64) * scale + total_orders) // (2 * total_orders)
+    return [Decimal(int(v)).scaleb(-SUPPORT_DECIMALS) for v in scaled]
+
+
+class BasketAccumulator:
+    """
+    Triángulo superior de Aᵀ·A acumulado por batches de líneas (orden, columna).
+    Las líneas deben llegar ordenadas por orden; una orden puede seguir en el
+    batch siguiente, así que la última de cada batch queda pendiente hasta ver
+    otra (o hasta `frame`). Las columnas van de 0 a n_cols - 1.
+    """
+
+    def __init__(self, n_cols: int):
+        self.n_cols = n_cols
+        self.total_orders = 0
+        self._pending = np.empty((0, 2), dtype=np.int64)
+        cells = n_cols * n_cols
+        self._dense = np.zeros(cells, dtype=np.int64) if cells <= DENSE_PAIR_LIMIT else None
+        self._codes = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._buffer: list[np.ndarray] = []
+        self._buffered = 0
+
+    def add(self, order_ids, cols):
+        """Agrega un batch de líneas; solo se procesan las órdenes ya completas."""
+        lines = np.column_stack((np.asarray(order_ids, dtype=np.int64),
+                                 np.asarray(cols, dtype=np.int64)))
+        if not len(lines):
+            return
+        if lines[:, 1].min() < 0 or lines[:, 1].max() >= self.n_cols:
+            raise ValueError(f"Columna fuera de rango [0, {self.n_cols}) en market basket")
+        lines = np.concatenate((self._pending, lines))
+        if (np.diff(lines[:, 0]) < 0).any():
+            raise ValueError("Las líneas del market basket no llegan ordenadas por orden")
+        last = np.searchsorted(lines[:, 0], lines[-1, 0])
+        self._pending = lines[last:]
+        self._add_block(lines[:last])
+
+    def _add_block(self, lines: np.ndarray):
+        if not len(lines):
+            return
+        indptr, indices = incidence_csr(lines[:, 0], lines[:, 1], self.n_cols)
+        self.total_orders += len(indptr) - 1
+        codes = cooccurrence_codes(indptr, indices, self.n_cols)
+        if self._dense is not None:
+            self._dense += np.bincount(codes, minlength=len(self._dense))
+            return
+        self._buffer.append(codes)
+        self._buffered += len(codes)
+        if self._buffered >= max(len(self._codes), SPARSE_MERGE_CODES):
+            self._merge()
+
+    def _merge(self):
+        """Reduce los pares del buffer junto con los acumulados (un conteo por par)."""
+        codes = np.concatenate([self._codes] + self._buffer)
+        counts = np.concatenate([self._counts] + [np.ones(len(b), dtype=np.int64)
+                                                  for b in self._buffer])
+        self._buffer, self._buffered = [], 0
+        if not len(codes):
+            return
+        order = np.argsort(codes, kind="stable")
+        codes, counts = codes[order], counts[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        self._codes, self._counts = codes[starts], np.add.reduceat(counts, starts)
+
+    def pairs(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Cierra la orden pendiente y retorna (col_a, col_b, conteo), sin ceros."""
+        self._add_block(self._pending)
+        self._pending = self._pending[:0]
+        if self._dense is not None:
+            codes = np.flatnonzero(self._dense)
+            counts = self._dense[codes]
+        else:
+            self._merge()
+            codes, counts = self._codes, self._counts
+        col_a, col_b = np.divmod(codes, self.n_cols)
+        return col_a, col_b, counts
+
+    def frame(self, products: np.ndarray | None = None) -> pd.DataFrame:
+        """
+        Pares con las columnas de agg_market_basket, ordenados por co_occurrences
+        descendente. `products[col]` es la product_key de cada columna (sin
+        `products`, la columna ya es la product_key).
+        """
+        col_a, col_b, counts = self.pairs()
+        if not len(counts):
+            return pd.DataFrame(columns=COLUMNS)
+        order = np.lexsort((col_b, col_a, -counts))
+        col_a, col_b, counts = col_a[order], col_b[order], counts[order]
+        if products is not None:
+            col_a, col_b = products[col_a], products[col_b]
+        return pd.DataFrame({
+            "product_key_a":  col_a,
+            "product_key_b":  col_b,
+            "co_occurrences": counts,
+            "support":        support_decimal(counts, self.total_orders),
+        }, columns=COLUMNS)
+
+
+def basket_pairs(order_ids, product_keys) -> pd.DataFrame:
+    """
+    Pares de productos comprados en la misma orden, con las columnas de
+    agg_market_basket, ordenados por co_occurrences descendente.
+    """
+    order_ids = np.asarray(order_ids, dtype=np.int64)
+    product_keys = np.asarray(product_keys, dtype=np.int64)
+    if len(order_ids) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+
+    products, cols = np.unique(product_keys, return_inverse=True)
+    order = np.argsort(order_ids, kind="stable")
+    accumulator = BasketAccumulator(len(products))
+    accumulator.add(order_ids[order], cols[order])
+    return accumulator.frame(products)
@@ -45,6 +45,19 @@ def chunked(iterable, size: int):
         yield chunk
 
 
+def split_range(lo: int, hi: int, parts: int) -> list[tuple[int, int]]:
+    """Divide el rango entero [lo, hi] en hasta `parts` sub-rangos contiguos (inclusive)."""
+    parts = max(1, min(parts, hi - lo + 1))
+    step, extra = divmod(hi - lo + 1, parts)
+    ranges = []
+    start = lo
+    for i in range(parts):
+        end = start + step - 1 + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+
 def price_range(price: float) -> str:
     """Clasifica un precio en rango Low/Mid/High."""
     if price < 100:
@@ -0,0 +1,342 @@
+"""Tests para el módulo de extracción (sin base de datos real — mock)."""
+import unittest
+from contextlib import contextmanager
+from unittest.mock import MagicMock, patch
+
+from datetime import datetime
+from decimal import Decimal
+
+import pandas as pd
+
+from src.extract import create_extractor
+from src.extract.copy_extractor import CopyExtractor
+from src.extract.extractor_base import ExtractorBase
+from src.extract.sql_extractor import SQLExtractor, ExtractionCache, ORDER_HEADER_COLUMNS
+from src.utils.exceptions import ExtractionError
+
+
+def _fake_session(keys, rows):
+    """Sesión mock cuyo resultado entrega `rows` en particiones."""
+    result = MagicMock()
+    result.keys.return_value = keys
+    result.partitions.side_effect = lambda size: (
+        rows[i:i + size] for i in range(0, len(rows), size)
+    )
+    session = MagicMock()
+    session.execute.return_value = result
+
+    @contextmanager
+    def factory():
+        yield session
+    return factory, session
+
+
+class TestSQLExtractorStreaming(unittest.TestCase):
+    def setUp(self):
+        self.keys = ["customer_id", "account_number"]
+        self.rows = [(i, f"AW{i:08d}") for i in range(1, 6)]
+
+    def test_stream_uses_server_side_cursor(self):
+        factory, session = _fake_session(self.keys, self.rows)
+        extractor = SQLExtractor(batch_size=2, stream_results=True)
+        with patch("src.extract.sql_extractor.oltp_session", factory):
+            batches = list(extractor.extract("SELECT 1"))
+        options = session.execute.call_args.kwargs["execution_options"]
+        self.assertEqual(options, {"stream_results": True, "yield_per": 2})
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertEqual(batches[0][0], {"customer_id": 1, "account_number": "AW00000001"})
+
+    def test_buffered_mode_has_no_stream_options(self):
+        factory, session = _fake_session(self.keys, self.rows)
+        extractor = SQLExtractor(batch_size=10, stream_results=False)
+        with patch("src.extract.sql_extractor.oltp_session", factory):
+            batches = list(extractor.extract("SELECT 1"))
+        self.assertEqual(session.execute.call_args.kwargs["execution_options"], {})
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 5)
+
+    def test_incremental_uses_changed_query(self):
+        extractor = SQLExtractor(batch_size=10)
+        since = {"header_since": "2014-06-01", "detail_since": "2014-06-01"}
+        with patch.object(extractor, "extract_columnar", return_value=iter([])) as extract:
+            list(extractor.extract_orders(since))
+        query, params = extract.call_args.args
+        self.assertIn(":header_since", query)
+        self.assertEqual(params, since)
+
+
+class TestColumnarExtract(unittest.TestCase):
+    def test_sql_extractor_yields_frames(self):
+        keys = ["sales_order_id", "territory_id"]
+        rows = [(1, 4), (2, None), (3, 6)]
+        factory, _ = _fake_session(keys, rows)
+        extractor = SQLExtractor(batch_size=2)
+        with patch("src.extract.sql_extractor.oltp_session", factory):
+            frames = list(extractor.extract_columnar("SELECT 1"))
+        self.assertEqual([len(f) for f in frames], [2, 1])
+        self.assertEqual(list(frames[0].columns), keys)
+        self.assertEqual(frames[0]["sales_order_id"].tolist(), [1, 2])
+        self.assertTrue(pd.isna(frames[0]["territory_id"].iloc[1]))
+
+    def test_base_default_converts_dict_batches(self):
+        class ListExtractor(ExtractorBase):
+            def extract(self, **kwargs):
+                yield [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}]
+
+        frames = list(ListExtractor().extract_columnar())
+        self.assertEqual(frames[0]["b"].tolist(), ["x", "y"])
+
+
+class TestCopyExtractor(unittest.TestCase):
+    # FORCE_QUOTE *: solo los NULL (NaN) van sin comillas
+    CSV = (b'"43659","1","2011-05-31 00:00:00","t","3578.2700",NaN\n'
+           b'"43659","2","2011-05-31 00:00:00","f","2024.9940","Road, 58"\n'
+           b'"43660","1","2011-06-01 00:00:00","t","2039.9940","\\N"\n')
+
+    def _engine(self):
+        description = [MagicMock(type_code=t) for t in (23, 23, 1114, 16, 1700, 25)]
+        for col, name in zip(description, ["sales_order_id", "sales_order_detail_id",
+                                           "order_date", "is_online", "unit_price", "color"]):
+            col.name = name
+        cursor = MagicMock()
+        cursor.description = description
+        cursor.copy_expert.side_effect = lambda sql, f: f.write(self.CSV)
+        cursor.__enter__.return_value = cursor
+        connection = MagicMock()
+        connection.dbapi_connection.cursor.return_value = cursor
+        engine = MagicMock()
+        engine.raw_connection.return_value = connection
+        return engine, cursor, connection
+
+    def test_copy_rows_are_typed(self):
+        engine, cursor, connection = self._engine()
+        extractor = CopyExtractor(batch_size=2)
+        with patch("src.extract.copy_extractor.get_oltp_engine", return_value=engine):
+            batches = list(extractor.extract("SELECT * FROM t WHERE a > :since",
+                                             {"since": datetime(2014, 6, 1)}))
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        first = batches[0][0]
+        self.assertEqual(first["sales_order_id"], 43659)
+        self.assertEqual(first["order_date"], datetime(2011, 5, 31))
+        self.assertIs(first["is_online"], True)
+        self.assertEqual(first["unit_price"], Decimal("3578.2700"))
+        self.assertIsNone(first["color"])
+        self.assertEqual(batches[0][1]["color"], "Road, 58")
+        # Un texto igual al marcador de NULL de COPY no se confunde con NULL
+        self.assertEqual(batches[1][0]["color"], "\\N")
+        copy_sql = cursor.copy_expert.call_args.args[0]
+        self.assertTrue(copy_sql.startswith("COPY (SELECT * FROM t WHERE a > '2014-06-01 00:00:00')"))
+        self.assertIn("FORCE_QUOTE *", copy_sql)
+        connection.close.assert_called_once()
+
+    def test_copy_columnar(self):
+        engine, _, _ = self._engine()
+        extractor = CopyExtractor(batch_size=10)
+        with patch("src.extract.copy_extractor.get_oltp_engine", return_value=engine):
+            frames = list(extractor.extract_columnar("SELECT 1"))
+        self.assertEqual(frames[0]["sales_order_id"].tolist(), [43659, 43659, 43660])
+
+    def test_create_extractor_backend(self):
+        self.assertIsInstance(create_extractor("copy"), CopyExtractor)
+        with self.assertRaises(ValueError):
+            create_extractor("odbc")
+
+
+class TestExtractionCache(unittest.TestCase):
+    def test_small_results_are_shared_across_extractors(self):
+        factory, session = _fake_session(["territory_id", "territory_name"],
+                                         [(1, "Northwest"), (2, "Northeast")])
+        cache = ExtractionCache()
+        with patch("src.extract.sql_extractor.oltp_session", factory), \
+             self.assertLogs("src.extract.sql_extractor", level="INFO") as logs:
+            first = list(SQLExtractor(cache=cache).extract_territories())
+            second = list(SQLExtractor(cache=cache).extract_territories())
+        self.assertEqual(first, second)
+        self.assertEqual(session.execute.call_count, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertTrue(any("miss" in line for line in logs.output))
+        self.assertTrue(any("hit" in line for line in logs.output))
+
+    def test_params_are_part_of_the_key(self):
+        factory, session = _fake_session(["a"], [(1,)])
+        extractor = SQLExtractor(cache=ExtractionCache())
+        with patch("src.extract.sql_extractor.oltp_session", factory):
+            list(extractor.extract("SELECT a", {"x": 1}, cacheable=True))
+            list(extractor.extract("SELECT a", {"x": 2}, cacheable=True))
+            list(extractor.extract("SELECT a", {"x": 1}, cacheable=True))
+        self.assertEqual(session.execute.call_count, 2)
+
+    def test_streams_are_not_materialized(self):
+        factory, session = _fake_session(["a"], [(1,)])
+        cache = ExtractionCache()
+        extractor = SQLExtractor(cache=cache)
+        with patch("src.extract.sql_extractor.oltp_session", factory):
+            list(extractor.extract("SELECT a"))
+            list(extractor.extract("SELECT a"))
+        self.assertEqual(session.execute.call_count, 2)
+        self.assertEqual(cache.misses, 2)
+
+    def test_territories_hit_across_pipelines(self):
+        """Como en main: CustomerPipeline extrae territorios y SalesPipeline los reutiliza."""
+        from src.pipelines.customer_pipeline import CustomerPipeline
+        from src.pipelines.sales_pipeline import SalesPipeline
+        territories = (["territory_id", "territory_name", "country_code", "region_group"],
+                       [(1, "Northwest", "US", "North America")])
+        customers = (["customer_id", "account_number", "territory_id"], [(11000, "AW11000", 1)])
+        queries = []
+
+        def execute(query, params=None, **kwargs):
+            queries.append(str(query))
+            keys, rows = territories if "sales_territory" in str(query) else customers
+            return _fake_session(keys, rows)[1].execute()
+
+        factory, session = _fake_session([], [])
+        session.execute.side_effect = execute
+        cache = ExtractionCache()
+        with patch("src.extract.sql_extractor.oltp_session", factory), \
+             patch("src.pipelines.customer_pipeline.load_dim_customers") as load_customers, \
+             patch("src.pipelines.customer_pipeline.olap_session"), \
+             patch("src.pipelines.customer_pipeline.SurrogateKeyCache"), \
+             patch("src.pipelines.sales_pipeline.load_dim_territories") as load_territories, \
+             patch("src.pipelines.sales_pipeline.olap_session"), \
+             patch("src.pipelines.sales_pipeline.SurrogateKeyCache") as key_cache:
+            key_cache.return_value.resolve.return_value = {1: 1}
+            CustomerPipeline(cache)._load_dim_customer({})
+            SalesPipeline(extraction_cache=cache)._load_dim_territory()
+
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(sum("sales_territory" in q for q in queries), 1)
+        customer = load_customers.call_args.args[1][0]
+        self.assertEqual(customer["territory_name"], "Northwest")
+        self.assertEqual(load_territories.call_args.args[1][0]["region_group"], "North America")
+
+    def test_order_lines_do_not_join_products(self):
+        self.assertNotIn("production.product", SQLExtractor.QUERY_ORDERS)
+        self.assertNotIn("standard_cost", SQLExtractor.QUERY_ORDERS_CHANGED)
+
+    def test_standard_cost_comes_from_product_extract(self):
+        from src.pipelines.sales_pipeline import SalesPipeline
+        pipeline = SalesPipeline()
+        pipeline.product_costs = pd.Series({707: Decimal("13.0863"), 708: Decimal("0.0000")},
+                                           dtype=object)
+        frame = pd.DataFrame({"product_id": [708, 707, 999]})
+        costs = pipeline._with_standard_cost(frame)["standard_cost"].tolist()
+        self.assertEqual(costs[:2], [Decimal("0.0000"), Decimal("13.0863")])
+        self.assertTrue(pd.isna(costs[2]))
+
+
+class TestSQLExtractorOrders(unittest.TestCase):
+    """Extracción combinada cabecera + detalle (una pasada ordenada por orden)."""
+
+    def _lines(self, order_ids, changed=None):
+        rows = []
+        for i, order_id in enumerate(order_ids):
+            row = {col: None for col in ORDER_HEADER_COLUMNS}
+            row.update(sales_order_id=order_id, sales_order_detail_id=i + 1,
+                       customer_id=order_id % 7, total_due=Decimal("10.00"),
+                       line_changed=changed is None or order_id in changed)
+            rows.append(row)
+        return rows
+
+    def _run(self, order_ids, changed=None, since=None):
+        keys = list(self._lines([0])[0])
+        rows = [tuple(r.values()) for r in self._lines(order_ids, changed)]
+        factory, session = _fake_session(keys, rows)
+        with patch("src.extract.sql_extractor.oltp_session", factory):
+            batches = list(SQLExtractor(batch_size=3).extract_orders(since))
+        self.query = str(session.execute.call_args.args[0])
+        return batches
+
+    def test_line_count_spans_batches(self):
+        # La orden 2 queda partida entre el primer y el segundo batch
+        batches = self._run([1, 2, 2, 2, 2, 3, 4])
+        lines = sum(len(frame) for frame, _ in batches)
+        headers = [h for _, batch in batches for h in batch]
+        self.assertEqual(lines, 7)
+        self.assertEqual([(h["sales_order_id"], h["line_count"]) for h in headers],
+                         [(1, 1), (2, 4), (3, 1), (4, 1)])
+        self.assertEqual(headers[0]["total_due"], Decimal("10.00"))
+
+    def test_empty_result(self):
+        self.assertEqual(self._run([]), [])
+
+    def test_incremental_writes_only_changed_lines(self):
+        since = {"header_since": datetime(2014, 6, 1), "detail_since": datetime(2014, 6, 1)}
+        batches = self._run([1, 2, 2, 2, 2, 3, 4], changed={2}, since=since)
+        lines = [i for frame, _ in batches for i in frame["sales_order_id"].tolist()]
+        headers = [(h["sales_order_id"], h["line_count"]) for _, batch in batches for h in batch]
+        # Las cabeceras conservan el line_count completo de todas las órdenes del cliente
+        self.assertEqual(lines, [2, 2, 2, 2])
+        self.assertEqual(headers, [(1, 1), (2, 4), (3, 1), (4, 1)])
+        # El filtro de clientes va dentro del CTE de las ventanas
+        self.assertLess(self.query.index("soh.customer_id IN"), self.query.index("FROM lines l"))
+
+    def test_unordered_lines_are_rejected(self):
+        with self.assertRaises(ExtractionError):
+            self._run([1, 3, 2])
+
+    def test_period_query_limits_customers_inside_window(self):
+        query = SQLExtractor.QUERY_ORDERS_PERIOD
+        cte = query[:query.index("FROM lines l")]
+        self.assertIn("h.order_date >= :period_start", cte)
+        self.assertIn("AND l.order_date >= :period_start", query[query.index("FROM lines l"):])
+
+    def test_range_query_orders_outside_subquery(self):
+        query = SQLExtractor._range_query(SQLExtractor.QUERY_ORDERS, "customer_id",
+                                          SQLExtractor.ORDERS_ORDER_BY)
+        self.assertTrue(query.endswith(
+            "WHERE q.customer_id BETWEEN :range_lo AND :range_hi "
+            "ORDER BY q.sales_order_id, q.sales_order_detail_id"))
+
+
+class TestSQLExtractorPartitioned(unittest.TestCase):
+    def _run(self, extract_side_effect, method="extract", call=None):
+        bounds_session = MagicMock()
+        bounds_session.execute.return_value.fetchone.return_value = (1, 9)
+
+        @contextmanager
+        def factory():
+            yield bounds_session
+
+        engine = MagicMock()
+        engine.pool.size.return_value = 5
+        extractor = SQLExtractor(batch_size=2)
+        with patch("src.extract.sql_extractor.oltp_session", factory), \
+             patch("src.extract.sql_extractor.get_oltp_engine", return_value=engine), \
+             patch.object(extractor, method, side_effect=extract_side_effect) as extract:
+            call = call or (lambda ex: ex.extract_partitioned(
+                "SELECT sales_order_id FROM orders", "sales_order_id", "SELECT 1, 9", 3))
+            batches = list(call(extractor))
+        return batches, extract
+
+    def test_ranges_are_merged(self):
+        def fake_extract(query, params):
+            yield [{"sales_order_id": i} for i in range(params["range_lo"], params["range_hi"] + 1)]
+
+        batches, extract = self._run(fake_extract)
+        self.assertEqual(extract.call_count, 3)
+        self.assertIn("BETWEEN :range_lo AND :range_hi", extract.call_args.args[0])
+        ids = sorted(r["sales_order_id"] for b in batches for r in b)
+        self.assertEqual(ids, list(range(1, 10)))
+
+    def test_orders_split_by_customer(self):
+        def fake_stream(query, params):
+            yield [{"customer_id": i} for i in range(params["range_lo"], params["range_hi"] + 1)]
+
+        _, extract = self._run(fake_stream, "_extract_orders_stream",
+                               lambda ex: ex.extract_orders(partitions=3))
+        # Cada rango contiene historiales completos de clientes para las ventanas
+        self.assertIn("q.customer_id BETWEEN", extract.call_args.args[0])
+        self.assertIn("PARTITION BY soh.customer_id", extract.call_args.args[0])
+
+    def test_worker_error_is_raised(self):
+        def failing_extract(query, params):
+            raise RuntimeError("boom")
+            yield  # pragma: no cover
+
+        with self.assertRaises(ExtractionError):
+            self._run(failing_extract)
+
+
+if __name__ == "__main__":
+    unittest.main()
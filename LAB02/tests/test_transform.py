@@ -1,12 +1,22 @@
 """Tests para el módulo de transformación."""
+import random
 import unittest
-from datetime import date
-from decimal import Decimal
+from unittest.mock import patch
+from datetime import date, datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+import pandas as pd
+
 from src.transform import (
-    transform_date, transform_product, transform_customer,
-    transform_fact_sales, transform_fact_orders
+    transform_date, transform_dates, transform_product, transform_customer,
+    transform_fact_sales, transform_fact_orders, transform_fact_sales_batch,
+    transform_territory, row_hash, scaled_to_decimal, FACT_SALES_AMOUNTS
 )
-from src.utils.helpers import date_to_key, get_quarter, price_range
+from src.transform import market_basket
+from src.transform.market_basket import basket_pairs
+from src.transform.key_map import KeyMap, MISSING
+from src.utils.exceptions import TransformationError
+from src.utils.helpers import date_to_key, get_quarter, price_range, split_range
 
 
 class TestTransformDate(unittest.TestCase):
@@ -25,6 +35,11 @@ class TestTransformDate(unittest.TestCase):
         result = transform_date(d)
         self.assertTrue(result["is_weekend"])
 
+    def test_vectorized_calendar_matches_transform_date(self):
+        days = [date(2011, 1, 1) + timedelta(days=i) for i in range(366 * 3)]  # incluye 2012
+        rows = transform_dates(days).astype(object).to_dict("records")
+        self.assertEqual(rows, [transform_date(d) for d in days])
+
     def test_date_key(self):
         self.assertEqual(date_to_key(date(2011, 1, 1)), 20110101)
         self.assertEqual(date_to_key(date(2014, 12, 31)), 20141231)
@@ -35,6 +50,11 @@ class TestTransformDate(unittest.TestCase):
         self.assertEqual(get_quarter(7), 3)
         self.assertEqual(get_quarter(10), 4)
 
+    def test_split_range(self):
+        self.assertEqual(split_range(1, 10, 3), [(1, 4), (5, 7), (8, 10)])
+        self.assertEqual(split_range(5, 6, 4), [(5, 5), (6, 6)])
+        self.assertEqual(split_range(7, 7, 1), [(7, 7)])
+
 
 class TestTransformProduct(unittest.TestCase):
     def setUp(self):
@@ -60,6 +80,23 @@ class TestTransformProduct(unittest.TestCase):
         self.assertEqual(price_range(2000), "High")
 
 
+class TestRowHash(unittest.TestCase):
+    ROW = {"territory_id": 1, "territory_name": "Northwest",
+           "country_code": "US", "region_group": "North America"}
+
+    def test_hash_is_stable_and_tracks_content(self):
+        first = transform_territory(self.ROW)
+        self.assertEqual(len(first["row_hash"]), 32)
+        self.assertEqual(first["row_hash"], transform_territory(dict(self.ROW))["row_hash"])
+        changed = transform_territory({**self.ROW, "territory_name": "Southwest"})
+        self.assertNotEqual(first["row_hash"], changed["row_hash"])
+
+    def test_numeric_representation_does_not_change_hash(self):
+        self.assertEqual(row_hash({"list_price": 12.5, "color": None}),
+                         row_hash({"list_price": Decimal("12.5000"), "color": None}))
+        self.assertNotEqual(row_hash({"color": None}), row_hash({"color": "None"}))
+
+
 class TestTransformCustomer(unittest.TestCase):
     def setUp(self):
         self.row = {
@@ -107,5 +144,240 @@ class TestTransformFactSales(unittest.TestCase):
         self.assertEqual(result["date_key"], 20110531)
 
 
+class TestTransformFactOrders(unittest.TestCase):
+    def setUp(self):
+        self.row = {
+            "sales_order_id": 43700, "order_date": datetime(2013, 3, 15),
+            "customer_id": 29825, "territory_id": 5,
+            "sub_total": "100.00", "tax_amt": "8.00", "freight": "2.50", "total_due": "110.50",
+            "line_count": 3, "customer_order_number": 2,
+            "is_first_order": False, "is_recurring": True, "months_since_first": 14,
+        }
+
+    def test_window_columns_come_from_row(self):
+        result = transform_fact_orders(self.row, customer_key=10, territory_key=3)
+        self.assertEqual(result["date_key"], 20130315)
+        self.assertEqual(result["customer_order_number"], 2)
+        self.assertFalse(result["is_first_order"])
+        self.assertTrue(result["is_recurring"])
+        self.assertEqual(result["months_since_first"], 14)
+        self.assertEqual(result["total_due"], Decimal("110.50"))
+
+
+class TestTransformFactSalesBatch(unittest.TestCase):
+    """El batch vectorizado debe coincidir con transform_fact_sales (referencia)."""
+
+    MONEY = ("unit_price", "unit_price_discount", "standard_cost",
+             "line_total", "cost_total", "gross_margin")
+
+    @staticmethod
+    def _random_rows(n: int, seed: int = 7) -> list[dict]:
+        rnd = random.Random(seed)
+        rows = []
+        for i in range(n):
+            price = Decimal(rnd.randint(0, 4_000_000)).scaleb(-4)
+            rows.append({
+                "sales_order_id": 43659 + i // 3, "sales_order_detail_id": i + 1,
+                "order_date": datetime(2011, 5, 31) + timedelta(days=rnd.randint(0, 1500)),
+                "customer_id": rnd.randint(1, 500), "territory_id": rnd.randint(1, 10),
+                "product_id": rnd.randint(1, 300), "order_qty": rnd.randint(1, 40),
+                "unit_price": price,
+                "unit_price_discount": rnd.choice([Decimal("0.0000"), Decimal("0.0200"),
+                                                   Decimal("0.0500"), Decimal("0.1000"),
+                                                   Decimal("0.1500"), Decimal("0.3333")]),
+                "standard_cost": rnd.choice([price, Decimal(rnd.randint(0, 2_500_000)).scaleb(-4)]),
+                "is_online": rnd.random() < 0.5,
+            })
+        return rows
+
+    def _assert_equivalent(self, rows: list[dict]):
+        frame = pd.DataFrame.from_records(rows)
+        keys = list(range(1, len(rows) + 1))
+        batch = transform_fact_sales_batch(frame, keys, keys, keys)
+        for col in FACT_SALES_AMOUNTS:
+            self.assertEqual(batch[col].dtype, "int64", col)
+            batch[col] = scaled_to_decimal(batch[col])
+        result = batch.to_dict("records")
+        for row, key, got in zip(rows, keys, result):
+            expected = transform_fact_sales(row, key, key, key)
+            for col, value in expected.items():
+                if col in self.MONEY:
+                    # Numeric(19,4): PostgreSQL redondea mitades lejos del cero
+                    value = value.quantize(Decimal("0.0001"), rounding=ROUND_HALF_UP)
+                self.assertEqual(got[col], value, f"{col} difiere en {row}")
+
+    def test_matches_reference_on_random_rows(self):
+        self._assert_equivalent(self._random_rows(500))
+
+    def test_edge_cases(self):
+        base = self._random_rows(1)[0]
+        rows = [
+            {**base, "unit_price": Decimal("0.0000")},                       # line_total = 0
+            {**base, "unit_price": Decimal("0.0001"), "standard_cost": Decimal("9999.0000")},
+            {**base, "unit_price": Decimal("1.0000"), "unit_price_discount": Decimal("0.0001"),
+             "order_qty": 5, "standard_cost": Decimal("0.0000")},          # mitad exacta
+            {**base, "unit_price": Decimal("3578.2700"), "unit_price_discount": Decimal("0.0000"),
+             "standard_cost": Decimal("2171.2942"), "order_date": date(2014, 6, 30)},
+        ]
+        self._assert_equivalent(rows)
+
+    def test_amounts_near_int64_limit(self):
+        # A escala 10^8 estos importes desbordan int64 (y `r * 1000` en el porcentaje):
+        # pasan por Decimal; el resto del batch sigue por la ruta vectorizada
+        base = self._random_rows(1)[0]
+        rows = [
+            {**base, "unit_price": Decimal("90000000.0000"), "order_qty": 1,
+             "standard_cost": Decimal("12345678.9999")},
+            {**base, "unit_price": Decimal("99999999999.9999"), "order_qty": 40,
+             "unit_price_discount": Decimal("0.3333"), "standard_cost": Decimal("99999999999.9999")},
+            {**base, "unit_price": Decimal("0.0001"), "order_qty": 1,
+             "standard_cost": Decimal("9999999.0000")},                     # margen/line_total enorme
+        ] + self._random_rows(20)
+        self._assert_equivalent(rows)
+
+    def test_amounts_out_of_int64_range_are_rejected(self):
+        base = self._random_rows(1)[0]
+        frame = pd.DataFrame.from_records([{**base, "unit_price": Decimal("99999999999.9999"),
+                                            "order_qty": 32767}])
+        with self.assertRaises(TransformationError):
+            transform_fact_sales_batch(frame, [1], [1], [1])
+
+    def test_scaling_is_exact(self):
+        from src.transform import _to_scaled
+        values = [Decimal("3578.2700"), Decimal("-0.0001"), Decimal("123456789012.3456"), 2]
+        self.assertEqual(_to_scaled(values).tolist(),
+                         [35782700, -1, 1234567890123456, 20000])
+        self.assertEqual(_to_scaled(pd.Series([5, 7])).tolist(), [50000, 70000])
+
+    def test_empty_batch(self):
+        frame = pd.DataFrame.from_records(self._random_rows(3)).iloc[0:0]
+        self.assertEqual(len(transform_fact_sales_batch(frame, [], [], [])), 0)
+
+
+class TestMarketBasketSparse(unittest.TestCase):
+    """basket_pairs debe reproducir el self-join SQL de load_agg_market_basket."""
+
+    @staticmethod
+    def _sql_reference(lines: list[tuple[int, int]]) -> dict:
+        """COUNT(DISTINCT orden) por par LEAST/GREATEST y ROUND(co / total, 6)."""
+        baskets = {}
+        for order_id, product_key in lines:
+            baskets.setdefault(order_id, set()).add(product_key)
+        pairs = {}
+        for products in baskets.values():
+            for a in products:
+                for b in products:
+                    if a < b:
+                        pairs[(a, b)] = pairs.get((a, b), 0) + 1
+        total = len(baskets)
+        return {
+            pair: (co, (Decimal(co) / Decimal(total)).quantize(Decimal("0.000001"), ROUND_HALF_UP))
+            for pair, co in pairs.items()
+        }
+
+    @staticmethod
+    def _random_lines(n: int, seed: int = 11) -> list[tuple[int, int]]:
+        rnd = random.Random(seed)
+        lines = []
+        for order_id in range(43659, 43659 + n):
+            # Canastas de 1 a 12 productos, con productos repetidos en la orden
+            lines.extend((order_id, rnd.randint(700, 760)) for _ in range(rnd.randint(1, 12)))
+        rnd.shuffle(lines)
+        return lines
+
+    def _assert_matches(self, lines):
+        frame = basket_pairs([o for o, _ in lines], [p for _, p in lines])
+        got = {(r.product_key_a, r.product_key_b): (r.co_occurrences, r.support)
+               for r in frame.itertuples()}
+        self.assertEqual(got, self._sql_reference(lines))
+        self.assertTrue(frame["co_occurrences"].is_monotonic_decreasing)
+
+    def test_matches_self_join(self):
+        self._assert_matches(self._random_lines(400))
+
+    def test_sparse_pair_accumulation(self):
+        """Con muchos productos se acumula con np.unique en lugar de bincount."""
+        original = market_basket.DENSE_PAIR_LIMIT
+        market_basket.DENSE_PAIR_LIMIT = 0
+        try:
+            self._assert_matches(self._random_lines(200, seed=3))
+        finally:
+            market_basket.DENSE_PAIR_LIMIT = original
+
+    def test_accumulates_ordered_batches(self):
+        """Batches con órdenes partidas entre uno y otro, en modo denso y disperso."""
+        lines = sorted(self._random_lines(300, seed=5))
+        expected = self._sql_reference(lines)
+        for limit, merge in ((market_basket.DENSE_PAIR_LIMIT, market_basket.SPARSE_MERGE_CODES),
+                             (0, 16)):
+            with patch.object(market_basket, "DENSE_PAIR_LIMIT", limit), \
+                 patch.object(market_basket, "SPARSE_MERGE_CODES", merge):
+                accumulator = market_basket.BasketAccumulator(800)
+                for start in range(0, len(lines), 7):
+                    batch = lines[start:start + 7]
+                    accumulator.add([o for o, _ in batch], [p for _, p in batch])
+                frame = accumulator.frame()
+            got = {(r.product_key_a, r.product_key_b): (r.co_occurrences, r.support)
+                   for r in frame.itertuples()}
+            self.assertEqual(got, expected)
+            self.assertEqual(accumulator.total_orders, 300)
+
+    def test_unordered_batches_are_rejected(self):
+        accumulator = market_basket.BasketAccumulator(10)
+        accumulator.add([1, 2], [3, 4])
+        with self.assertRaises(ValueError):
+            accumulator.add([1], [5])
+
+    def test_support_rounds_half_up(self):
+        # 1 de 8 órdenes = 0.125; 1 de 3 = 0.333333; 2 de 3 = 0.666667
+        lines = [(1, 10), (1, 20)] + [(i, 30) for i in range(2, 9)]
+        frame = basket_pairs([o for o, _ in lines], [p for _, p in lines])
+        self.assertEqual(frame["support"].tolist(), [Decimal("0.125000")])
+        lines = [(1, 10), (1, 20), (2, 10), (2, 20), (3, 10)]
+        frame = basket_pairs([o for o, _ in lines], [p for _, p in lines])
+        self.assertEqual(frame["support"].tolist(), [Decimal("0.666667")])
+
+    def test_no_pairs(self):
+        self.assertEqual(len(basket_pairs([1, 2], [10, 10])), 0)
+        self.assertEqual(len(basket_pairs([], [])), 0)
+
+
+class TestKeyMap(unittest.TestCase):
+    MAPPING = {11000: 1, 11001: 2, 11005: 7}
+
+    def _assert_lookup(self, key_map):
+        ids = pd.Series([11001, 11005, 42, 11000, 11002, 99999])
+        self.assertEqual(key_map.lookup(ids).tolist(), [2, 7, MISSING, 1, MISSING, MISSING])
+        self.assertEqual(key_map.get(11005), 7)
+        self.assertIsNone(key_map.get(11002))
+        self.assertIsNone(key_map.get(None))
+        self.assertIn(11000, key_map)
+        self.assertEqual(len(key_map), 3)
+
+    def test_dense_lookup(self):
+        key_map = KeyMap(range(11000, 11006), [1, 2, 3, 4, 5, 7])
+        self.assertTrue(key_map.dense)
+        self.assertEqual(key_map.lookup([11005, 10999, 11006]).tolist(), [7, MISSING, MISSING])
+        key_map = KeyMap.from_dict(self.MAPPING)
+        self.assertTrue(key_map.dense)
+        self._assert_lookup(key_map)
+
+    def test_sparse_ids_use_sorted_search(self):
+        mapping = {**self.MAPPING, 10**9: 9}
+        key_map = KeyMap.from_dict(mapping)
+        self.assertFalse(key_map.dense)
+        self.assertEqual(key_map.lookup([10**9, 11000, 10**9 + 1]).tolist(), [9, 1, MISSING])
+
+    def test_null_ids_have_no_key(self):
+        key_map = KeyMap.from_dict({1: 10, 2: 20})
+        self.assertEqual(key_map.lookup([1, None, 2]).tolist(), [10, MISSING, 20])
+        self.assertEqual(key_map.lookup(pd.Series([2.0, float("nan")])).tolist(), [20, MISSING])
+
+    def test_empty_map(self):
+        key_map = KeyMap.from_dict({})
+        self.assertEqual(key_map.lookup([1, 2]).tolist(), [MISSING, MISSING])
+        self.assertIsNone(key_map.get(1))
+
+
 if __name__ == "__main__":
     unittest.main()